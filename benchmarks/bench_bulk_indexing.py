@@ -0,0 +1,83 @@
+"""
+Indexing throughput (docs/sec) of the ingestion job against FakeOpenSearch.
+
+before: what process_shard used to do, a new client (and connection) per shard
+        of 100 documents, one serial _bulk request and a refresh per shard.
+after:  one pooled keep-alive client shared by the job and BulkIndexer with
+        several _bulk requests in flight.
+
+python benchmarks/bench_bulk_indexing.py --docs 5000 --dim 512 --in-flight 1 2 4 8
+"""
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "embedding"))
+from langchain.docstore.document import Document
+from opensearchpy.helpers import bulk
+from opensearch_ingestion import create_opensearch_client, create_knn_index, MAX_OS_DOCS_PER_PUT
+from bulk_indexer import BulkIndexer
+from ingestion_pipeline import batched
+from fake_opensearch import FakeOpenSearch
+
+# the ingestion module logs every request at INFO
+logging.getLogger("opensearch").setLevel(logging.WARNING)
+
+
+def make_batches(docs: int, dim: int):
+    rng = random.Random(0)
+    chunks = [Document(page_content=f"chunk {i}", metadata={"source": f"page_{i // 20}.html", "chunk_id": f"id-{i}"})
+              for i in range(docs)]
+    vectors = [[rng.random() for _ in range(dim)] for _ in range(docs)]
+    return [(chunks[i:i + MAX_OS_DOCS_PER_PUT], vectors[i:i + MAX_OS_DOCS_PER_PUT])
+            for i in range(0, docs, MAX_OS_DOCS_PER_PUT)]
+
+
+def run_before(server: FakeOpenSearch, batches) -> float:
+    st = time.time()
+    for chunks, vectors in batches:
+        client = create_opensearch_client(server.url, None)
+        bulk(client, [{"_op_type": "index", "_index": "bench", "_id": chunk.metadata["chunk_id"],
+                       "vector_field": vector, "text": chunk.page_content, "metadata": chunk.metadata}
+                      for chunk, vector in zip(chunks, vectors)])
+        client.indices.refresh(index="bench")
+        client.transport.close()
+    return time.time() - st
+
+
+def run_after(server: FakeOpenSearch, batches, in_flight: int, bulk_size: int) -> float:
+    client = create_opensearch_client(server.url, None, pool_maxsize=max(10, in_flight))
+    indexer = BulkIndexer(client, "bench", bulk_size=bulk_size, max_in_flight=in_flight)
+    st = time.time()
+    ok = sum(1 for _ in indexer.index_embedded_batches(iter(batches)))
+    client.indices.refresh(index="bench")
+    elapsed = time.time() - st
+    assert ok == sum(len(chunks) for chunks, _ in batches), indexer.summary()
+    return elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=5000)
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--bulk-size", type=int, default=MAX_OS_DOCS_PER_PUT)
+    parser.add_argument("--request-latency-ms", type=float, default=20.0)
+    parser.add_argument("--per-doc-latency-ms", type=float, default=0.2)
+    parser.add_argument("--in-flight", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    batches = make_batches(args.docs, args.dim)
+    with FakeOpenSearch(args.request_latency_ms, args.per_doc_latency_ms) as server:
+        client = create_opensearch_client(server.url, None)
+        create_knn_index(client, "bench", args.dim)
+        connections = server.state.connections
+        elapsed = run_before(server, batches)
+        print(f"before              docs/sec={args.docs / elapsed:10.1f} connections={server.state.connections - connections}")
+        for in_flight in args.in_flight:
+            connections = server.state.connections
+            elapsed = run_after(server, batches, in_flight, args.bulk_size)
+            print(f"after in_flight={in_flight:>3} docs/sec={args.docs / elapsed:10.1f} "
+                  f"connections={server.state.connections - connections}")
@@ -0,0 +1,118 @@
+"""
+Full rebuild of the index while it is being searched, against fake sagemaker
+and an in-process fake opensearch. The corpus is first loaded into the `docs`
+alias, then rebuilt with changed chunking (every chunk id changes):
+
+    in place      the index is deleted and loaded again under the same name,
+                  the usual way to re-index from scratch
+    fresh index   --fresh-index --bulk-load: a new index with refresh and
+                  replicas off, restored and force-merged at the end, then the
+                  alias is swapped to it
+
+A reader keeps searching the name the query API uses during the rebuild and
+reports how many chunks its searches saw. The index settings seen during and
+after the load are reported too. The fake does not model refresh or HNSW
+costs, this checks the behaviour, not the indexing speed.
+
+python benchmarks/bench_bulk_load.py --max-pages 60
+"""
+import os
+import sys
+import logging
+import time
+import argparse
+import tempfile
+import threading
+from pathlib import Path
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+DATA_DIR = os.path.join(REPO_DIR, "data", "sagemaker.readthedocs.io")
+sys.path.insert(0, BENCHMARKS_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "embedding"))
+import fake_app
+ALIAS = "docs"
+
+
+def ingest(opensearch_url: str, pages_dir: str, tmp_dir: str, extra_args, args) -> float:
+    return fake_app.run_ingestion_job(opensearch_url, ALIAS, pages_dir, tmp_dir, extra_args, dim=args.dim,
+                                      embed_latency_ms=args.embed_latency_ms, verbose=args.verbose)["wall_seconds"]
+
+
+class Reader(threading.Thread):
+    """Searches the alias until stopped, counts the chunks every search sees and the settings of the indexes."""
+
+    def __init__(self, client, state):
+        super().__init__(daemon=True)
+        self.client = client
+        self.state = state
+        self.seen = []
+        self.errors = 0
+        self.settings = set()
+        self.stop = threading.Event()
+
+    def run(self):
+        while not self.stop.is_set():
+            try:
+                response = self.client.search(index=ALIAS, body={"size": 100000, "_source": ["metadata.source"],
+                                                                 "query": {"match_all": {}}})
+                self.seen.append(len(response["hits"]["hits"]))
+            except Exception:
+                self.errors += 1
+            for name, index in list(self.state.indices.items()):
+                settings = index.get("settings", {})
+                self.settings.add((settings.get("index.refresh_interval", "default"),
+                                   settings.get("index.number_of_replicas", "default")))
+            time.sleep(0.02)
+
+
+def rebuild(name: str, opensearch, pages_dir: str, tmp_dir: str, extra_args, before, args) -> None:
+    from opensearch_ingestion import create_opensearch_client
+    # the ingestion module logs every request at INFO
+    logging.getLogger().setLevel(logging.WARNING)
+    reader = Reader(create_opensearch_client(opensearch.url, None), opensearch.state)
+    reader.start()
+    if before is not None:
+        before()
+    seconds = ingest(opensearch.url, pages_dir, tmp_dir, extra_args, args)
+    reader.stop.set()
+    reader.join()
+    index = opensearch.state.resolve(ALIAS)
+    final = opensearch.state.indices[index]
+    settings = final.get("settings", {})
+    print(f"{name:<12} {seconds:>7.2f}s searches={len(reader.seen):>4} errors={reader.errors:>3} "
+          f"chunks seen min={min(reader.seen, default=0):>6} max={max(reader.seen, default=0):>6} "
+          f"final={len(final['docs']):>6} index={index} "
+          f"refresh/replicas seen={sorted(reader.settings)} after="
+          f"{settings.get('index.refresh_interval', 'default')}/{settings.get('index.number_of_replicas', 'default')}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-pages", type=int, default=60)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--embed-latency-ms", type=float, default=20.0)
+    parser.add_argument("--verbose", action="store_true", help="show the logs of the ingestion job")
+    args = parser.parse_args()
+
+    from fake_opensearch import FakeOpenSearch
+    with tempfile.TemporaryDirectory() as tmp, FakeOpenSearch(1.0, 0.0) as opensearch:
+        pages_dir = os.path.join(tmp, "pages")
+        os.makedirs(pages_dir)
+        for p in sorted(Path(DATA_DIR).rglob("*.html"))[:args.max_pages]:
+            os.symlink(p, os.path.join(pages_dir, str(p.relative_to(DATA_DIR)).replace(os.sep, "_")))
+        print(f"pages={len(os.listdir(pages_dir))}")
+        rechunk = ["--chunk-size-for-doc-split", "300"]
+
+        # in place: the index is named like the alias, deleted then loaded again
+        ingest(opensearch.url, pages_dir, tmp, [], args)
+        rebuild("in place", opensearch, pages_dir, tmp, rechunk,
+                lambda: opensearch.state.indices.pop(ALIAS), args)
+
+        # the index of the same name is replaced by the alias at the first fresh load
+        ingest(opensearch.url, pages_dir, tmp, ["--fresh-index", "--fresh-index-name", f"{ALIAS}-1",
+                                                "--delete-previous-index"], args)
+        rebuild("fresh index", opensearch, pages_dir, tmp,
+                rechunk + ["--fresh-index", "--fresh-index-name", f"{ALIAS}-2", "--bulk-load", "--knn-warmup",
+                           "--index-replicas", "1", "--delete-previous-index"], None, args)
+        print(f"indexes={sorted(opensearch.state.indices)} aliases={opensearch.state.aliases}")
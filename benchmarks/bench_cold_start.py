@@ -0,0 +1,85 @@
+"""
+Cold start cost of the Lambda app: time to import `main` and time until the
+configuration of the first request is resolved, with SSM replaced by FakeSSM.
+Every measurement runs in a fresh interpreter.
+
+Pass --before-rev to also measure an older revision of lambda/app, it is
+extracted with `git archive` into a temporary directory.
+
+python benchmarks/bench_cold_start.py --ssm-latency-ms 30 --before-rev <git revision>
+"""
+import io
+import os
+import sys
+import json
+import time
+import tarfile
+import argparse
+import tempfile
+import subprocess
+from statistics import median
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+
+def child(app_dir: str, ssm_latency_ms: float) -> None:
+    sys.path.insert(0, BENCHMARKS_DIR)
+    import fake_ssm
+    fake = fake_ssm.install(fake_ssm.FakeSSM(latency_ms=ssm_latency_ms))
+    os.environ.setdefault("AWS_DEFAULT_REGION", "ap-southeast-2")
+    sys.path.insert(0, app_dir)
+    st = time.perf_counter()
+    import main  # noqa: F401
+    import_seconds = time.perf_counter() - st
+    import_calls = fake.calls
+    # what the first /rag request needs before it can call any endpoint
+    from routers.api_v1.endpoints.fastapi_request import sagemaker_endpoint_mapping, Text2TextModelName, EmbeddingsModelName
+    st = time.perf_counter()
+    sagemaker_endpoint_mapping[Text2TextModelName.flan_t5_xl]
+    sagemaker_endpoint_mapping[EmbeddingsModelName.gpt_j_6b]
+    try:
+        from routers.api_v1.endpoints.config import get_parameter
+        for name in ("REGION", "OPENSEARCH_DOMAIN_ENDPOINT", "OPENSEARCH_INDEX", "ACCESS_KEY", "SECRET_KEY"):
+            get_parameter(name)
+    except ImportError:
+        pass
+    first_use_seconds = time.perf_counter() - st
+    print(json.dumps({"import_seconds": import_seconds, "import_ssm_calls": import_calls,
+                      "first_use_seconds": first_use_seconds, "total_ssm_calls": fake.calls}))
+
+
+def measure(app_dir: str, args) -> dict:
+    runs = []
+    for _ in range(args.repeat):
+        out = subprocess.run([sys.executable, __file__, "--child", app_dir, "--ssm-latency-ms", str(args.ssm_latency_ms)],
+                             check=True, capture_output=True, text=True).stdout
+        runs.append(json.loads(out.strip().splitlines()[-1]))
+    return {key: median(run[key] for run in runs) for key in runs[0]}
+
+
+def report(label: str, result: dict) -> None:
+    print(f"{label:>7}: import={result['import_seconds'] * 1000:8.1f} ms ({result['import_ssm_calls']} ssm calls), "
+          f"first use={result['first_use_seconds'] * 1000:8.1f} ms, total ssm calls={result['total_ssm_calls']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--child", type=str, default=None)
+    parser.add_argument("--ssm-latency-ms", type=float, default=30.0)
+    parser.add_argument("--before-rev", type=str, default=None)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.ssm_latency_ms)
+        sys.exit(0)
+
+    if args.before_rev:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            archive = subprocess.run(["git", "-C", REPO_DIR, "archive", args.before_rev, "lambda/app"],
+                                     check=True, capture_output=True).stdout
+            with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+                tar.extractall(tmp_dir)
+            report("before", measure(os.path.join(tmp_dir, "lambda", "app"), args))
+    report("after", measure(os.path.join(REPO_DIR, "lambda", "app"), args))
@@ -0,0 +1,120 @@
+"""
+Throughput of /text2text and /rag as the number of concurrent clients grows.
+The app is served by uvicorn in a child process against FakeSageMakerServer
+(and the boto3 fake for the code paths still using boto3), FakeOpenSearch and
+FakeSSM. A request path that blocks the event loop serialises the requests,
+so its requests/sec stays flat; a non-blocking one scales with the clients.
+
+Pass --before-rev to also measure an older revision of lambda/app, it is
+extracted with `git archive` into a temporary directory.
+
+python benchmarks/bench_concurrency.py --clients 1 4 16 --latency-ms 200 --before-rev <git revision>
+"""
+import io
+import os
+import sys
+import time
+import socket
+import tarfile
+import argparse
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+EMBEDDING_DIM = 256
+
+
+def child(app_dir: str, port: int, latency_ms: float, os_latency_ms: float) -> None:
+    sys.path.insert(0, BENCHMARKS_DIR)
+    import fake_app
+    from fake_sagemaker import FakeSageMakerRuntime
+    from fake_opensearch import FakeOpenSearch
+
+    runtime = FakeSageMakerRuntime(embedding_dim=EMBEDDING_DIM, latency_ms=latency_ms, per_item_latency_ms=0.0)
+    opensearch = FakeOpenSearch(os_latency_ms, 0.0).__enter__()
+    fake_app.index_synthetic_corpus(opensearch.url, "bench", EMBEDDING_DIM)
+    fake_app.serve(fake_app.load_app(runtime, opensearch.url, "bench", app_dir), port)
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait(port: int, timeout: float = 60.0) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("the app did not start")
+
+
+def load(url: str, clients: int, requests_per_client: int):
+    import requests
+    local = threading.local()
+
+    def _one(i):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        st = time.perf_counter()
+        response = local.session.post(url, json={"query": f"how do I deploy endpoint {i}", "use_cache": False})
+        response.raise_for_status()
+        return time.perf_counter() - st
+
+    total = clients * requests_per_client
+    st = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        latencies = sorted(executor.map(_one, range(total)))
+    elapsed = time.perf_counter() - st
+    return total / elapsed, latencies[len(latencies) // 2], latencies[int(0.95 * (len(latencies) - 1))]
+
+
+def measure(label: str, app_dir: str, args) -> None:
+    port = _free_port()
+    proc = subprocess.Popen([sys.executable, __file__, "--child", app_dir, "--port", str(port),
+                             "--latency-ms", str(args.latency_ms), "--os-latency-ms", str(args.os_latency_ms)])
+    try:
+        _wait(port)
+        for endpoint in args.endpoints:
+            url = f"http://127.0.0.1:{port}/api/v1/llm/{endpoint}"
+            load(url, 1, 2)  # warm up, the first /rag initialises the vector db
+            for clients in args.clients:
+                rps, p50, p95 = load(url, clients, args.requests_per_client)
+                print(f"{label:>6} {endpoint:<9} clients={clients:<3} req/s={rps:7.2f} "
+                      f"p50_ms={p50 * 1000:8.1f} p95_ms={p95 * 1000:8.1f}")
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--child", type=str, default=None)
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--latency-ms", type=float, default=200.0)
+    parser.add_argument("--os-latency-ms", type=float, default=10.0)
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--requests-per-client", type=int, default=5)
+    parser.add_argument("--endpoints", type=str, nargs="+", default=["text2text", "rag"])
+    parser.add_argument("--before-rev", type=str, default=None)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.port, args.latency_ms, args.os_latency_ms)
+        sys.exit(0)
+
+    if args.before_rev:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            archive = subprocess.run(["git", "-C", REPO_DIR, "archive", args.before_rev, "lambda/app"],
+                                     check=True, capture_output=True).stdout
+            with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+                tar.extractall(tmp_dir)
+            measure("before", os.path.join(tmp_dir, "lambda", "app"), args)
+    measure("after", os.path.join(REPO_DIR, "lambda", "app"), args)
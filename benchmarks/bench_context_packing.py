@@ -0,0 +1,101 @@
+"""
+Prompt tokens and coverage of the context stuffed into the prompt, the top k
+chunks as before vs context packing (merge of overlapping chunks, score
+threshold, MMR and token budget) on CONTEXT_CANDIDATES_FACTOR * k candidates.
+
+The bundled SageMaker docs are split like the ingestion job does (chunk offsets
+included) and searched exactly with the fake embeddings. Every query is a run
+of words taken from a random chunk, the context covers the query when it
+contains that chunk. Sources counts the distinct pages in the context.
+
+python benchmarks/bench_context_packing.py --max-pages 60 --queries 200 --k 3 --budgets 400 200 100
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import numpy as np
+from pathlib import Path
+from typing import List, Tuple
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(ROOT, "embedding"))
+sys.path.append(os.path.join(ROOT, "lambda", "app"))
+from langchain.docstore.document import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from ingestion_pipeline import clean_readthedocs_html
+from ingestion_manifest import split_documents_with_ids
+from routers.api_v1.endpoints.context_packing import (CONTEXT_CANDIDATES_FACTOR, SCORE_FIELD, count_tokens,
+                                                      pack_context)
+from fake_sagemaker import fake_embedding
+
+
+def load_pages(data_dir: str, max_pages: int) -> List[Document]:
+    return [Document(page_content=clean_readthedocs_html(p.read_text(errors="ignore"), features="html.parser"),
+                     metadata={"source": str(p)}) for p in sorted(Path(data_dir).rglob("*.html"))[:max_pages]]
+
+
+def make_queries(chunks: List[Document], n: int, words: int) -> List[Tuple[str, str]]:
+    # (query, chunk text) pairs
+    rng = random.Random(0)
+    queries = []
+    while len(queries) < n:
+        text = rng.choice(chunks).page_content
+        tokens = text.split()
+        if len(tokens) < words * 2:
+            continue
+        start = rng.randrange(len(tokens) - words)
+        queries.append((" ".join(tokens[start:start + words]), text))
+    return queries
+
+
+def search(vectors: np.ndarray, chunks: List[Document], query: str, k: int, dim: int) -> List[Document]:
+    distances = ((vectors - np.asarray(fake_embedding(query, dim), dtype=np.float32)) ** 2).sum(axis=1)
+    top = np.argsort(distances)[:k]
+    return [Document(page_content=chunks[i].page_content, metadata=dict(chunks[i].metadata, **{
+        SCORE_FIELD: float(1.0 / (1.0 + distances[i]))})) for i in top]
+
+
+def evaluate(name: str, queries: List[Tuple[str, str]], candidates: List[List[Document]], pack) -> None:
+    tokens, covered, sources, seconds = [], 0, [], 0.0
+    for (_, expected), docs in zip(queries, candidates):
+        st = time.perf_counter()
+        context = pack(docs)
+        seconds += time.perf_counter() - st
+        text = "\n\n".join(doc.page_content for doc in context)
+        tokens.append(count_tokens(text))
+        covered += expected in text
+        sources.append(len({doc.metadata.get("source") for doc in context}))
+    print(f"{name:<34} tokens mean={np.mean(tokens):6.1f} p95={np.percentile(tokens, 95):6.1f} "
+          f"coverage={covered / len(queries):.3f} sources={np.mean(sources):.2f} "
+          f"pack_ms={seconds * 1000 / len(queries):.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-dir", type=str, default=os.path.join(ROOT, "data", "sagemaker.readthedocs.io"))
+    parser.add_argument("--max-pages", type=int, default=60)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--query-words", type=int, default=8)
+    parser.add_argument("--candidates-factor", type=int, default=CONTEXT_CANDIDATES_FACTOR)
+    parser.add_argument("--budgets", type=int, nargs="+", default=[400, 200, 100])
+    parser.add_argument("--min-score", type=float, default=0.0)
+    parser.add_argument("--mmr-lambdas", type=float, nargs="+", default=[1.0, 0.7, 0.5])
+    args = parser.parse_args()
+
+    pages = load_pages(args.data_dir, args.max_pages)
+    chunks = split_documents_with_ids(RecursiveCharacterTextSplitter(chunk_size=200, chunk_overlap=30), pages, "fake")
+    queries = make_queries(chunks, args.queries, args.query_words)
+    vectors = np.asarray([fake_embedding(chunk.page_content, args.dim) for chunk in chunks], dtype=np.float32)
+    n = args.k * args.candidates_factor
+    candidates = [search(vectors, chunks, query, n, args.dim) for query, _ in queries]
+    print(f"chunks={len(chunks)} queries={len(queries)} k={args.k} candidates={n} dim={args.dim}")
+    evaluate(f"top {args.k} (before)", queries, candidates, lambda docs: docs[:args.k])
+    for budget in args.budgets:
+        for lambda_mult in args.mmr_lambdas:
+            evaluate(f"packed budget={budget} mmr={lambda_mult}", queries, candidates,
+                     lambda docs: pack_context(docs, args.k, token_budget=budget, min_score=args.min_score,
+                                               lambda_mult=lambda_mult)[0])
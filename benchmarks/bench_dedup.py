@@ -0,0 +1,84 @@
+"""
+Deduplication of the chunks of the bundled docs, the ingestion job runs
+against fake sagemaker and an in-process fake opensearch with:
+
+    no dedup        --no-dedup, every chunk is embedded
+    dedup           the default, chunks with the same normalized text share
+                    one embedding
+    near-duplicates --near-duplicate-filter, chunks close to a chunk already
+                    kept (simhash) are not indexed either
+
+It reports the endpoint calls, the chunk texts embedded and the chunks in the
+index. The 5 nearest chunks of every chunk of the dedup index are compared
+with those of the no dedup index, a reused vector must not change them.
+
+python benchmarks/bench_dedup.py --max-pages 200
+"""
+import os
+import sys
+import argparse
+import tempfile
+from pathlib import Path
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+DATA_DIR = os.path.join(REPO_DIR, "data", "sagemaker.readthedocs.io")
+sys.path.insert(0, BENCHMARKS_DIR)
+
+RUNS = [("no dedup", ["--no-dedup"]),
+        ("dedup", []),
+        ("near-duplicates", ["--near-duplicate-filter"])]
+
+
+def same_neighbours(state, index_name: str, reference: str, k: int = 5) -> float:
+    """Fraction of the chunks whose k nearest chunks (by id) are the same as in the reference index."""
+    import numpy as np
+
+    def neighbours(name):
+        docs = state.docs(name)
+        ids = sorted(docs)
+        vectors = np.array([docs[_id]["vector_field"] for _id in ids], dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+        top = np.argsort(-(vectors @ vectors.T), axis=1, kind="stable")[:, :k]
+        return {_id: {ids[j] for j in row} for _id, row in zip(ids, top)}
+
+    got, expected = neighbours(index_name), neighbours(reference)
+    return sum(got[_id] == expected.get(_id) for _id in got) / max(1, len(got))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-pages", type=int, default=200)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--embed-latency-ms", type=float, default=20.0)
+    parser.add_argument("--process-count", type=int, default=2)
+    parser.add_argument("--verbose", action="store_true", help="show the logs of the ingestion job")
+    args = parser.parse_args()
+
+    import fake_app
+    from fake_opensearch import FakeOpenSearch
+    with tempfile.TemporaryDirectory() as tmp, FakeOpenSearch(1.0, 0.0) as opensearch:
+        pages_dir = os.path.join(tmp, "pages")
+        os.makedirs(pages_dir)
+        for p in sorted(Path(DATA_DIR).rglob("*.html"))[:args.max_pages]:
+            os.symlink(p, os.path.join(pages_dir, str(p.relative_to(DATA_DIR)).replace(os.sep, "_")))
+        print(f"pages={len(os.listdir(pages_dir))} process_count={args.process_count}")
+        print(f"{'run':<16} {'time':>8} {'calls':>7} {'embedded':>9} {'reused':>7} {'dropped':>8} {'chunks':>7} "
+              f"{'same top5':>10}")
+        for i, (name, extra_args) in enumerate(RUNS):
+            index_name = f"dedup-{i}"
+            job_metrics = fake_app.run_ingestion_job(opensearch.url, index_name, pages_dir, tmp, extra_args,
+                                                     dim=args.dim, embed_latency_ms=args.embed_latency_ms,
+                                                     process_count=args.process_count, verbose=args.verbose)
+            counters = {}
+            for counter in job_metrics["metrics"]["counters"]:
+                counters[counter["name"]] = counters.get(counter["name"], 0) + counter["value"]
+            texts = int(counters.get("dedup_texts_total", 0))
+            reused = int(counters.get("dedup_embeddings_saved_total", 0))
+            # the chunks dropped as near duplicates are not in the index, their neighbours are not compared
+            agreement = same_neighbours(opensearch.state, index_name, "dedup-0") if name == "dedup" else None
+            print(f"{name:<16} {job_metrics['wall_seconds']:>7.2f}s {job_metrics['embedding_calls']:>7} "
+                  f"{texts - reused if texts else '-':>9} {reused:>7} "
+                  f"{int(counters.get('dedup_near_duplicates_dropped_total', 0)):>8} "
+                  f"{len(opensearch.state.docs(index_name)):>7} "
+                  f"{'-' if agreement is None else f'{agreement:.1%}':>10}")
@@ -0,0 +1,51 @@
+"""
+Embedding throughput (docs/sec) of SagemakerEndpointEmbeddingsJumpStart as the
+number of in-flight requests changes, measured against FakeSageMakerRuntime.
+
+python benchmarks/bench_embedding.py --docs 500 --latency-ms 100 --capacity 8
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "embedding"))
+from embedding_helper import create_sagemaker_embeddings_from_js_model
+from fake_sagemaker import FakeSageMakerRuntime
+
+
+def run(args, max_in_flight: int, use_asyncio: bool) -> float:
+    fake = FakeSageMakerRuntime(embedding_dim=args.dim, latency_ms=args.latency_ms,
+                                jitter_ms=args.jitter_ms, capacity=args.capacity)
+    embeddings = create_sagemaker_embeddings_from_js_model("fake-embeddings", "ap-southeast-2",
+                                                           batch_size=args.batch_size,
+                                                           max_in_flight=max_in_flight)
+    embeddings.client = fake
+    texts = [f"document number {i} about sagemaker processing jobs" for i in range(args.docs)]
+    st = time.time()
+    if use_asyncio:
+        results = asyncio.run(embeddings.aembed_documents(texts))
+    else:
+        results = embeddings.embed_documents(texts)
+    elapsed = time.time() - st
+    assert len(results) == len(texts)
+    print(f"{'asyncio' if use_asyncio else 'sync':>7} max_in_flight={max_in_flight:>3} "
+          f"docs/sec={len(texts) / elapsed:10.1f} calls={fake.calls} throttled={fake.throttled}")
+    return len(texts) / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=500)
+    parser.add_argument("--batch-size", type=int, default=5)
+    parser.add_argument("--dim", type=int, default=4096)
+    parser.add_argument("--latency-ms", type=float, default=100.0)
+    parser.add_argument("--jitter-ms", type=float, default=20.0)
+    parser.add_argument("--capacity", type=int, default=None)
+    parser.add_argument("--in-flight", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    args = parser.parse_args()
+
+    for use_asyncio in (False, True):
+        for max_in_flight in args.in_flight:
+            run(args, max_in_flight, use_asyncio)
@@ -0,0 +1,69 @@
+"""
+Persistent embedding cache of the ingestion job, against fake sagemaker and
+an in-process fake opensearch, every run loads a new index from the same pages:
+
+    cold            --embedding-cache-dir on an empty directory
+    warm            the same job again, every text is in the cache
+    re-chunked      --chunk-size-for-doc-split 300 --chunk-overlap-for-doc-split 0,
+                    only the chunk texts the first runs did not have are embedded
+    re-chunked, no cache  the same without the cache, for comparison
+
+The in-run deduplication is off (--no-dedup) so the endpoint calls only
+depend on the cache. The last line checks that the vectors read from the cache
+are the ones the endpoint returned.
+
+python benchmarks/bench_embedding_cache.py --max-pages 200
+"""
+import os
+import sys
+import argparse
+import tempfile
+from pathlib import Path
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+DATA_DIR = os.path.join(REPO_DIR, "data", "sagemaker.readthedocs.io")
+sys.path.insert(0, BENCHMARKS_DIR)
+RECHUNK = ["--chunk-size-for-doc-split", "300", "--chunk-overlap-for-doc-split", "0"]
+
+
+def vectors_by_text(state, index_name: str) -> dict:
+    return {doc["text"]: doc["vector_field"] for doc in state.docs(index_name).values()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-pages", type=int, default=200)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--embed-latency-ms", type=float, default=20.0)
+    parser.add_argument("--verbose", action="store_true", help="show the logs of the ingestion job")
+    args = parser.parse_args()
+
+    import fake_app
+    from fake_opensearch import FakeOpenSearch
+    with tempfile.TemporaryDirectory() as tmp, FakeOpenSearch(1.0, 0.0) as opensearch:
+        pages_dir = os.path.join(tmp, "pages")
+        os.makedirs(pages_dir)
+        for p in sorted(Path(DATA_DIR).rglob("*.html"))[:args.max_pages]:
+            os.symlink(p, os.path.join(pages_dir, str(p.relative_to(DATA_DIR)).replace(os.sep, "_")))
+        cache = ["--embedding-cache-dir", os.path.join(tmp, "embedding-cache")]
+        print(f"pages={len(os.listdir(pages_dir))}")
+        print(f"{'run':<22} {'time':>8} {'calls':>7} {'hits':>7} {'misses':>7} {'chunks':>7} {'cache MB':>9}")
+        for index_name, name, extra_args in [("cold", "cold", cache),
+                                             ("warm", "warm", cache),
+                                             ("rechunked", "re-chunked", cache + RECHUNK),
+                                             ("rechunked-nocache", "re-chunked, no cache", RECHUNK)]:
+            job_metrics = fake_app.run_ingestion_job(opensearch.url, index_name, pages_dir, tmp,
+                                                     ["--no-dedup"] + extra_args, dim=args.dim,
+                                                     embed_latency_ms=args.embed_latency_ms, verbose=args.verbose)
+            counters = {}
+            for counter in job_metrics["metrics"]["counters"]:
+                counters[counter["name"]] = counters.get(counter["name"], 0) + counter["value"]
+            cache_bytes = sum(f.stat().st_size for f in Path(cache[1]).rglob("*") if f.is_file())
+            print(f"{name:<22} {job_metrics['wall_seconds']:>7.2f}s {job_metrics['embedding_calls']:>7} "
+                  f"{int(counters.get('embedding_cache_hits_total', 0)):>7} "
+                  f"{int(counters.get('embedding_cache_misses_total', 0)):>7} "
+                  f"{len(opensearch.state.docs(index_name)):>7} {cache_bytes / 2 ** 20:>9.1f}")
+        cached, expected = vectors_by_text(opensearch.state, "rechunked"), vectors_by_text(opensearch.state, "rechunked-nocache")
+        same = sum(cached[text] == expected.get(text) for text in cached)
+        print(f"vectors of the re-chunked run equal to the endpoint's: {same}/{len(cached)}")
@@ -0,0 +1,79 @@
+"""
+Time to load the bundled SageMaker docs: the serial loader the ingestion job
+used (BeautifulSoup, html.parser, whole page) vs html_loader's process pool,
+for every installed parser, without the cache, with an empty cache and with a
+warm one. Every run is checked to give exactly the documents of the serial
+loader.
+
+python benchmarks/bench_html_loader.py --workers 4
+"""
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import warnings
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(ROOT, "embedding"))
+from ingestion_pipeline import iter_readthedocs_documents  # noqa: E402
+from html_loader import iter_readthedocs_documents_parallel  # noqa: E402
+
+
+def installed_parsers():
+    yield "html.parser"
+    try:
+        import lxml  # noqa: F401
+        yield "lxml"
+    except ImportError:
+        pass
+    try:
+        from selectolax.lexbor import LexborHTMLParser  # noqa: F401
+        yield "lexbor"
+    except ImportError:
+        pass
+
+
+def copy_pages(data_dir: str, output_dir: str, max_pages: int) -> int:
+    # only the html pages, the loaders read every file of the directory
+    pages = sorted(os.path.join(d, name) for d, _, names in os.walk(data_dir) for name in names if name.endswith(".html"))
+    pages = pages[:max_pages] if max_pages else pages
+    for page in pages:
+        target = os.path.join(output_dir, os.path.relpath(page, data_dir))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copyfile(page, target)
+    return len(pages)
+
+
+def load(documents) -> dict:
+    return {doc.metadata["source"]: doc.page_content for doc in documents}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-dir", type=str, default=os.path.join(ROOT, "data", "sagemaker.readthedocs.io"))
+    parser.add_argument("--max-pages", type=int, default=0, help="0 loads every page")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    warnings.filterwarnings("ignore")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        input_dir = os.path.join(tmp, "input")
+        pages = copy_pages(args.data_dir, input_dir, args.max_pages)
+        print(f"pages={pages} workers={args.workers} cpus={os.cpu_count()}")
+        st = time.perf_counter()
+        expected = load(iter_readthedocs_documents(input_dir, features="html.parser"))
+        before = time.perf_counter() - st
+        print(f"{'serial html.parser (before)':<34} {before:>7.2f}s {pages / before:>8.1f} pages/s")
+        for name in installed_parsers():
+            cache_dir = os.path.join(tmp, f"cache-{name}")
+            for label, cache in (("", None), (" empty cache", cache_dir), (" warm cache", cache_dir)):
+                st = time.perf_counter()
+                documents = load(iter_readthedocs_documents_parallel(input_dir, workers=args.workers, cache_dir=cache,
+                                                                     parser=name))
+                seconds = time.perf_counter() - st
+                print(f"{'pool ' + name + label:<34} {seconds:>7.2f}s {pages / seconds:>8.1f} pages/s "
+                      f"{before / seconds:>6.1f}x {'same documents' if documents == expected else 'DIFFERENT DOCUMENTS'}")
@@ -0,0 +1,116 @@
+"""
+Relevance and latency of vector only vs hybrid (BM25 + k-NN) retrieval on the
+bundled SageMaker docs, indexed into FakeOpenSearch with the fake embeddings.
+
+Queries ask about an API name (dotted path, snake_case or CamelCase identifier)
+taken from the corpus, a chunk is relevant when it contains that name. A small
+--dim makes the hashed embeddings lossy like a real model is on exact strings.
+Reports hit rate and MRR at k, and the mean/p95 latency of a retrieval call.
+
+python benchmarks/bench_hybrid_retrieval.py --max-pages 60 --queries 200 --k 3
+"""
+import os
+import re
+import sys
+import time
+import random
+import logging
+import argparse
+from pathlib import Path
+from typing import List
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(ROOT, "embedding"))
+sys.path.append(os.path.join(ROOT, "lambda", "app"))
+from langchain.embeddings.base import Embeddings
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain.vectorstores import OpenSearchVectorSearch
+from opensearchpy.helpers import bulk
+from ingestion_pipeline import clean_readthedocs_html
+from opensearch_ingestion import create_opensearch_client, create_knn_index
+from routers.api_v1.endpoints.hybrid_search import hybrid_similarity_search
+from fake_opensearch import FakeOpenSearch
+from fake_sagemaker import fake_embedding
+
+logging.getLogger("opensearch").setLevel(logging.WARNING)
+logging.getLogger("routers").setLevel(logging.WARNING)
+
+_IDENTIFIER = re.compile(r"\b(?:[A-Za-z_]\w*\.){1,}[A-Za-z_]\w*\b|\b[a-z]+_[a-z_]+\b|\b[A-Z][a-z]+[A-Z]\w+\b")
+
+
+class FakeEmbeddings(Embeddings):
+    def __init__(self, dim: int):
+        self.dim = dim
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [fake_embedding(text, self.dim) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return fake_embedding(text, self.dim)
+
+
+def load_chunks(data_dir: str, max_pages: int) -> List[str]:
+    splitter = RecursiveCharacterTextSplitter(chunk_size=200, chunk_overlap=30)
+    chunks = []
+    for p in sorted(Path(data_dir).rglob("*.html"))[:max_pages]:
+        text = clean_readthedocs_html(p.read_text(errors="ignore"), features="html.parser")
+        chunks.extend(splitter.split_text(text))
+    return chunks
+
+
+def make_queries(chunks: List[str], n: int) -> List[str]:
+    identifiers = sorted({m for chunk in chunks for m in _IDENTIFIER.findall(chunk) if len(m) > 6})
+    rng = random.Random(0)
+    templates = ["how do I use {}", "what does {} do", "example of {} in a training job", "{} raises an error"]
+    return [rng.choice(templates).format(name) for name in rng.sample(identifiers, min(n, len(identifiers)))]
+
+
+def evaluate(search, queries: List[str], k: int):
+    hits, rr, latencies = 0, 0.0, []
+    for query in queries:
+        name = next(m for m in _IDENTIFIER.findall(query) if len(m) > 6)
+        st = time.perf_counter()
+        docs = search(query, k)
+        latencies.append(time.perf_counter() - st)
+        ranks = [i for i, doc in enumerate(docs, start=1) if name in doc.page_content]
+        if ranks:
+            hits += 1
+            rr += 1.0 / ranks[0]
+    latencies.sort()
+    return hits / len(queries), rr / len(queries), sum(latencies) / len(latencies), latencies[int(0.95 * (len(latencies) - 1))]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-dir", type=str, default=os.path.join(ROOT, "data", "sagemaker.readthedocs.io"))
+    parser.add_argument("--max-pages", type=int, default=60)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--request-latency-ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    chunks = load_chunks(args.data_dir, args.max_pages)
+    queries = make_queries(chunks, args.queries)
+    embeddings = FakeEmbeddings(args.dim)
+    print(f"chunks={len(chunks)} queries={len(queries)} k={args.k} dim={args.dim}")
+    with FakeOpenSearch(args.request_latency_ms, 0.0) as server:
+        client = create_opensearch_client(server.url, None)
+        create_knn_index(client, "bench", args.dim)
+        vectors = embeddings.embed_documents(chunks)
+        bulk(client, ({"_index": "bench", "_id": str(i), "vector_field": vector, "text": text, "metadata": {"chunk": i}}
+                      for i, (text, vector) in enumerate(zip(chunks, vectors))))
+        vector_db = OpenSearchVectorSearch(index_name="bench", embedding_function=embeddings, opensearch_url=server.url)
+
+        runs = [
+            ("vector", args.k, lambda q, k: vector_db.similarity_search(q, k=k)),
+            ("vector k*3", args.k * 3, lambda q, k: vector_db.similarity_search(q, k=k)),
+            ("hybrid rrf", args.k, lambda q, k: hybrid_similarity_search(vector_db, q, k=k)),
+            ("hybrid weighted", args.k, lambda q, k: hybrid_similarity_search(vector_db, q, k=k, fusion_method="weighted")),
+            ("hybrid rrf 0.3/0.7", args.k, lambda q, k: hybrid_similarity_search(vector_db, q, k=k, lexical_weight=0.3,
+                                                                                 vector_weight=0.7)),
+        ]
+        for name, k, search in runs:
+            hit_rate, mrr, mean, p95 = evaluate(search, queries, k)
+            print(f"{name:<20} k={k:<3} hit_rate={hit_rate:.3f} mrr={mrr:.3f} "
+                  f"mean_ms={mean * 1000:7.2f} p95_ms={p95 * 1000:7.2f}")
@@ -0,0 +1,98 @@
+"""
+Per-request setup of /rag and the generation parameters the text generation
+endpoint actually receives. The app runs in-process (TestClient) against fake
+sagemaker, FakeOpenSearch and FakeSSM. The requests cycle through a few sets of
+max_length / temperature / top_k, a correct app sends every request's own set.
+
+Reports the mean of the "prompt" stage (prompt template and qa chain of the
+request) and the fraction of the generation calls with the parameters of the
+request they answer.
+
+Pass --before-rev to also measure an older revision of lambda/app, it is
+extracted with `git archive` into a temporary directory.
+
+python benchmarks/bench_llm_pool.py --requests 200 --parameter-sets 4 --before-rev <git revision>
+"""
+import io
+import os
+import sys
+import json
+import tarfile
+import argparse
+import tempfile
+import subprocess
+from collections import Counter
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+EMBEDDING_DIM = 256
+
+
+def parameter_sets(n: int):
+    return [{"max_length": 100 * (i + 1), "temperature": round(0.2 + 0.2 * i, 2), "top_k": 50 + i}
+            for i in range(n)]
+
+
+def child(app_dir: str, args) -> None:
+    sys.path.insert(0, BENCHMARKS_DIR)
+    import logging
+    import fake_app
+    from fake_sagemaker import FakeSageMakerRuntime
+    from fake_opensearch import FakeOpenSearch
+    from fastapi.testclient import TestClient
+
+    runtime = FakeSageMakerRuntime(embedding_dim=EMBEDDING_DIM, latency_ms=0.0, per_item_latency_ms=0.0)
+    with FakeOpenSearch(0.0, 0.0) as opensearch:
+        fake_app.index_synthetic_corpus(opensearch.url, "bench", EMBEDDING_DIM)
+        client = TestClient(fake_app.load_app(runtime, opensearch.url, "bench", app_dir))
+        # the app logs every llm it sets up at INFO
+        logging.getLogger().setLevel(logging.WARNING)
+        from routers.api_v1.endpoints.metrics import registry
+        sets = parameter_sets(args.parameter_sets)
+        expected = Counter()
+        for i in range(args.requests):
+            parameters = sets[i % len(sets)]
+            response = client.post("/api/v1/llm/rag", json={"query": f"how do I deploy endpoint {i}", "use_cache": False,
+                                                           **parameters})
+            response.raise_for_status()
+            request = {"max_length": 500, "num_return_sequences": 1, "top_k": 250, "top_p": 0.95,
+                       "do_sample": False, "temperature": 1, **parameters}
+            expected[json.dumps(request, sort_keys=True)] += 1
+        prompt = next((h for h in registry.as_dict()["histograms"]
+                       if h["name"] == "stage_seconds" and h["labels"].get("stage") == "prompt"), {"mean": 0.0})
+        received = runtime.generation_parameters
+        correct = sum(min(count, received[key]) for key, count in expected.items())
+        print(json.dumps({"prompt_ms": prompt["mean"] * 1000, "correct": correct, "requests": args.requests,
+                          "distinct_received": len(received)}))
+
+
+def measure(label: str, app_dir: str, args) -> None:
+    out = subprocess.run([sys.executable, __file__, "--child", app_dir, "--requests", str(args.requests),
+                          "--parameter-sets", str(args.parameter_sets)],
+                         check=True, capture_output=True, text=True).stdout
+    result = json.loads(out.strip().splitlines()[-1])
+    print(f"{label:>6} prompt stage mean={result['prompt_ms']:7.3f} ms, generation calls with the request's "
+          f"parameters={result['correct']}/{result['requests']}, distinct parameter sets received="
+          f"{result['distinct_received']}/{args.parameter_sets}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--child", type=str, default=None)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--parameter-sets", type=int, default=4)
+    parser.add_argument("--before-rev", type=str, default=None)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args)
+        sys.exit(0)
+
+    if args.before_rev:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            archive = subprocess.run(["git", "-C", REPO_DIR, "archive", args.before_rev, "lambda/app"],
+                                     check=True, capture_output=True).stdout
+            with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+                tar.extractall(tmp_dir)
+            measure("before", os.path.join(tmp_dir, "lambda", "app"), args)
+    measure("after", os.path.join(REPO_DIR, "lambda", "app"), args)
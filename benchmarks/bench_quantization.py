@@ -0,0 +1,135 @@
+"""
+Recall vs memory of the vector encodings, on a synthetic corpus shaped like
+the gpt-j-6b embeddings (4096 dimensions, most of the variance in a few
+hundred directions, so PQ and PCA behave like they do on real embeddings).
+
+- OpenSearch encodings (float32, fp16, byte and byte with rescoring):
+  the documents and the queries go through VectorEncoding like the ingestion
+  job and the API do and are searched exactly, so the recall only reflects the
+  quantization, not the HNSW graph. Memory is the k-NN plugin estimate for
+  HNSW, 1.1 * (vector bytes + 8 * m) per vector.
+- FAISS artifacts: exported with FaissExporter and searched through
+  FaissVectorStore, memory is the size of index.faiss (the fp16 copy used for
+  rescoring is memory-mapped, it is reported separately as disk).
+
+Recall@k is the share of the exact float32 top k that is returned.
+
+python benchmarks/bench_quantization.py --docs 20000 --dim 4096 --queries 200 --k 4
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "embedding"))
+sys.path.insert(0, os.path.join(REPO_DIR, "lambda", "app"))
+
+from vector_quantization import VectorEncoding, rescore  # noqa: E402
+
+HNSW_M = 16
+
+
+def synthetic_embeddings(n: int, dim: int, rank: int, seed: int) -> np.ndarray:
+    # low rank signal plus isotropic noise, around a common offset like real embeddings
+    rng = np.random.default_rng(seed)
+    basis = np.random.default_rng(0).standard_normal((rank, dim)).astype(np.float32) / np.sqrt(rank)
+    offset = np.random.default_rng(1).standard_normal(dim).astype(np.float32) * 0.2
+    decay = (1.0 / np.sqrt(np.arange(1, rank + 1))).astype(np.float32)
+    latent = rng.standard_normal((n, rank)).astype(np.float32) * decay
+    return offset + latent @ basis + rng.standard_normal((n, dim)).astype(np.float32) * 0.02
+
+
+def exact_top_k(corpus: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    squared_norms = (corpus.astype(np.float32) ** 2).sum(axis=1)
+    top = []
+    for query in queries:
+        distances = squared_norms - 2 * (corpus @ query.astype(corpus.dtype)).astype(np.float32)
+        part = np.argpartition(distances, k)[:k]
+        top.append(part[np.argsort(distances[part])])
+    return np.asarray(top)
+
+
+def recall(found, truth: np.ndarray) -> float:
+    return float(np.mean([len(set(map(int, f)) & set(map(int, t))) / len(t) for f, t in zip(found, truth)]))
+
+
+def opensearch_runs(corpus: np.ndarray, queries: np.ndarray, truth: np.ndarray, k: int, oversample: int):
+    rescore_vectors = corpus.astype(np.float16).astype(np.float32)
+    for name, rescored in (("float32", False), ("fp16", False), ("byte", False), ("byte", True)):
+        encoding = VectorEncoding(name, rescore=rescored)
+        encoding.calibrate(corpus[:100])
+        encoded = encoding.encode(corpus).astype(np.float32)
+        if name == "fp16":
+            # what the fp16 scalar quantizer of the faiss engine keeps
+            encoded = corpus.astype(np.float16).astype(np.float32)
+        st = time.perf_counter()
+        candidates = exact_top_k(encoded, encoding.encode(queries).astype(np.float32), k * oversample if rescored else k)
+        found = []
+        for query, ids in zip(queries, candidates):
+            if rescored:
+                order, _ = rescore(query, rescore_vectors[ids], k)
+                ids = ids[order]
+            found.append(ids[:k])
+        ms = (time.perf_counter() - st) * 1000 / len(queries)
+        memory = 1.1 * (encoding.bytes_per_vector(corpus.shape[1]) + 8 * HNSW_M) * len(corpus)
+        disk = 2 * corpus.size if rescored else 0
+        yield f"opensearch {name}{' +rescore' if rescored else ''}", recall(found, truth), memory, disk, ms
+
+
+def faiss_runs(corpus: np.ndarray, queries: np.ndarray, truth: np.ndarray, k: int, pq_m: int, pca_dim: int):
+    from langchain.docstore.document import Document
+    from faiss_export import FaissExporter, RESCORE_FILE
+    from routers.api_v1.endpoints.faiss_store import FaissVectorStore
+    configs = [("hnsw", {}), ("hnsw_fp16", {}), ("hnsw_sq8", {}), ("hnsw_sq8", {"rescore": True}),
+               ("ivfpq", {}), ("ivfpq", {"rescore": True}),
+               ("ivfpq", {"pca_dim": pca_dim}), ("ivfpq", {"pca_dim": pca_dim, "rescore": True})]
+    for index_type, options in configs:
+        with tempfile.TemporaryDirectory() as output_dir:
+            exporter = FaissExporter(output_dir, index_type=index_type, pq_m=pq_m, **options)
+            for i in range(0, len(corpus), 1000):
+                batch = corpus[i:i + 1000]
+                exporter.add([Document(page_content=str(i + j), metadata={}) for j in range(len(batch))], batch)
+            meta = exporter.finalize()
+            store = FaissVectorStore.load(output_dir, embedding_function=None)
+            st = time.perf_counter()
+            found = [[int(doc.page_content) for doc in store.similarity_search_by_vector(query, k=k)] for query in queries]
+            ms = (time.perf_counter() - st) * 1000 / len(queries)
+            disk = os.path.getsize(os.path.join(output_dir, RESCORE_FILE)) if options.get("rescore") else 0
+        label = meta["index_type"] + (f" pca{meta['pca_dim']}" if meta.get("pca_dim") else "")
+        yield f"faiss {label}{' +rescore' if options.get('rescore') else ''}", recall(found, truth), meta["index_bytes"], disk, ms
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=4096)
+    parser.add_argument("--rank", type=int, default=256, help="dimensions of the synthetic signal")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--oversample", type=int, default=int(os.environ.get("VECTOR_RESCORE_OVERSAMPLE", "4")))
+    parser.add_argument("--pq-m", type=int, default=64)
+    parser.add_argument("--pca-dim", type=int, default=512)
+    parser.add_argument("--skip-faiss", action="store_true")
+    args = parser.parse_args()
+    os.environ["VECTOR_RESCORE_OVERSAMPLE"] = str(args.oversample)
+    import logging
+    logging.basicConfig(level=logging.WARNING)
+
+    corpus = synthetic_embeddings(args.docs, args.dim, args.rank, seed=2)
+    queries = synthetic_embeddings(args.queries, args.dim, args.rank, seed=3)
+    truth = exact_top_k(corpus, queries, args.k)
+    float32_mb = 1.1 * (4 * args.dim + 8 * HNSW_M) * args.docs / 2 ** 20
+    print(f"docs={args.docs} dim={args.dim} queries={args.queries} k={args.k} oversample={args.oversample}")
+    print(f"{'encoding':<34} {'recall@k':>8} {'memory MB':>10} {'vs float32':>10} {'disk MB':>8} {'ms/query':>9}")
+    runs = opensearch_runs(corpus, queries, truth, args.k, args.oversample)
+    for name, value, memory, disk, ms in runs:
+        print(f"{name:<34} {value:>8.3f} {memory / 2 ** 20:>10.1f} {memory / 2 ** 20 / float32_mb:>9.2f}x "
+              f"{disk / 2 ** 20:>8.1f} {ms:>9.2f}")
+    if not args.skip_faiss:
+        for name, value, memory, disk, ms in faiss_runs(corpus, queries, truth, args.k, args.pq_m, args.pca_dim):
+            print(f"{name:<34} {value:>8.3f} {memory / 2 ** 20:>10.1f} {memory / 2 ** 20 / float32_mb:>9.2f}x "
+                  f"{disk / 2 ** 20:>8.1f} {ms:>9.2f}")
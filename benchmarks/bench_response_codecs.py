@@ -0,0 +1,116 @@
+"""
+Client CPU spent decoding embedding responses, per batch size: the previous
+handler (json.loads of the decoded str into lists of floats), json / orjson
+followed by numpy, and the codecs of response_codecs.py (json, which uses
+orjson when installed, and npy).
+
+By default the bodies are decoded from memory. With --http they come from
+FakeSageMakerServer through a boto3 runtime client and the measurement is the
+CPU time of the calling thread per call (the server runs in other threads),
+so the botocore request and the read of the stream are included.
+
+python benchmarks/bench_response_codecs.py --dim 4096 --batch-sizes 1 2 4 8 16 32 64
+python benchmarks/bench_response_codecs.py --http
+"""
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "embedding"))
+
+import response_codecs  # noqa: E402
+from response_codecs import get_codec  # noqa: E402
+
+
+def previous_handler(body) -> list:
+    response_json = json.loads(body.read().decode("utf-8"))
+    return response_json["embedding"]
+
+
+def decoders():
+    yield "json.loads lists (before)", "application/json", previous_handler
+    yield "json.loads + numpy", "application/json", lambda body: np.asarray(previous_handler(body), dtype=np.float32)
+    if response_codecs.orjson is not None:
+        orjson = response_codecs.orjson
+        yield "orjson + numpy", "application/json", lambda body: np.asarray(orjson.loads(body.read())["embedding"],
+                                                                           dtype=np.float32)
+    yield "codec json", "application/json", get_codec("json").decode_embeddings
+    yield "codec npy", "application/x-npy", get_codec("npy").decode_embeddings
+
+
+def payloads(batch_size: int, dim: int):
+    vectors = np.random.default_rng(batch_size).standard_normal((batch_size, dim)).astype(np.float32) * 0.05
+    npy = io.BytesIO()
+    np.save(npy, vectors)
+    return {"application/json": json.dumps({"embedding": vectors.tolist()}).encode("utf-8"),
+            "application/x-npy": npy.getvalue()}
+
+
+def time_per_call(fn, min_seconds: float, clock=time.perf_counter) -> float:
+    calls, st, wall = 0, clock(), time.perf_counter()
+    while True:
+        fn()
+        calls += 1
+        if time.perf_counter() - wall >= min_seconds and calls >= 3:
+            return (clock() - st) / calls
+
+
+def in_memory(batch_size: int, dim: int, min_seconds: float):
+    bodies = payloads(batch_size, dim)
+    for name, accept, decode in decoders():
+        body = bodies[accept]
+        seconds = time_per_call(lambda: decode(io.BytesIO(body)), min_seconds)
+        yield name, len(body), seconds
+
+
+def over_http(batch_size: int, dim: int, min_seconds: float):
+    from fake_sagemaker import FakeSageMakerRuntime, FakeSageMakerServer
+    from fake_app import fake_aws_environment
+    import boto3
+    from botocore.config import Config
+    fake_aws_environment()
+    runtime = FakeSageMakerRuntime(embedding_dim=dim, latency_ms=0.0, per_item_latency_ms=0.0, jitter_ms=0.0)
+    # dense vectors like a real model returns, the hashed fake embeddings are mostly zeros
+    bodies = payloads(batch_size, dim)
+    runtime._respond = lambda payload, accept="application/json": {"Body": io.BytesIO(bodies[accept]),
+                                                                   "ContentType": accept}
+    request = json.dumps({"text_inputs": [f"text {i}" for i in range(batch_size)]}).encode("utf-8")
+    with FakeSageMakerServer(runtime) as server:
+        client = boto3.Session().client("sagemaker-runtime", endpoint_url=server.url,
+                                        config=Config(tcp_keepalive=True, retries={"total_max_attempts": 1}))
+
+        def _invoke(accept):
+            return client.invoke_endpoint(EndpointName="bench", Body=request, ContentType="application/json",
+                                          Accept=accept)
+
+        for name, accept, decode in decoders():
+            seconds = time_per_call(lambda: decode(_invoke(accept)["Body"]), min_seconds, clock=time.thread_time)
+            yield name, len(bodies[accept]), seconds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dim", type=int, default=4096)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64])
+    parser.add_argument("--min-seconds", type=float, default=0.3, help="minimum time spent per measurement")
+    parser.add_argument("--http", action="store_true", help="decode responses read from the fake endpoint over http")
+    args = parser.parse_args()
+    sys.path.insert(0, BENCHMARKS_DIR)
+
+    print(f"dim={args.dim} orjson={'yes' if response_codecs.orjson is not None else 'no'} "
+          f"source={'http' if args.http else 'memory'}")
+    print(f"{'batch':>5} {'decoder':<28} {'body KB':>8} {'ms/call':>9} {'MB/s':>8} {'speedup':>8}"
+          + ("   (client cpu, request included)" if args.http else ""))
+    for batch_size in args.batch_sizes:
+        run = over_http if args.http else in_memory
+        before = None
+        for name, size, seconds in run(batch_size, args.dim, args.min_seconds):
+            before = before or seconds
+            print(f"{batch_size:>5} {name:<28} {size / 1024:>8.0f} {seconds * 1000:>9.3f} "
+                  f"{size / 2 ** 20 / seconds:>8.0f} {before / seconds:>7.1f}x")
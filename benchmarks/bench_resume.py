@@ -0,0 +1,115 @@
+"""
+Restart of an interrupted ingestion job. The job runs on the bundled docs
+against fake sagemaker (with a fraction of the embedding calls failing with a
+ModelError, retried per batch of chunks) and an in-process fake opensearch:
+
+    full          one uninterrupted run, the reference
+    interrupted   a run with --checkpoint-dir killed (SIGKILL) once a given
+                  fraction of the pages is checkpointed
+    resumed       the same job restarted on that index with the checkpoint,
+                  finished pages are not split, planned or embedded again
+    no checkpoint the job restarted on a copy of the interrupted index without
+                  the checkpoint, the manifest of the index is all it has
+
+Every finished index must hold exactly the chunks of the full run.
+
+python benchmarks/bench_resume.py --max-pages 200 --kill-at 0.5 --error-rate 0.01
+"""
+import os
+import sys
+import copy
+import time
+import uuid
+import signal
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+DATA_DIR = os.path.join(REPO_DIR, "data", "sagemaker.readthedocs.io")
+sys.path.insert(0, BENCHMARKS_DIR)
+import fake_app
+
+
+def input_dir(max_pages: int, tmp_dir: str) -> str:
+    pages = sorted(Path(DATA_DIR).rglob("*.html"))
+    subset = os.path.join(tmp_dir, "pages")
+    os.makedirs(subset)
+    for p in pages[:max_pages] if max_pages > 0 else pages:
+        os.symlink(p, os.path.join(subset, str(p.relative_to(DATA_DIR)).replace(os.sep, "_")))
+    return subset
+
+
+def start(opensearch_url: str, index_name: str, pages_dir: str, output_file: str, checkpoint_dir: str,
+          args) -> subprocess.Popen:
+    return fake_app.start_ingestion_job(opensearch_url, index_name, pages_dir, output_file,
+                                        ["--unit-initial-backoff", "0.1", "--checkpoint-dir", checkpoint_dir],
+                                        dim=args.dim, embed_latency_ms=args.embed_latency_ms,
+                                        error_rate=args.error_rate, verbose=args.verbose)
+
+
+def checkpointed(checkpoint_dir: str) -> int:
+    return sum(sum(1 for _ in open(os.path.join(checkpoint_dir, name)))
+               for name in os.listdir(checkpoint_dir) if name.endswith(".jsonl")) if os.path.isdir(checkpoint_dir) else 0
+
+
+def run(opensearch_url: str, index_name: str, pages_dir: str, tmp_dir: str, checkpoint_dir: str, args) -> dict:
+    return fake_app.run_ingestion_job(opensearch_url, index_name, pages_dir, tmp_dir,
+                                      ["--unit-initial-backoff", "0.1", "--checkpoint-dir", checkpoint_dir],
+                                      dim=args.dim, embed_latency_ms=args.embed_latency_ms,
+                                      error_rate=args.error_rate, verbose=args.verbose)
+
+
+def report(name: str, job_metrics: dict, docs: int) -> None:
+    counters = {counter["name"]: counter["value"] for counter in job_metrics["metrics"]["counters"]}
+    indexed = next(stats["units"] for stats in job_metrics["stages"] if stats["stage"] == "index")
+    print(f"{name:<14} {job_metrics['wall_seconds']:>8.2f}s {indexed:>8} {job_metrics['embedding_calls']:>7} "
+          f"{job_metrics['embedding_errors']:>7} {int(counters.get('ingestion_sources_skipped_total', 0)):>8} "
+          f"{int(counters.get('ingestion_sources_failed_total', 0)):>7} {docs:>7}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-pages", type=int, default=200)
+    parser.add_argument("--kill-at", type=float, default=0.5, help="fraction of the pages checkpointed before the kill")
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--embed-latency-ms", type=float, default=20.0)
+    parser.add_argument("--error-rate", type=float, default=0.01, help="fraction of embedding calls failing")
+    parser.add_argument("--verbose", action="store_true", help="show the logs of the ingestion job")
+    args = parser.parse_args()
+
+    from fake_opensearch import FakeOpenSearch
+    with tempfile.TemporaryDirectory() as tmp, FakeOpenSearch(1.0, 0.0) as opensearch:
+        pages_dir = input_dir(args.max_pages, tmp)
+        pages = len(os.listdir(pages_dir))
+        state = opensearch.state
+        print(f"pages={pages} error_rate={args.error_rate} kill_at={args.kill_at}")
+        # indexed: chunks written by the run, chunks: chunks in the index after the run
+        print(f"{'run':<14} {'time':>9} {'indexed':>8} {'calls':>7} {'errors':>7} {'skipped':>8} "
+              f"{'failed':>7} {'chunks':>7}")
+
+        full = run(opensearch.url, "full", pages_dir, tmp, "", args)
+        report("full", full, len(state.docs("full")))
+
+        checkpoint_dir = os.path.join(tmp, "checkpoint")
+        st = time.perf_counter()
+        process = start(opensearch.url, "resume", pages_dir, os.path.join(tmp, "killed.json"), checkpoint_dir, args)
+        while process.poll() is None and checkpointed(checkpoint_dir) < pages * args.kill_at:
+            time.sleep(0.05)
+        process.send_signal(signal.SIGKILL)
+        process.wait()
+        print(f"{'interrupted':<14} {time.perf_counter() - st:>8.2f}s, {checkpointed(checkpoint_dir)} pages "
+              f"checkpointed, {len(state.docs('resume'))} chunks indexed")
+
+        # the same interrupted index, as a new index (new uuid) the checkpoint does not apply to it
+        state.indices["no-checkpoint"] = dict(copy.deepcopy(state.indices["resume"]), uuid=uuid.uuid4().hex)
+        resumed = run(opensearch.url, "resume", pages_dir, tmp, checkpoint_dir, args)
+        report("resumed", resumed, len(state.docs("resume")))
+        restarted = run(opensearch.url, "no-checkpoint", pages_dir, tmp, "", args)
+        report("no checkpoint", restarted, len(state.docs("no-checkpoint")))
+
+        expected = set(state.docs("full"))
+        for index_name in ("resume", "no-checkpoint"):
+            print(f"{index_name}: {'same chunks as the full run' if set(state.docs(index_name)) == expected else 'DIFFERENT CHUNKS'}")
@@ -0,0 +1,73 @@
+"""
+Per-call overhead of the SageMaker runtime client: a new boto3 client per call
+(what query_llm used to do) against the shared pooled client of
+sagemaker_runtime.py. Both invoke FakeSageMakerServer over real HTTP, with no
+model latency, so the time measured is client creation, signing, connection
+setup and the round trip itself.
+
+python benchmarks/bench_runtime_client.py --calls 200 --threads 1 8
+"""
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "lambda", "app"))
+
+BODY = b'{"text_inputs": "what is an estimator", "max_length": 50}'
+
+
+def new_client_per_call(endpoint_url: str):
+    import boto3
+
+    def _call():
+        client = boto3.client('runtime.sagemaker', endpoint_url=endpoint_url)
+        return client.invoke_endpoint(EndpointName="bench-llm", ContentType="application/json", Body=BODY)["Body"].read()
+    return _call
+
+
+def pooled_client():
+    from routers.api_v1.endpoints.sagemaker_runtime import get_sagemaker_runtime_client
+
+    def _call():
+        client = get_sagemaker_runtime_client()
+        return client.invoke_endpoint(EndpointName="bench-llm", ContentType="application/json", Body=BODY)["Body"].read()
+    return _call
+
+
+def measure(call, calls: int, threads: int):
+    def _timed(_):
+        st = time.perf_counter()
+        call()
+        return time.perf_counter() - st
+
+    call()  # warm up, loads the service model and the credentials
+    st = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        latencies = sorted(executor.map(_timed, range(calls)))
+    elapsed = time.perf_counter() - st
+    return calls / elapsed, latencies[len(latencies) // 2], latencies[int(0.99 * (len(latencies) - 1))]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 8])
+    args = parser.parse_args()
+
+    from fake_sagemaker import FakeSageMakerRuntime, FakeSageMakerServer
+    runtime = FakeSageMakerRuntime(latency_ms=0.0, per_item_latency_ms=0.0)
+    with FakeSageMakerServer(runtime) as server:
+        # before importing sagemaker_runtime, it reads the endpoint url at import time
+        os.environ["SAGEMAKER_RUNTIME_ENDPOINT_URL"] = server.url
+        os.environ.setdefault("AWS_DEFAULT_REGION", "ap-southeast-2")
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "fake")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "fake")
+        for label, call in (("new client per call", new_client_per_call(server.url)), ("pooled client", pooled_client())):
+            for threads in args.threads:
+                calls_per_second, p50, p99 = measure(call, args.calls, threads)
+                print(f"{label:<20} threads={threads:<3} calls/s={calls_per_second:8.1f} "
+                      f"p50_ms={p50 * 1000:7.2f} p99_ms={p99 * 1000:7.2f}")
@@ -0,0 +1,357 @@
+"""
+End to end benchmark of the ingestion job and the query API, fully offline:
+
+1. the OpenSearch stand-in (FakeOpenSearch) is started in its own process,
+2. embedding/opensearch_ingestion.py runs on the bundled
+   data/sagemaker.readthedocs.io pages with the fake SageMaker runtime and
+   FakeSSM patched in, into that stand-in,
+3. the FastAPI app of lambda/app/main.py is served by uvicorn against the same
+   index and FakeSageMakerServer, and /rag and /text2text are queried by
+   concurrent clients with questions drawn from the corpus.
+
+Reported: ingestion docs/sec and chunks/sec, query requests/sec and
+p50/p95/p99 latency, the mean Server-Timing of every stage, and the peak
+memory (max RSS) of the ingestion job and of the app. Every run is saved to
+benchmarks/results/<timestamp>-<label>.json, pass --baseline with an earlier
+file to compare and flag regressions above --tolerance.
+
+The fake models sleep for a latency drawn from a distribution, lognormal by
+default so the tail percentiles mean something.
+
+python benchmarks/bench_suite.py --label my-change --baseline benchmarks/results/<earlier run>.json
+"""
+import os
+import sys
+import json
+import time
+import runpy
+import random
+import socket
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+DATA_DIR = os.path.join(REPO_DIR, "data", "sagemaker.readthedocs.io")
+RESULTS_DIR = os.path.join(BENCHMARKS_DIR, "results")
+INDEX_NAME = "bench_suite"
+
+# (path in the results, True when a higher value is better)
+COMPARED_METRICS = [
+    (("ingestion", "docs_per_second"), True),
+    (("ingestion", "chunks_per_second"), True),
+    (("ingestion", "peak_rss_mb"), False),
+    (("app", "peak_rss_mb"), False),
+    (("query", "rag", "requests_per_second"), True),
+    (("query", "rag", "p50_ms"), False),
+    (("query", "rag", "p95_ms"), False),
+    (("query", "rag", "p99_ms"), False),
+    (("query", "text2text", "requests_per_second"), True),
+    (("query", "text2text", "p50_ms"), False),
+    (("query", "text2text", "p95_ms"), False),
+    (("query", "text2text", "p99_ms"), False),
+]
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def _process_peak_rss_mb(pid: int) -> Optional[float]:
+    # high water mark of a running process, linux only
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def _runtime(args):
+    from fake_sagemaker import FakeSageMakerRuntime
+    return FakeSageMakerRuntime(embedding_dim=args.dim,
+                                latency_ms=args.embed_latency_ms,
+                                per_item_latency_ms=args.per_item_latency_ms,
+                                text_latency_ms=args.llm_latency_ms,
+                                latency_distribution=args.latency_distribution,
+                                latency_sigma=args.latency_sigma)
+
+
+def serve_opensearch(port: int, args) -> None:
+    sys.path.insert(0, BENCHMARKS_DIR)
+    from fake_opensearch import FakeOpenSearch
+    with FakeOpenSearch(args.os_latency_ms, 0.0, port=port) as opensearch:
+        # until the parent terminates the process
+        opensearch.thread.join()
+
+
+def ingest(opensearch_url: str, input_dir: str, output_file: str, args) -> None:
+    sys.path.insert(0, BENCHMARKS_DIR)
+    sys.path.insert(0, os.path.join(REPO_DIR, "embedding"))
+    import fake_app
+    fake_app.fake_aws_environment()
+    # the sagemaker sdk does not import once boto3 is patched
+    import sagemaker  # noqa: F401
+    import fake_ssm
+    fake_ssm.install(fake_ssm.FakeSSM(latency_ms=0.0))
+    fake_app.patch_boto3_runtime(_runtime(args))
+    sys.argv = ["opensearch_ingestion.py",
+                "--opensearch-cluster-domain", opensearch_url,
+                "--opensearch-index-name", INDEX_NAME,
+                "--embeddings-model-endpoint-name", "fake-gpt-j-6b",
+                "--input-data-dir", input_dir,
+                "--process-count", str(args.process_count),
+                "--embeddings-max-in-flight", str(args.embeddings_max_in_flight),
+                "--metrics-output-file", output_file]
+    runpy.run_path(os.path.join(REPO_DIR, "embedding", "opensearch_ingestion.py"), run_name="__main__")
+    with open(output_file) as f:
+        job_metrics = json.load(f)
+    job_metrics["peak_rss_mb"] = _peak_rss_mb()
+    with open(output_file, "w") as f:
+        json.dump(job_metrics, f)
+
+
+def serve_app(opensearch_url: str, port: int, args) -> None:
+    sys.path.insert(0, BENCHMARKS_DIR)
+    import fake_app
+    fake_app.serve(fake_app.load_app(_runtime(args), opensearch_url, INDEX_NAME), port)
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait(port: int, timeout: float = 120.0) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"nothing listening on port {port}")
+
+
+def _child_args(args) -> List[str]:
+    # the settings the children need, passed on their command line
+    forwarded = []
+    for name in ("dim", "embed_latency_ms", "per_item_latency_ms", "llm_latency_ms", "latency_distribution",
+                 "latency_sigma", "os_latency_ms", "process_count", "embeddings_max_in_flight"):
+        forwarded += [f"--{name.replace('_', '-')}", str(getattr(args, name))]
+    return forwarded
+
+
+def _child(mode: str, *extra: str, args) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, __file__, f"--{mode}", *extra, *_child_args(args)])
+
+
+def _input_dir(max_pages: int, tmp_dir: str) -> str:
+    # the html pages (the mirror also has css, js and fonts), linked into a temporary directory
+    pages = sorted(Path(DATA_DIR).rglob("*.html"))
+    subset = os.path.join(tmp_dir, "pages")
+    os.makedirs(subset)
+    for p in pages[:max_pages] if max_pages > 0 else pages:
+        os.symlink(p, os.path.join(subset, str(p.relative_to(DATA_DIR)).replace(os.sep, "_")))
+    return subset
+
+
+def _queries(input_dir: str, n: int) -> List[str]:
+    sys.path.insert(0, BENCHMARKS_DIR)
+    sys.path.insert(0, os.path.join(REPO_DIR, "embedding"))
+    from bench_hybrid_retrieval import load_chunks, make_queries
+    queries = make_queries(load_chunks(input_dir, 10 ** 6), n)
+    random.Random(0).shuffle(queries)
+    return queries
+
+
+def _percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def _server_timing(header: str) -> Dict[str, float]:
+    stages = {}
+    for part in header.split(","):
+        name, _, duration = part.strip().partition(";dur=")
+        if duration:
+            stages[name] = float(duration)
+    return stages
+
+
+def load(url: str, queries: List[str], clients: int, warmup: int) -> Dict[str, Any]:
+    import requests
+    local = threading.local()
+
+    def _one(query: str):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        st = time.perf_counter()
+        response = local.session.post(url, json={"query": query, "use_cache": False})
+        elapsed = time.perf_counter() - st
+        response.raise_for_status()
+        return elapsed, _server_timing(response.headers.get("server-timing", ""))
+
+    for query in queries[:warmup]:
+        _one(query)
+    st = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        results = list(executor.map(_one, queries))
+    elapsed = time.perf_counter() - st
+    latencies = [latency * 1000 for latency, _ in results]
+    stage_totals: Dict[str, float] = {}
+    for _, stages in results:
+        for name, duration in stages.items():
+            stage_totals[name] = stage_totals.get(name, 0.0) + duration
+    return {"requests": len(results),
+            "requests_per_second": round(len(results) / elapsed, 2),
+            "p50_ms": round(_percentile(latencies, 0.50), 1),
+            "p95_ms": round(_percentile(latencies, 0.95), 1),
+            "p99_ms": round(_percentile(latencies, 0.99), 1),
+            "server_timing_mean_ms": {name: round(total / len(results), 2) for name, total in stage_totals.items()}}
+
+
+def _git_revision() -> str:
+    result = subprocess.run(["git", "-C", REPO_DIR, "rev-parse", "--short", "HEAD"], capture_output=True, text=True)
+    return result.stdout.strip() or "unknown"
+
+
+def run(args) -> Dict[str, Any]:
+    result: Dict[str, Any] = {"label": args.label, "git_revision": _git_revision(),
+                              "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                              "parameters": {k: v for k, v in vars(args).items()
+                                             if k not in ("serve_opensearch", "ingest", "serve_app", "baseline")}}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_dir = _input_dir(args.max_pages, tmp_dir)
+        opensearch_port = _free_port()
+        opensearch = _child("serve-opensearch", str(opensearch_port), args=args)
+        try:
+            _wait(opensearch_port)
+            opensearch_url = f"http://127.0.0.1:{opensearch_port}"
+
+            ingest_file = os.path.join(tmp_dir, "ingest.json")
+            subprocess.run([sys.executable, __file__, "--ingest", opensearch_url, input_dir, ingest_file,
+                            *_child_args(args)], check=True)
+            with open(ingest_file) as f:
+                job = json.load(f)
+            stages = {stats["stage"]: stats for stats in job["stages"]}
+            result["ingestion"] = {"docs": stages["load"]["units"],
+                                   "chunks": stages["index"]["units"],
+                                   "seconds": job["run_seconds"],
+                                   "docs_per_second": round(stages["load"]["units"] / job["run_seconds"], 2),
+                                   "chunks_per_second": round(stages["index"]["units"] / job["run_seconds"], 2),
+                                   "peak_rss_mb": job["peak_rss_mb"],
+                                   "stages": job["stages"]}
+            print(f"ingestion: {result['ingestion']['docs']} docs, {result['ingestion']['chunks']} chunks "
+                  f"in {job['run_seconds']}s, {result['ingestion']['docs_per_second']} docs/s, "
+                  f"peak rss {job['peak_rss_mb']} MB")
+
+            app_port = _free_port()
+            app = _child("serve-app", opensearch_url, str(app_port), args=args)
+            try:
+                _wait(app_port)
+                queries = _queries(input_dir, args.queries)
+                result["query"] = {}
+                for endpoint in args.endpoints:
+                    stats = load(f"http://127.0.0.1:{app_port}/api/v1/llm/{endpoint}", queries, args.clients,
+                                 args.warmup)
+                    result["query"][endpoint] = stats
+                    print(f"{endpoint:<9} clients={args.clients} req/s={stats['requests_per_second']:7.2f} "
+                          f"p50_ms={stats['p50_ms']:8.1f} p95_ms={stats['p95_ms']:8.1f} p99_ms={stats['p99_ms']:8.1f} "
+                          f"stages={stats['server_timing_mean_ms']}")
+                result["app"] = {"peak_rss_mb": _process_peak_rss_mb(app.pid)}
+                print(f"app peak rss {result['app']['peak_rss_mb']} MB")
+            finally:
+                app.terminate()
+                app.wait()
+        finally:
+            opensearch.terminate()
+            opensearch.wait()
+    return result
+
+
+def _get(result: Dict, path) -> Optional[float]:
+    for key in path:
+        if not isinstance(result, dict) or key not in result:
+            return None
+        result = result[key]
+    return result
+
+
+def compare(baseline: Dict, current: Dict, tolerance: float) -> int:
+    """Prints the change of every metric, returns the number of regressions above the tolerance."""
+    regressions = 0
+    print(f"\ncompared with {baseline['label']} ({baseline['git_revision']}, {baseline['timestamp']})")
+    ignored = ("label", "queries", "warmup", "tolerance")
+    changed = {name: (value, current["parameters"].get(name)) for name, value in baseline.get("parameters", {}).items()
+               if name not in ignored and current["parameters"].get(name) != value}
+    if changed:
+        print(f"warning, the runs used different parameters (baseline, current): {changed}")
+    for path, higher_is_better in COMPARED_METRICS:
+        before, after = _get(baseline, path), _get(current, path)
+        if before is None or after is None or before == 0:
+            continue
+        change = (after - before) / before
+        regressed = (change < -tolerance) if higher_is_better else (change > tolerance)
+        regressions += regressed
+        print(f"{'.'.join(path):<38} {before:>10} -> {after:>10} {change * 100:+7.1f}%{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    # internal, the child processes
+    parser.add_argument("--serve-opensearch", type=int, default=None)
+    parser.add_argument("--ingest", type=str, nargs=3, default=None)
+    parser.add_argument("--serve-app", type=str, nargs=2, default=None)
+
+    parser.add_argument("--label", type=str, default="run")
+    parser.add_argument("--max-pages", type=int, default=0, help="0 ingests every page")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--embed-latency-ms", type=float, default=30.0)
+    parser.add_argument("--per-item-latency-ms", type=float, default=1.0)
+    parser.add_argument("--llm-latency-ms", type=float, default=300.0)
+    parser.add_argument("--latency-distribution", type=str, default="lognormal", choices=["uniform", "lognormal"])
+    parser.add_argument("--latency-sigma", type=float, default=0.4)
+    parser.add_argument("--os-latency-ms", type=float, default=5.0)
+    parser.add_argument("--process-count", type=int, default=2)
+    parser.add_argument("--embeddings-max-in-flight", type=int, default=4)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--endpoints", type=str, nargs="+", default=["rag", "text2text"])
+    parser.add_argument("--baseline", type=str, default=None)
+    parser.add_argument("--tolerance", type=float, default=0.1, help="relative change flagged as a regression")
+    args = parser.parse_args()
+
+    if args.serve_opensearch is not None:
+        serve_opensearch(args.serve_opensearch, args)
+        sys.exit(0)
+    if args.ingest:
+        ingest(*args.ingest, args)
+        sys.exit(0)
+    if args.serve_app:
+        opensearch_url, port = args.serve_app
+        serve_app(opensearch_url, int(port), args)
+        sys.exit(0)
+
+    result = run(args)
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{args.label}.json")
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"results saved to {path}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(json.load(f), result, args.tolerance)
+        sys.exit(1 if regressions else 0)
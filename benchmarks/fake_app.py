@@ -0,0 +1,148 @@
+"""
+The FastAPI app of lambda/app wired to the stand-ins: SageMaker calls go to a
+FakeSageMakerRuntime (through boto3 and over HTTP with FakeSageMakerServer),
+the configuration comes from FakeSSM and the vector db is an OpenSearch
+stand-in reached over plain http.
+
+run_ingestion_job does the same for the ingestion job, it runs
+embedding/opensearch_ingestion.py in a new process against the stand-ins.
+"""
+import os
+import sys
+import json
+import time
+import runpy
+import subprocess
+from typing import Sequence
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+
+def fake_aws_environment() -> None:
+    os.environ.setdefault("AWS_DEFAULT_REGION", "ap-southeast-2")
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "fake")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "fake")
+
+
+def patch_boto3_runtime(runtime) -> None:
+    """Make boto3.client('runtime.sagemaker') and Session.client('sagemaker-runtime') return the fake."""
+    import boto3
+    client, session_client = boto3.client, boto3.Session.client
+    runtime_names = ("runtime.sagemaker", "sagemaker-runtime")
+    boto3.client = lambda name, *a, **k: runtime if name in runtime_names else client(name, *a, **k)
+    boto3.Session.client = lambda self, name, *a, **k: runtime if name in runtime_names else session_client(self, name, *a, **k)
+
+
+def index_synthetic_corpus(opensearch_url: str, index_name: str, dim: int, docs: int = 500) -> None:
+    """Small generated corpus, for when the content of the documents does not matter."""
+    sys.path.insert(0, os.path.join(REPO_DIR, "embedding"))
+    from opensearchpy.helpers import bulk
+    from opensearch_ingestion import create_opensearch_client, create_knn_index
+    from fake_sagemaker import fake_embedding
+    client = create_opensearch_client(opensearch_url, None)
+    create_knn_index(client, index_name, dim)
+    texts = [f"sagemaker document {i} about estimators, endpoints and training job {i % 13}" for i in range(docs)]
+    bulk(client, ({"_index": index_name, "_id": str(i), "vector_field": fake_embedding(text, dim), "text": text,
+                   "metadata": {"source": f"page_{i}.html"}} for i, text in enumerate(texts)))
+    client.indices.refresh(index=index_name)
+
+
+def load_app(runtime, opensearch_url: str, index_name: str, app_dir: str = None, answer_cache: bool = False):
+    """
+    Imports `main` from app_dir (lambda/app by default) and returns its app.
+    Call before anything else imports the app modules, they read their
+    settings at import time.
+    """
+    sys.path.insert(0, BENCHMARKS_DIR)
+    import fake_ssm
+    from fake_sagemaker import FakeSageMakerServer
+
+    sagemaker_server = FakeSageMakerServer(runtime).__enter__()
+    parameters = dict(fake_ssm.DEFAULT_PARAMETERS, OPENSEARCH_DOMAIN_ENDPOINT=opensearch_url, OPENSEARCH_INDEX=index_name)
+    fake_ssm.install(fake_ssm.FakeSSM(parameters, latency_ms=0.0))
+    os.environ["SAGEMAKER_RUNTIME_ENDPOINT_URL"] = sagemaker_server.url
+    os.environ["ANSWER_CACHE_ENABLED"] = "true" if answer_cache else "false"
+    fake_aws_environment()
+    patch_boto3_runtime(runtime)
+
+    sys.path.insert(0, app_dir or os.path.join(REPO_DIR, "lambda", "app"))
+    import main
+    from routers.api_v1.endpoints import initialise
+    vector_search = initialise.OpenSearchVectorSearch
+
+    def _plain_http(**kwargs):
+        # the stand-in speaks plain http without auth
+        kwargs.update(use_ssl=False, verify_certs=False, http_auth=None)
+        return vector_search(**kwargs)
+
+    initialise.OpenSearchVectorSearch = _plain_http
+    return main.app
+
+
+def serve(app, port: int) -> None:
+    import logging
+    import uvicorn
+    logging.getLogger().setLevel(logging.WARNING)
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def start_ingestion_job(opensearch_url: str, index_name: str, input_dir: str, output_file: str,
+                        extra_args: Sequence[str] = (), dim: int = 256, embed_latency_ms: float = 20.0,
+                        error_rate: float = 0.0, process_count: int = 2, verbose: bool = False) -> subprocess.Popen:
+    """
+    Starts embedding/opensearch_ingestion.py in a new process with FakeSSM and
+    a FakeSageMakerRuntime patched in. Its metrics file, with the embedding
+    calls and errors of the fake added, is written to output_file.
+    """
+    job = {"argv": ["--opensearch-cluster-domain", opensearch_url,
+                    "--opensearch-index-name", index_name,
+                    "--embeddings-model-endpoint-name", "fake-gpt-j-6b",
+                    "--input-data-dir", input_dir,
+                    "--process-count", str(process_count),
+                    "--parse-workers", "1",
+                    "--metrics-output-file", output_file] + list(extra_args),
+           "output_file": output_file, "dim": dim, "embed_latency_ms": embed_latency_ms, "error_rate": error_rate}
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), "--ingestion-job", json.dumps(job)],
+                            stderr=None if verbose else subprocess.DEVNULL)
+
+
+def run_ingestion_job(opensearch_url: str, index_name: str, input_dir: str, tmp_dir: str,
+                      extra_args: Sequence[str] = (), **kwargs) -> dict:
+    """start_ingestion_job and wait for it, returns its metrics with the wall time in wall_seconds."""
+    output_file = os.path.join(tmp_dir, f"{index_name}-{time.time()}.json")
+    st = time.perf_counter()
+    if start_ingestion_job(opensearch_url, index_name, input_dir, output_file, extra_args, **kwargs).wait() != 0:
+        raise RuntimeError(f"ingestion of index={index_name} failed")
+    with open(output_file) as f:
+        job_metrics = json.load(f)
+    job_metrics["wall_seconds"] = time.perf_counter() - st
+    return job_metrics
+
+
+def _ingestion_job(job: dict) -> None:
+    sys.path.insert(0, BENCHMARKS_DIR)
+    sys.path.insert(0, os.path.join(REPO_DIR, "embedding"))
+    fake_aws_environment()
+    # the sagemaker sdk does not import once boto3 is patched
+    import sagemaker  # noqa: F401
+    import fake_ssm
+    from fake_sagemaker import FakeSageMakerRuntime
+    fake_ssm.install(fake_ssm.FakeSSM(latency_ms=0.0))
+    runtime = FakeSageMakerRuntime(embedding_dim=job["dim"], latency_ms=job["embed_latency_ms"],
+                                   per_item_latency_ms=0.0, error_rate=job["error_rate"])
+    patch_boto3_runtime(runtime)
+    sys.argv = ["opensearch_ingestion.py"] + job["argv"]
+    runpy.run_path(os.path.join(REPO_DIR, "embedding", "opensearch_ingestion.py"), run_name="__main__")
+    with open(job["output_file"]) as f:
+        job_metrics = json.load(f)
+    job_metrics["embedding_calls"] = runtime.calls
+    job_metrics["embedding_errors"] = runtime.errors
+    with open(job["output_file"], "w") as f:
+        json.dump(job_metrics, f)
+
+
+if __name__ == "__main__":
+    # the process started by start_ingestion_job
+    if sys.argv[1:2] == ["--ingestion-job"]:
+        _ingestion_job(json.loads(sys.argv[2]))
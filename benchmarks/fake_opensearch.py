@@ -0,0 +1,373 @@
+"""
+Local stand-in for an OpenSearch domain, served over HTTP/1.1 keep-alive so
+the real opensearch-py client (and its connection pool) can be used against it.
+
+Supported: index exists/create/get/refresh/settings, aliases (a name resolves to
+the first index of its alias), _bulk (index and delete), _search with match_all,
+a k-NN query (exact scan) or a match query (BM25), scroll, and _msearch.
+Force merges and k-NN warmups are acknowledged and do nothing.
+Documents are kept in memory. Every request sleeps for a configurable latency
+plus a per document cost for _bulk.
+"""
+import re
+import json
+import math
+import time
+import uuid
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+# like the standard analyzer, dotted and snake_case names stay one token
+_TOKEN = re.compile(r"\w+(?:\.\w+)*")
+
+
+def _l2_score(a: List[float], b: List[float]) -> float:
+    # the score OpenSearch reports for the l2 space
+    return 1.0 / (1.0 + sum((x - y) ** 2 for x, y in zip(a, b)))
+
+
+class FakeOpenSearchState:
+    def __init__(self, request_latency_ms: float = 2.0, per_doc_latency_ms: float = 0.05):
+        self.request_latency_ms = request_latency_ms
+        self.per_doc_latency_ms = per_doc_latency_ms
+        self.indices: Dict[str, Dict] = {}
+        self.aliases: Dict[str, List[str]] = {}
+        self.requests = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+        # vectors matrix and postings built on the first query after a write
+        self._search_cache: Dict[Tuple[str, str, str], object] = {}
+
+    def resolve(self, name: Optional[str]) -> Optional[str]:
+        indices = self.aliases.get(name)
+        return indices[0] if indices else name
+
+    def docs(self, index: str) -> Dict[str, Dict]:
+        return self.indices.setdefault(index, {"mapping": {}, "docs": {}})["docs"]
+
+    def invalidate(self, index: str) -> None:
+        with self.lock:
+            for key in [key for key in self._search_cache if key[0] == index]:
+                del self._search_cache[key]
+
+    def _cached(self, kind: str, index: str, field: str, build):
+        key = (index, field, kind)
+        with self.lock:
+            if key not in self._search_cache:
+                self._search_cache[key] = build()
+            return self._search_cache[key]
+
+    def knn(self, index: str, field: str, vector: List[float], k: int) -> List[Tuple[float, str, Dict]]:
+        try:
+            import numpy as np
+        except ImportError:
+            np = None
+        items = list(self.docs(index).items())
+        if not items:
+            return []
+        if np is not None:
+            def _matrix():
+                matrix = np.asarray([doc[field] for _, doc in items], dtype=np.float32)
+                return items, matrix, (matrix ** 2).sum(axis=1)
+
+            items, matrix, squared_norms = self._cached("knn", index, field, _matrix)
+            query = np.asarray(vector, dtype=np.float32)
+            distances = np.maximum(squared_norms - 2 * (matrix @ query) + (query ** 2).sum(), 0.0)
+            order = np.argsort(distances)[:k]
+            return [(float(1.0 / (1.0 + distances[i])), items[i][0], items[i][1]) for i in order]
+        scored = sorted(((_l2_score(doc[field], vector), _id, doc) for _id, doc in items), key=lambda x: -x[0])
+        return scored[:k]
+
+    def match(self, index: str, field: str, query: str, k: int) -> List[Tuple[float, str, Dict]]:
+        # BM25 (k1=1.2, b=0.75) over postings built on the first query after a write
+        terms = set(_TOKEN.findall(query.lower()))
+        docs = self.docs(index)
+
+        def _postings():
+            postings: Dict[str, Dict[str, int]] = {}
+            lengths = {}
+            for _id, doc in docs.items():
+                tokens = _TOKEN.findall(str(doc.get(field, "")).lower())
+                lengths[_id] = len(tokens)
+                for token in tokens:
+                    counts = postings.setdefault(token, {})
+                    counts[_id] = counts.get(_id, 0) + 1
+            return postings, lengths, sum(lengths.values()) / (len(lengths) or 1)
+
+        postings, lengths, average_length = self._cached("match", index, field, _postings)
+        n = len(lengths)
+        scores: Dict[str, float] = {}
+        for term in terms:
+            matches = postings.get(term, {})
+            idf = math.log(1 + (n - len(matches) + 0.5) / (len(matches) + 0.5))
+            for _id, tf in matches.items():
+                norm = tf + 1.2 * (0.25 + 0.75 * lengths[_id] / (average_length or 1))
+                scores[_id] = scores.get(_id, 0.0) + idf * tf * 2.2 / norm
+        scored = [(score, _id, docs[_id]) for _id, score in scores.items() if _id in docs]
+        scored.sort(key=lambda x: -x[0])
+        return scored[:k]
+
+
+def _flat_settings(settings: Dict, prefix: str = "") -> Dict:
+    flat = {}
+    for key, value in settings.items():
+        if isinstance(value, dict):
+            flat.update(_flat_settings(value, f"{prefix}{key}."))
+        else:
+            flat[f"{prefix}{key}"] = value if isinstance(value, str) or value is None else json.dumps(value)
+    return flat
+
+
+def _source(doc: Dict, includes: Optional[List[str]]) -> Dict:
+    if not includes:
+        return doc
+    out: Dict = {}
+    for path in includes:
+        value, target, parts = doc, out, path.split(".")
+        for part in parts[:-1]:
+            value = value.get(part, {}) if isinstance(value, dict) else {}
+            target = target.setdefault(part, {})
+        if isinstance(value, dict) and parts[-1] in value:
+            target[parts[-1]] = value[parts[-1]]
+    return out
+
+
+class FakeOpenSearchHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, without this every response waits for a delayed ack
+    disable_nagle_algorithm = True
+    state: FakeOpenSearchState = None
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        with self.state.lock:
+            self.state.connections += 1
+
+    def _body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _send(self, status: int, payload: Optional[Dict] = None) -> None:
+        body = json.dumps(payload).encode("utf-8") if payload is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body and self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _sleep(self, docs: int = 0) -> None:
+        with self.state.lock:
+            self.state.requests += 1
+        time.sleep((self.state.request_latency_ms + self.state.per_doc_latency_ms * docs) / 1000)
+
+    def do_HEAD(self):
+        self._sleep()
+        index = self.path.strip("/").split("?")[0]
+        if index.startswith("_alias/"):
+            return self._send(200 if index[len("_alias/"):] in self.state.aliases else 404)
+        self._send(200 if index in self.state.indices or index in self.state.aliases else 404)
+
+    def do_DELETE(self):
+        # e.g. the scroll ids, read so the next request on the connection starts at its beginning
+        self._body()
+        self._sleep()
+        path = self.path.split("?")[0].strip("/")
+        if path.startswith("_search/scroll"):
+            self._send(200, {"succeeded": True})
+        else:
+            self._delete_index(path)
+            self._send(200, {"acknowledged": True})
+
+    def _delete_index(self, index: str) -> None:
+        with self.state.lock:
+            self.state.indices.pop(index, None)
+            for alias, indices in list(self.state.aliases.items()):
+                if index in indices:
+                    indices.remove(index)
+                if not indices:
+                    del self.state.aliases[alias]
+
+    def do_PUT(self):
+        self.do_POST()
+
+    def do_GET(self):
+        self.do_POST()
+
+    def do_POST(self):
+        path, _, _query = self.path.partition("?")
+        parts = [p for p in path.split("/") if p]
+        body = self._body()
+        if parts and not parts[0].startswith("_"):
+            parts[0] = self.state.resolve(parts[0])
+        if parts[:1] == ["_alias"] and len(parts) == 2:
+            self._sleep()
+            indices = self.state.aliases.get(parts[1])
+            if not indices:
+                return self._send(404, {"error": f"alias [{parts[1]}] missing", "status": 404})
+            return self._send(200, {index: {"aliases": {parts[1]: {}}} for index in indices})
+        if parts == ["_aliases"]:
+            self._sleep()
+            return self._send(*self._update_aliases(json.loads(body)["actions"]))
+        if parts[:3] == ["_plugins", "_knn", "warmup"]:
+            self._sleep()
+            return self._send(200, {"_shards": {"total": 1, "successful": 1, "failed": 0}})
+        if len(parts) == 2 and parts[1] == "_settings":
+            self._sleep()
+            if parts[0] not in self.state.indices:
+                return self._send(404, {"error": {"type": "index_not_found_exception"}, "status": 404})
+            settings = self.state.indices[parts[0]].setdefault("settings", {})
+            if self.command == "PUT":
+                for key, value in _flat_settings(json.loads(body)).items():
+                    key = key if key.startswith("index.") else f"index.{key}"
+                    if value is None:
+                        settings.pop(key, None)
+                    else:
+                        settings[key] = value
+                return self._send(200, {"acknowledged": True})
+            return self._send(200, {parts[0]: {"settings": dict(settings)}})
+        if parts and parts[-1] == "_bulk":
+            return self._bulk(body, parts[0] if len(parts) > 1 else None)
+        if parts and parts[-1] == "_msearch":
+            return self._msearch(body, parts[0] if len(parts) > 1 else None)
+        if parts[:2] == ["_search", "scroll"]:
+            self._sleep()
+            return self._send(200, {"_scroll_id": "done", "hits": {"hits": []}})
+        if len(parts) == 2 and parts[1] == "_search":
+            self._sleep()
+            return self._send(200, self._search(self.state.resolve(parts[0]), json.loads(body or b"{}"),
+                                                scroll="scroll=" in _query))
+        if len(parts) == 2 and parts[1] == "_mapping":
+            self._sleep()
+            # keyed by the concrete index, also for an alias
+            index = self.state.resolve(parts[0])
+            if index not in self.state.indices:
+                return self._send(404, {"error": {"type": "index_not_found_exception"}, "status": 404})
+            mapping = self.state.indices[index]["mapping"]
+            return self._send(200, {index: {"mappings": mapping.get("mappings", {})}})
+        if len(parts) == 2 and parts[1] in ("_refresh", "_forcemerge"):
+            self._sleep()
+            return self._send(200, {"acknowledged": True})
+        if len(parts) == 1 and self.command == "PUT":
+            self._sleep()
+            if parts[0] in self.state.indices:
+                return self._send(400, {"error": {"type": "resource_already_exists_exception"}, "status": 400})
+            mapping = json.loads(body or b"{}")
+            self.state.indices[parts[0]] = {"mapping": mapping, "docs": {}, "uuid": uuid.uuid4().hex,
+                                            "settings": _flat_settings(mapping.get("settings", {}))}
+            return self._send(200, {"acknowledged": True, "index": parts[0]})
+        if len(parts) == 1 and self.command == "GET" and not parts[0].startswith("_"):
+            self._sleep()
+            if parts[0] not in self.state.indices:
+                return self._send(404, {"error": {"type": "index_not_found_exception"}, "status": 404})
+            index = self.state.indices[parts[0]]
+            settings = dict(index["mapping"].get("settings", {}).get("index", {}), uuid=index.get("uuid", parts[0]))
+            aliases = {alias: {} for alias, indices in self.state.aliases.items() if parts[0] in indices}
+            return self._send(200, {parts[0]: {"aliases": aliases, "mappings": index["mapping"].get("mappings", {}),
+                                               "settings": {"index": settings}}})
+        self._sleep()
+        self._send(200, {"name": "fake-opensearch", "version": {"number": "2.5.0", "distribution": "opensearch"}})
+
+    def _update_aliases(self, actions: List[Dict]) -> Tuple[int, Dict]:
+        # all the actions or none, like the real _aliases
+        with self.state.lock:
+            aliases = {alias: list(indices) for alias, indices in self.state.aliases.items()}
+            removed = []
+            for action in actions:
+                op, spec = next(iter(action.items()))
+                if op == "add":
+                    if spec["alias"] in self.state.indices and spec["alias"] not in removed:
+                        return 400, {"error": {"type": "invalid_alias_name_exception"}, "status": 400}
+                    aliases.setdefault(spec["alias"], []).append(spec["index"])
+                elif op == "remove":
+                    aliases[spec["alias"]].remove(spec["index"])
+                elif op == "remove_index":
+                    removed.append(spec["index"])
+            for index in removed:
+                self.state.indices.pop(index, None)
+                for indices in aliases.values():
+                    if index in indices:
+                        indices.remove(index)
+            self.state.aliases = {alias: indices for alias, indices in aliases.items() if indices}
+        return 200, {"acknowledged": True}
+
+    def _bulk(self, body: bytes, default_index: Optional[str]) -> None:
+        lines = [line for line in body.split(b"\n") if line.strip()]
+        items, i = [], 0
+        while i < len(lines):
+            action = json.loads(lines[i])
+            op, meta = next(iter(action.items()))
+            index = self.state.resolve(meta.get("_index", default_index))
+            docs = self.state.docs(index)
+            self.state.invalidate(index)
+            if op == "delete":
+                found = docs.pop(meta["_id"], None) is not None
+                items.append({op: {"_id": meta["_id"], "status": 200 if found else 404}})
+                i += 1
+                continue
+            doc = json.loads(lines[i + 1])
+            docs[meta.get("_id") or str(len(docs))] = doc
+            items.append({op: {"_id": meta.get("_id"), "status": 201}})
+            i += 2
+        self._sleep(len(items))
+        self._send(200, {"took": 1, "errors": any(item[next(iter(item))]["status"] >= 300 for item in items),
+                         "items": items})
+
+    def _search(self, index: str, body: Dict, scroll: bool = False) -> Dict:
+        size = body.get("size", 10)
+        query = body.get("query", {"match_all": {}})
+        if "knn" in query:
+            field, spec = next(iter(query["knn"].items()))
+            scored = self.state.knn(index, field, spec["vector"], max(size, spec.get("k", size)))
+        elif "match" in query:
+            field, spec = next(iter(query["match"].items()))
+            text = spec["query"] if isinstance(spec, dict) else spec
+            scored = self.state.match(index, field, text, size)
+        else:
+            scored = [(1.0, _id, doc) for _id, doc in self.state.docs(index).items()]
+            if not scroll:
+                scored = scored[:size]
+        includes = body.get("_source") if isinstance(body.get("_source"), list) else None
+        hits = [{"_index": index, "_id": _id, "_score": score, "_source": _source(doc, includes)}
+                for score, _id, doc in scored[:size if not scroll else None]]
+        response = {"took": 1, "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+                    "hits": {"total": {"value": len(hits)}, "hits": hits}}
+        if scroll:
+            response["_scroll_id"] = "done"
+        return response
+
+    def _msearch(self, body: bytes, default_index: Optional[str]) -> None:
+        lines = [line for line in body.split(b"\n") if line.strip()]
+        responses = []
+        for header, query in zip(lines[0::2], lines[1::2]):
+            index = self.state.resolve(json.loads(header).get("index", default_index))
+            responses.append(self._search(index, json.loads(query)))
+        self._sleep()
+        self._send(200, {"took": 1, "responses": responses})
+
+
+class FakeOpenSearch:
+    """Runs the stand-in on a background thread, use as a context manager."""
+
+    def __init__(self, request_latency_ms: float = 2.0, per_doc_latency_ms: float = 0.05, port: int = 0):
+        self.state = FakeOpenSearchState(request_latency_ms, per_doc_latency_ms)
+        handler = type("Handler", (FakeOpenSearchHandler,), {"state": self.state})
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self) -> "FakeOpenSearch":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,223 @@
+"""
+In-process stand-in for the boto3 `sagemaker-runtime` client so the embedding
+and text generation code paths can be exercised without live endpoints.
+
+The embedding model is a deterministic hashed bag-of-words, similar texts get
+similar vectors, and every call sleeps for a configurable latency. An optional
+capacity makes the fake throttle like a real endpoint when too many requests
+are in flight.
+"""
+import io
+import json
+import time
+import random
+import hashlib
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+
+class FakeThrottlingException(Exception):
+    """Looks like the botocore ClientError raised by a throttled endpoint."""
+
+    def __init__(self):
+        self.response = {"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}}
+        super().__init__("An error occurred (ThrottlingException) when calling the InvokeEndpoint operation: Rate exceeded")
+
+
+class FakeModelError(Exception):
+    """Looks like the botocore ClientError raised when the model container fails a request."""
+
+    def __init__(self):
+        self.response = {"Error": {"Code": "ModelError", "Message": "Received server error (500) from primary"}}
+        super().__init__("An error occurred (ModelError) when calling the InvokeEndpoint operation: "
+                         "Received server error (500) from primary")
+
+
+def fake_embedding(text: str, dim: int = 4096) -> List[float]:
+    """Hashed bag-of-words embedding, L2 normalised."""
+    vector = [0.0] * dim
+    for token in text.lower().split():
+        digest = hashlib.md5(token.encode("utf-8")).digest()
+        index = int.from_bytes(digest[:4], "little") % dim
+        vector[index] += 1.0 if digest[4] & 1 else -1.0
+    norm = sum(v * v for v in vector) ** 0.5 or 1.0
+    return [v / norm for v in vector]
+
+
+class FakeSageMakerRuntime:
+    """
+    Args:
+        embedding_dim: dimension of the vectors returned for `text_inputs` lists.
+        latency_ms: fixed latency of every call, the median with a lognormal distribution.
+        per_item_latency_ms: extra latency per text in a batch.
+        jitter_ms: uniform random latency added on top.
+        text_latency_ms: latency of the text generation calls, latency_ms when None.
+        latency_distribution: "uniform" (latency_ms plus the jitter) or "lognormal"
+            (latency_ms times a lognormal factor of shape latency_sigma, a long tail).
+        capacity: number of concurrent requests the endpoint accepts before
+            throttling, None means unlimited.
+        token_latency_ms: time between two tokens of a response stream.
+        supports_streaming: False makes InvokeEndpointWithResponseStream fail
+            like a container without streaming support.
+        error_rate: fraction of the calls failing with a ModelError.
+    """
+
+    def __init__(self,
+                 embedding_dim: int = 4096,
+                 latency_ms: float = 50.0,
+                 per_item_latency_ms: float = 2.0,
+                 jitter_ms: float = 0.0,
+                 capacity: int = None,
+                 token_latency_ms: float = 20.0,
+                 supports_streaming: bool = True,
+                 text_latency_ms: Optional[float] = None,
+                 latency_distribution: str = "uniform",
+                 latency_sigma: float = 0.5,
+                 error_rate: float = 0.0):
+        if latency_distribution not in ("uniform", "lognormal"):
+            raise ValueError(f"unsupported latency distribution={latency_distribution}")
+        self.embedding_dim = embedding_dim
+        self.latency_ms = latency_ms
+        self.per_item_latency_ms = per_item_latency_ms
+        self.jitter_ms = jitter_ms
+        self.text_latency_ms = latency_ms if text_latency_ms is None else text_latency_ms
+        self.latency_distribution = latency_distribution
+        self.latency_sigma = latency_sigma
+        self.capacity = capacity
+        self.token_latency_ms = token_latency_ms
+        self.supports_streaming = supports_streaming
+        self.error_rate = error_rate
+        self.calls = 0
+        # text generation calls by their generation parameters (json)
+        self.generation_parameters = Counter()
+        self.throttled = 0
+        self.errors = 0
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    def _sleep(self, items: int, base_ms: Optional[float] = None) -> None:
+        base_ms = self.latency_ms if base_ms is None else base_ms
+        if self.latency_distribution == "lognormal":
+            base_ms *= random.lognormvariate(0.0, self.latency_sigma)
+        latency = base_ms + self.per_item_latency_ms * items + random.uniform(0, self.jitter_ms)
+        time.sleep(latency / 1000)
+
+    def _respond(self, payload: Dict, accept: str = "application/json") -> Dict:
+        inputs = payload["text_inputs"]
+        if isinstance(inputs, list):
+            self._sleep(len(inputs))
+            body = {"embedding": [fake_embedding(text, self.embedding_dim) for text in inputs]}
+            if accept == "application/x-npy":
+                import numpy as np
+                npy = io.BytesIO()
+                np.save(npy, np.asarray(body["embedding"], dtype=np.float32))
+                return {"Body": io.BytesIO(npy.getvalue()), "ContentType": accept}
+        else:
+            parameters = json.dumps({k: v for k, v in payload.items() if k != "text_inputs"}, sort_keys=True)
+            with self._lock:
+                self.generation_parameters[parameters] += 1
+            self._sleep(1, self.text_latency_ms)
+            body = {"generated_texts": [f"answer to: {inputs[-200:]}"] * payload.get("num_return_sequences", 1)}
+        return {"Body": io.BytesIO(json.dumps(body).encode("utf-8")), "ContentType": "application/json"}
+
+    def invoke_endpoint(self, EndpointName: str, Body: bytes, ContentType: str = "application/json",
+                        Accept: str = "application/json", **kwargs) -> Dict:
+        with self._lock:
+            self.calls += 1
+            self._in_flight += 1
+            throttled = self.capacity is not None and self._in_flight > self.capacity
+            if throttled:
+                self.throttled += 1
+            failed = not throttled and random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        try:
+            if throttled:
+                raise FakeThrottlingException()
+            if failed:
+                raise FakeModelError()
+            return self._respond(json.loads(Body), Accept)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def invoke_endpoint_with_response_stream(self, EndpointName: str, Body: bytes,
+                                             ContentType: str = "application/json", **kwargs) -> Dict:
+        """Streams the generated text word by word as text-generation-inference style events."""
+        with self._lock:
+            self.calls += 1
+        if not self.supports_streaming:
+            from botocore.exceptions import ClientError
+            raise ClientError({"Error": {"Code": "ValidationError", "Message": "streaming is not supported"}},
+                              "InvokeEndpointWithResponseStream")
+        payload = json.loads(Body)
+        text = json.loads(self._respond(payload)["Body"].read())["generated_texts"][0]
+
+        def _events():
+            words = text.split(" ")
+            for i, word in enumerate(words):
+                time.sleep(self.token_latency_ms / 1000)
+                event = {"token": {"text": word if i == 0 else " " + word, "special": False}}
+                if i == len(words) - 1:
+                    event["generated_text"] = text
+                line = f"data:{json.dumps(event)}\n\n".encode("utf-8")
+                # split every event in two parts, like the service may do
+                yield {"PayloadPart": {"Bytes": line[:7]}}
+                yield {"PayloadPart": {"Bytes": line[7:]}}
+
+        return {"Body": _events(), "ContentType": "text/event-stream"}
+
+
+class FakeSageMakerServer:
+    """
+    Serves a FakeSageMakerRuntime over HTTP (POST /endpoints/<name>/invocations)
+    for clients that do not go through boto3, e.g. the async runtime client with
+    SAGEMAKER_RUNTIME_ENDPOINT_URL pointing here. Use as a context manager.
+    """
+
+    def __init__(self, runtime: FakeSageMakerRuntime, port: int = 0):
+        self.runtime = runtime
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                name = self.path.strip("/").split("/")[1]
+                try:
+                    response = runtime.invoke_endpoint(EndpointName=name, Body=body,
+                                                       Accept=self.headers.get("Accept") or "application/json")
+                    status, payload, content_type = 200, response["Body"].read(), response["ContentType"]
+                    error_type = None
+                except FakeThrottlingException as e:
+                    status, payload, error_type = 429, json.dumps({"message": str(e)}).encode("utf-8"), "ThrottlingException"
+                    content_type = "application/json"
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(payload)))
+                if error_type:
+                    self.send_header("x-amzn-ErrorType", error_type)
+                self.end_headers()
+                self.wfile.write(payload)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self) -> "FakeSageMakerServer":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,53 @@
+"""
+In-process stand-in for the boto3 `ssm` client. Every call sleeps for a
+configurable round trip time and is counted, `install()` patches boto3 so any
+code creating an SSM client gets the fake instead.
+"""
+import time
+import boto3
+from typing import Dict, List
+
+DEFAULT_PARAMETERS: Dict[str, str] = {
+    "REGION": "ap-southeast-2",
+    "TEXT2TEXT_ENDPOINT_NAME": "fake-flan-t5-xl",
+    "EMBEDDING_ENDPOINT_NAME": "fake-gpt-j-6b",
+    "OPENSEARCH_DOMAIN_ENDPOINT": "https://localhost:9200",
+    "OPENSEARCH_INDEX": "llm_app_documents",
+    "ACCESS_KEY": "fake-access-key",
+    "SECRET_KEY": "fake-secret-key",
+}
+
+
+class FakeSSM:
+    def __init__(self, parameters: Dict[str, str] = None, latency_ms: float = 30.0):
+        self.parameters = dict(DEFAULT_PARAMETERS if parameters is None else parameters)
+        self.latency_ms = latency_ms
+        self.calls = 0
+
+    def _round_trip(self) -> None:
+        self.calls += 1
+        time.sleep(self.latency_ms / 1000)
+
+    def get_parameter(self, Name: str, WithDecryption: bool = False) -> Dict:
+        self._round_trip()
+        return {"Parameter": {"Name": Name, "Value": self.parameters[Name]}}
+
+    def get_parameters(self, Names: List[str], WithDecryption: bool = False) -> Dict:
+        self._round_trip()
+        return {"Parameters": [{"Name": name, "Value": self.parameters[name]} for name in Names if name in self.parameters],
+                "InvalidParameters": [name for name in Names if name not in self.parameters]}
+
+
+def install(fake: FakeSSM) -> FakeSSM:
+    """Make boto3.client('ssm') and Session.client('ssm') return the fake."""
+    client, session_client = boto3.client, boto3.Session.client
+
+    def _client(service_name, *args, **kwargs):
+        return fake if service_name == "ssm" else client(service_name, *args, **kwargs)
+
+    def _session_client(self, service_name, *args, **kwargs):
+        return fake if service_name == "ssm" else session_client(self, service_name, *args, **kwargs)
+
+    boto3.client = _client
+    boto3.Session.client = _session_client
+    return fake
@@ -0,0 +1,286 @@
+"""
+Replays recorded Request payloads against /rag and /text2text, to size Lambda
+concurrency and endpoint instance counts before a launch.
+
+The payloads are a JSONL file with one Request body per line, an optional
+"endpoint" key ("rag" or "text2text") routes the line, --endpoint otherwise.
+The lines are replayed in order and cycled.
+
+Two modes, each run for one or more levels:
+
+- --rate 5 10 20: open loop, requests are sent on a fixed schedule (or with
+  Poisson arrivals) whether or not the previous ones completed. Latency is
+  measured from the time a request was due, so a server that stalls is not
+  hidden by the generator waiting for it (coordinated omission). The service
+  time, from the actual send, is reported as well.
+- --concurrency 1 4 16: closed loop, every client sends its next request as
+  soon as the previous one completes.
+
+Requests started during --warmup-seconds are not counted. The target is a
+deployed URL (--target https://<api id>.execute-api.<region>.amazonaws.com/prod)
+or, with --in-process, the app of lambda/app served from this process with
+httpx's ASGI transport against the stand-ins.
+
+python benchmarks/load_generator.py --in-process --rate 5 10 20 --duration 30
+python benchmarks/load_generator.py --target https://<api> --concurrency 1 4 16 --payloads <recorded>.jsonl
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import asyncio
+import logging
+import argparse
+from typing import Any, Dict, List, Optional, Tuple
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_PAYLOADS = os.path.join(BENCHMARKS_DIR, "sample_requests.jsonl")
+EMBEDDING_DIM = 256
+
+# upper bounds of the printed latency histogram, in milliseconds
+HISTOGRAM_BOUNDS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+
+def load_payloads(path: str, default_endpoint: str) -> List[Tuple[str, Dict[str, Any]]]:
+    payloads = []
+    with open(path) as f:
+        for number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            payload = json.loads(line)
+            if "query" not in payload:
+                raise ValueError(f"{path}:{number} is not a Request payload, it has no query")
+            payloads.append((payload.pop("endpoint", default_endpoint), payload))
+    if not payloads:
+        raise ValueError(f"no payloads in {path}")
+    return payloads
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(math.ceil(q * len(values))) - 1)] if q > 0 else values[0]
+
+
+class Recorder:
+    """Outcome of every counted request, per endpoint."""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.service_times: Dict[str, List[float]] = {}
+        self.errors: Dict[str, Dict[str, int]] = {}
+
+    def record(self, endpoint: str, latency: float, service_time: float, error: Optional[str]) -> None:
+        if error is not None:
+            errors = self.errors.setdefault(endpoint, {})
+            errors[error] = errors.get(error, 0) + 1
+            return
+        self.latencies.setdefault(endpoint, []).append(latency * 1000)
+        self.service_times.setdefault(endpoint, []).append(service_time * 1000)
+
+    def summary(self, seconds: float) -> Dict[str, Any]:
+        summary = {}
+        for endpoint in sorted(set(self.latencies) | set(self.errors)):
+            latencies = self.latencies.get(endpoint, [])
+            service_times = self.service_times.get(endpoint, [])
+            summary[endpoint] = {
+                "ok": len(latencies),
+                "errors": self.errors.get(endpoint, {}),
+                "throughput": round(len(latencies) / seconds, 2) if seconds > 0 else 0.0,
+                "latency_ms": {name: round(_percentile(latencies, q), 1)
+                               for name, q in (("p50", 0.5), ("p90", 0.9), ("p95", 0.95), ("p99", 0.99),
+                                               ("p99.9", 0.999), ("max", 1.0))},
+                "service_time_ms": {name: round(_percentile(service_times, q), 1)
+                                    for name, q in (("p50", 0.5), ("p99", 0.99))},
+                "histogram_ms": histogram(latencies),
+            }
+        return summary
+
+
+def histogram(values: List[float]) -> Dict[str, int]:
+    counts = {f"<={bound}": 0 for bound in HISTOGRAM_BOUNDS_MS}
+    counts[f">{HISTOGRAM_BOUNDS_MS[-1]}"] = 0
+    for value in values:
+        for bound in HISTOGRAM_BOUNDS_MS:
+            if value <= bound:
+                counts[f"<={bound}"] += 1
+                break
+        else:
+            counts[f">{HISTOGRAM_BOUNDS_MS[-1]}"] += 1
+    return counts
+
+
+def print_histogram(counts: Dict[str, int], width: int = 40) -> None:
+    top = max(counts.values()) or 1
+    for bucket, count in counts.items():
+        if count:
+            print(f"    {bucket:>9} ms {count:>7} {'#' * max(1, round(width * count / top))}")
+
+
+class LoadGenerator:
+    """
+    Args:
+        client: httpx.AsyncClient, on the deployed URL or on the in-process app.
+        payloads: (endpoint, Request body) pairs, replayed in order and cycled.
+        path_prefix: where the llm router is mounted.
+        timeout: seconds before a request counts as an error.
+    """
+
+    def __init__(self, client, payloads: List[Tuple[str, Dict]], path_prefix: str = "/api/v1/llm",
+                 timeout: float = 120.0):
+        self.client = client
+        self.payloads = payloads
+        self.path_prefix = path_prefix.rstrip("/")
+        self.timeout = timeout
+        self._next = 0
+
+    def _payload(self) -> Tuple[str, Dict]:
+        payload = self.payloads[self._next % len(self.payloads)]
+        self._next += 1
+        return payload
+
+    async def _send(self, endpoint: str, body: Dict, due: float, recorder: Optional[Recorder]) -> None:
+        sent = time.perf_counter()
+        error = None
+        try:
+            response = await self.client.post(f"{self.path_prefix}/{endpoint}", json=body, timeout=self.timeout)
+            # streamed answers are read to the end
+            await response.aread()
+            if response.status_code >= 400:
+                error = f"http {response.status_code}"
+        except Exception as e:
+            error = type(e).__name__
+        done = time.perf_counter()
+        if recorder is not None:
+            recorder.record(endpoint, done - due, done - sent, error)
+
+    async def open_loop(self, rate: float, duration: float, warmup: float, poisson: bool = False,
+                        max_outstanding: int = 10000) -> Tuple[Recorder, Dict[str, Any]]:
+        """Sends `rate` requests per second for warmup + duration seconds, on schedule."""
+        recorder, tasks, rng = Recorder(), set(), random.Random(0)
+        start = time.perf_counter()
+        measured_from, end = start + warmup, start + warmup + duration
+        due, dropped = start, 0
+        while due < end:
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            counted = due >= measured_from
+            if len(tasks) >= max_outstanding:
+                # the generator protects itself, the request is reported as not sent
+                dropped += counted
+            else:
+                endpoint, body = self._payload()
+                task = asyncio.ensure_future(self._send(endpoint, body, due, recorder if counted else None))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            due += rng.expovariate(rate) if poisson else 1.0 / rate
+        if tasks:
+            await asyncio.gather(*tasks)
+        return recorder, {"dropped": dropped, "seconds": duration}
+
+    async def closed_loop(self, concurrency: int, duration: float, warmup: float) -> Tuple[Recorder, Dict[str, Any]]:
+        """`concurrency` clients each sending their next request as soon as the previous one completed."""
+        recorder = Recorder()
+        start = time.perf_counter()
+        measured_from, end = start + warmup, start + warmup + duration
+
+        async def _client():
+            while True:
+                now = time.perf_counter()
+                if now >= end:
+                    return
+                endpoint, body = self._payload()
+                await self._send(endpoint, body, now, recorder if now >= measured_from else None)
+
+        await asyncio.gather(*[_client() for _ in range(concurrency)])
+        # the last requests may complete after the end, they still count
+        return recorder, {"seconds": max(time.perf_counter() - measured_from, 1e-9)}
+
+
+def in_process_client(args):
+    """httpx client on the app of lambda/app, wired to in-process stand-ins."""
+    import httpx
+    sys.path.insert(0, BENCHMARKS_DIR)
+    import fake_app
+    from fake_sagemaker import FakeSageMakerRuntime
+    from fake_opensearch import FakeOpenSearch
+    runtime = FakeSageMakerRuntime(embedding_dim=EMBEDDING_DIM, latency_ms=args.embed_latency_ms,
+                                   per_item_latency_ms=0.0, text_latency_ms=args.llm_latency_ms,
+                                   latency_distribution="lognormal", latency_sigma=args.latency_sigma)
+    opensearch = FakeOpenSearch(args.os_latency_ms, 0.0).__enter__()
+    fake_app.index_synthetic_corpus(opensearch.url, "bench", EMBEDDING_DIM)
+    app = fake_app.load_app(runtime, opensearch.url, "bench")
+    # the app logs at INFO, it would drown the report
+    logging.getLogger().setLevel(logging.WARNING)
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://in-process",
+                             limits=httpx.Limits(max_connections=None))
+
+
+def remote_client(target: str):
+    import httpx
+    return httpx.AsyncClient(base_url=target.rstrip("/"),
+                             limits=httpx.Limits(max_connections=None, max_keepalive_connections=1000))
+
+
+def report(mode: str, level: float, recorder: Recorder, extra: Dict[str, Any]) -> Dict[str, Any]:
+    summary = recorder.summary(extra["seconds"])
+    print(f"\n{mode}={level:g}" + (f", dropped={extra['dropped']}" if extra.get("dropped") else ""))
+    for endpoint, stats in summary.items():
+        latency = stats["latency_ms"]
+        print(f"  {endpoint:<9} ok={stats['ok']:<6} errors={stats['errors'] or 0} throughput={stats['throughput']}/s "
+              f"p50={latency['p50']}ms p90={latency['p90']}ms p99={latency['p99']}ms p99.9={latency['p99.9']}ms "
+              f"max={latency['max']}ms service_p50={stats['service_time_ms']['p50']}ms")
+        print_histogram(stats["histogram_ms"])
+    return {"mode": mode, "level": level, **extra, "endpoints": summary}
+
+
+async def main(args) -> List[Dict[str, Any]]:
+    payloads = load_payloads(args.payloads, args.endpoint)
+    client = in_process_client(args) if args.in_process else remote_client(args.target)
+    results = []
+    async with client:
+        generator = LoadGenerator(client, payloads, path_prefix=args.path_prefix, timeout=args.timeout)
+        for rate in args.rate or []:
+            recorder, extra = await generator.open_loop(rate, args.duration, args.warmup_seconds, poisson=args.poisson,
+                                                        max_outstanding=args.max_outstanding)
+            results.append(report("rate", rate, recorder, extra))
+        for concurrency in args.concurrency or []:
+            recorder, extra = await generator.closed_loop(concurrency, args.duration, args.warmup_seconds)
+            results.append(report("concurrency", concurrency, recorder, extra))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--target", type=str, help="base URL of a deployed API")
+    target.add_argument("--in-process", action="store_true", help="the app of lambda/app against the stand-ins")
+    parser.add_argument("--payloads", type=str, default=DEFAULT_PAYLOADS)
+    parser.add_argument("--endpoint", type=str, default="rag", choices=["rag", "text2text"],
+                        help="endpoint of the payloads without an endpoint key")
+    parser.add_argument("--path-prefix", type=str, default="/api/v1/llm")
+    parser.add_argument("--rate", type=float, nargs="+", default=None, help="open loop, requests per second")
+    parser.add_argument("--poisson", action="store_true", help="exponential inter-arrival times instead of a fixed interval")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=None, help="closed loop, number of clients")
+    parser.add_argument("--duration", type=float, default=30.0, help="measured seconds per level")
+    parser.add_argument("--warmup-seconds", type=float, default=5.0)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--max-outstanding", type=int, default=10000)
+    parser.add_argument("--output", type=str, default=None, help="write the results as json")
+    # stand-in latencies of --in-process
+    parser.add_argument("--embed-latency-ms", type=float, default=30.0)
+    parser.add_argument("--llm-latency-ms", type=float, default=300.0)
+    parser.add_argument("--latency-sigma", type=float, default=0.4)
+    parser.add_argument("--os-latency-ms", type=float, default=5.0)
+    args = parser.parse_args()
+    if not args.rate and not args.concurrency:
+        parser.error("pass --rate and/or --concurrency")
+
+    results = asyncio.run(main(args))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,122 @@
+"""
+Writes embedded chunks to OpenSearch through the _bulk API.
+
+Actions are streamed into opensearch-py's parallel_bulk so several _bulk
+requests of `bulk_size` documents are in flight at the same time over one
+pooled keep-alive client. A document the cluster rejects is reported and
+counted instead of failing the whole run. The vectors are written with the
+encoding of the index (see vector_quantization.py).
+"""
+import logging
+import threading
+import numpy as np
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from opensearchpy import OpenSearch
+from opensearchpy.helpers import parallel_bulk
+from vector_quantization import RESCORE_FIELD, VectorEncoding, pack_rescore_vectors
+
+logger = logging.getLogger(__name__)
+
+# number of rejected documents kept for the final report
+MAX_REPORTED_ERRORS = 100
+
+
+class BulkIndexer:
+    """
+    Args:
+        client: OpenSearch client, its connection pool should allow at least max_in_flight connections.
+        index_name: index the documents are written to.
+        bulk_size: number of documents per _bulk request.
+        max_in_flight: number of _bulk requests sent in parallel.
+        encoding: how the vectors are stored, float32 when None.
+    """
+
+    def __init__(self, client: OpenSearch, index_name: str, bulk_size: int = 100, max_in_flight: int = 2,
+                 encoding: Optional[VectorEncoding] = None):
+        self.client = client
+        self.index_name = index_name
+        self.encoding = encoding or VectorEncoding()
+        self.bulk_size = bulk_size
+        self.max_in_flight = max_in_flight
+        self.indexed = 0
+        self.failed = 0
+        self.errors: List[Dict] = []
+        self._lock = threading.Lock()
+
+    def _record(self, ok: bool, item: Dict) -> None:
+        with self._lock:
+            if ok:
+                self.indexed += 1
+                return
+            self.failed += 1
+            if len(self.errors) < MAX_REPORTED_ERRORS:
+                self.errors.append(item)
+        logger.warning(f"document rejected by the cluster, {item}")
+
+    def stream(self, actions: Iterable[Dict],
+               on_result: Optional[Callable[[str, bool], None]] = None) -> Iterator[bool]:
+        """
+        Sends the actions, yields True/False for every document as the responses come back.
+        on_result is called with the id of every document and whether it was written.
+        """
+        for ok, item in parallel_bulk(self.client, actions,
+                                      thread_count=self.max_in_flight,
+                                      chunk_size=self.bulk_size,
+                                      queue_size=self.max_in_flight,
+                                      raise_on_error=False,
+                                      raise_on_exception=False):
+            self._record(ok, item)
+            if on_result is not None:
+                # {"index": {"_id": ..., "status": ...}}, also for the documents of a failed request
+                on_result(next(iter(item.values()), {}).get("_id"), ok)
+            yield ok
+
+    def index_embedded_batches(self, embedded_batches: Iterable[Tuple[List, np.ndarray]],
+                               before_first: Optional[Callable[[np.ndarray], None]] = None,
+                               on_result: Optional[Callable[[str, bool], None]] = None) -> Iterator[bool]:
+        """
+        Upserts (chunks, vectors) batches under the deterministic chunk ids,
+        before_first is called with the first batch of vectors before any document is sent
+        (e.g. to create the index and calibrate the encoding), on_result as in stream.
+        """
+        def _actions():
+            first = True
+            for chunks, vectors in embedded_batches:
+                if len(chunks) == 0:
+                    continue
+                vectors = np.asarray(vectors, dtype=np.float32)
+                if first and before_first is not None:
+                    before_first(vectors)
+                first = False
+                encoded = self.encoding.encode(vectors).tolist()
+                rescore_vectors = pack_rescore_vectors(vectors) if self.encoding.rescore else None
+                for i, chunk in enumerate(chunks):
+                    action = {"_op_type": "index",
+                              "_index": self.index_name,
+                              "_id": chunk.metadata['chunk_id'],
+                              "vector_field": encoded[i],
+                              "text": chunk.page_content,
+                              "metadata": chunk.metadata}
+                    if rescore_vectors is not None:
+                        action[RESCORE_FIELD] = rescore_vectors[i]
+                    yield action
+        return self.stream(_actions(), on_result)
+
+    def delete(self, ids: List[str]) -> int:
+        """Deletes documents by id, ids that are already gone are not an error."""
+        actions = ({"_op_type": "delete", "_index": self.index_name, "_id": _id} for _id in ids)
+        deleted = 0
+        for ok, item in parallel_bulk(self.client, actions,
+                                      thread_count=self.max_in_flight,
+                                      chunk_size=self.bulk_size,
+                                      raise_on_error=False,
+                                      raise_on_exception=False):
+            if ok:
+                deleted += 1
+            elif item.get("delete", {}).get("status") != 404:
+                self._record(ok, item)
+        return deleted
+
+    def summary(self) -> Dict:
+        with self._lock:
+            return {"indexed": self.indexed, "failed": self.failed, "errors": list(self.errors[:10])}
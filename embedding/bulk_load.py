@@ -0,0 +1,125 @@
+"""
+Bulk-load mode of the ingestion job.
+
+While an index is being loaded it does not need to be searchable nor
+replicated: with the refresh interval off OpenSearch stops turning the
+indexing buffer into small segments every second (and building a k-NN graph
+for each of them), and with no replicas every document is indexed once. When
+the load is done the settings are restored, the segments are force-merged
+(fewer, larger HNSW graphs to search) and the graphs can be loaded into the
+k-NN plugin's memory before the first query needs them.
+
+With a fresh index the corpus is loaded into a new index and the alias the
+query API searches is swapped to it in one _aliases call, queries never see a
+half-built index. The job must then see the whole corpus, like
+--delete-missing-sources it is not for ShardedByS3Key jobs across instances.
+The query API reads the vector encoding of the alias again once its hits
+come from another index, a fresh byte index takes the int8 scale of the one
+it replaces so the queries encoded before that still match it.
+"""
+import time
+import logging
+from typing import Any, Dict, List, Optional
+from opensearchpy import OpenSearch
+
+logger = logging.getLogger(__name__)
+
+# settings of an index while it is loaded
+BULK_LOAD_SETTINGS = {"index.refresh_interval": "-1", "index.number_of_replicas": 0}
+# force merges and warmups run much longer than a _bulk request
+MAINTENANCE_REQUEST_TIMEOUT = 3600
+
+
+def fresh_index_name(alias: str) -> str:
+    return f"{alias}-{time.strftime('%Y%m%d%H%M%S', time.gmtime())}"
+
+
+def alias_indices(client: OpenSearch, alias: str) -> List[str]:
+    """Indices behind the alias, empty when there is no such alias."""
+    # a HEAD first, a 404 on GET is logged as a failed request
+    if not client.indices.exists_alias(name=alias):
+        return []
+    return sorted(client.indices.get_alias(name=alias))
+
+
+def settings_after_load(client: OpenSearch, index_name: str, replicas: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Settings to restore once the load of an existing index is done: the ones
+    it has now, replicas when given. A refresh interval already off is what an
+    interrupted load left behind, the default (None) is restored instead.
+    """
+    response = client.indices.get_settings(index=index_name, flat_settings=True)
+    current = next(iter(response.values()))["settings"]
+    refresh_interval = current.get("index.refresh_interval")
+    return {"index.refresh_interval": None if refresh_interval == "-1" else refresh_interval,
+            "index.number_of_replicas": current.get("index.number_of_replicas") if replicas is None else replicas}
+
+
+def start_bulk_load(client: OpenSearch, index_name: str) -> None:
+    client.indices.put_settings(index=index_name, body=BULK_LOAD_SETTINGS)
+    logger.info(f"index={index_name} in bulk-load mode, {BULK_LOAD_SETTINGS}")
+
+
+def restore_settings(client: OpenSearch, index_name: str, settings: Dict[str, Any]) -> None:
+    # None resets a setting to its default
+    client.indices.put_settings(index=index_name, body=settings)
+    logger.info(f"index={index_name} settings restored, {settings}")
+
+
+def finish_bulk_load(client: OpenSearch, index_name: str, settings: Dict[str, Any], max_num_segments: int = 1,
+                     warmup: bool = False) -> Dict[str, float]:
+    """
+    Restores the settings, refreshes, force-merges down to max_num_segments
+    per shard (0 skips it) and loads the k-NN graphs into memory with warmup.
+    Returns the seconds taken by every step.
+    """
+    seconds = {}
+    st = time.time()
+    restore_settings(client, index_name, settings)
+    client.indices.refresh(index=index_name, request_timeout=MAINTENANCE_REQUEST_TIMEOUT)
+    seconds["refresh"] = time.time() - st
+    if max_num_segments > 0:
+        st = time.time()
+        client.indices.forcemerge(index=index_name, max_num_segments=max_num_segments,
+                                  request_timeout=MAINTENANCE_REQUEST_TIMEOUT)
+        seconds["forcemerge"] = time.time() - st
+    if warmup:
+        st = time.time()
+        # only the native engines (nmslib, faiss) keep their graphs in the plugin's memory
+        client.transport.perform_request("GET", f"/_plugins/_knn/warmup/{index_name}",
+                                         params={"request_timeout": MAINTENANCE_REQUEST_TIMEOUT})
+        seconds["warmup"] = time.time() - st
+    logger.info(f"bulk load of index={index_name} finished, "
+                + ", ".join(f"{step}={s:.2f}s" for step, s in seconds.items()))
+    return seconds
+
+
+def check_alias(client: OpenSearch, alias: str, delete_previous: bool = False) -> None:
+    """Raises when `alias` is a concrete index (from before the fresh index mode) that may not be deleted."""
+    if not delete_previous and not alias_indices(client, alias) and client.indices.exists(alias):
+        raise ValueError(f"index={alias} is an index, not an alias, it can only be replaced by a fresh index "
+                         f"when the previous index may be deleted")
+
+
+def swap_alias(client: OpenSearch, alias: str, index_name: str, delete_previous: bool = False) -> List[str]:
+    """
+    Points the alias to index_name only, in one atomic _aliases call, and
+    deletes the indices it pointed to before when delete_previous is set.
+    Returns those indices.
+    """
+    check_alias(client, alias, delete_previous)
+    aliased = alias_indices(client, alias)
+    previous = [name for name in aliased if name != index_name]
+    if not aliased and client.indices.exists(alias):
+        # still a concrete index, the alias can only take its name once it is gone
+        actions = [{"remove_index": {"index": alias}}]
+        previous = [alias]
+    else:
+        actions = [{"remove": {"index": name, "alias": alias}} for name in previous]
+        if delete_previous:
+            actions += [{"remove_index": {"index": name}} for name in previous]
+    actions.append({"add": {"index": index_name, "alias": alias}})
+    client.indices.update_aliases(body={"actions": actions})
+    logger.info(f"alias={alias} now points to index={index_name}, previously {previous} "
+                f"({'deleted' if delete_previous else 'kept'})")
+    return previous
@@ -0,0 +1,207 @@
+"""
+Deduplication of the chunks of the ingestion job.
+
+The ReadTheDocs pages repeat the same navigation, footers and boilerplate,
+after splitting many chunks of different pages have the same text. Every
+chunk is still indexed under its own id (the manifest, the checkpoint, the
+stale chunk deletes and the context packing all work per source) but its
+vector is only computed once:
+
+    EmbeddingDeduplicator   embeds every distinct text (after normalization
+                            of the unicode forms and whitespace) once, the
+                            vector is fanned out to all the chunks with that
+                            text. Recent vectors are kept in a bounded LRU,
+                            a text being embedded by another worker is
+                            waited for rather than embedded twice.
+
+    NearDuplicateFilter     optional, drops a chunk whose 64 bit SimHash is
+                            within a few bits of a chunk already kept (or
+                            already in the index), the boilerplate variants
+                            that are not byte-identical are not indexed.
+"""
+import re
+import hashlib
+import logging
+import threading
+import unicodedata
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Dict, Iterable, List, Optional
+from langchain.docstore.document import Document
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# vectors kept for texts seen again later, 16 KB each with 4096 dimensions
+DEDUP_CACHE_SIZE = 10000
+# metadata field with the SimHash of a chunk, read back from the index to seed the filter
+SIMHASH_FIELD = "simhash"
+SIMHASH_BITS = 64
+# the 64 bits are split in bands, two hashes within MAX_DISTANCE < bands bits share at least one band
+SIMHASH_BANDS = 4
+SHINGLE_SIZE = 4
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+
+def dedup_key(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+def simhash(text: str) -> int:
+    """SimHash of the character shingles of the normalized, lower cased text."""
+    # chunks are a few hundred characters, word features are too few and too coarse at that size
+    text = normalize_text(text).lower()
+    features = [text[i:i + SHINGLE_SIZE] for i in range(max(1, len(text) - SHINGLE_SIZE + 1))]
+    if not text:
+        return 0
+    hashes = np.array([int.from_bytes(hashlib.blake2b(f.encode("utf-8"), digest_size=8).digest(), "little")
+                       for f in features], dtype=np.uint64)
+    bits = (hashes[:, None] >> np.arange(SIMHASH_BITS, dtype=np.uint64)) & np.uint64(1)
+    weights = (2 * bits.astype(np.int64) - 1).sum(axis=0)
+    return int(sum(1 << i for i in range(SIMHASH_BITS) if weights[i] > 0))
+
+
+class NearDuplicateFilter:
+    """
+    Args:
+        max_distance: largest number of differing bits of two near duplicates, below SIMHASH_BANDS.
+        seen: SimHashes of the chunks already indexed.
+    """
+
+    def __init__(self, max_distance: int = 3, seen: Iterable[int] = ()):
+        if not 0 <= max_distance < SIMHASH_BANDS:
+            raise ValueError(f"max_distance={max_distance} must be between 0 and {SIMHASH_BANDS - 1}")
+        self.max_distance = max_distance
+        self._band_bits = SIMHASH_BITS // SIMHASH_BANDS
+        self._bands: List[Dict[int, List[int]]] = [{} for _ in range(SIMHASH_BANDS)]
+        self.dropped = 0
+        for value in seen:
+            self._add(value)
+
+    def _band_keys(self, value: int) -> List[int]:
+        mask = (1 << self._band_bits) - 1
+        return [(value >> (i * self._band_bits)) & mask for i in range(SIMHASH_BANDS)]
+
+    def _add(self, value: int) -> None:
+        for band, key in zip(self._bands, self._band_keys(value)):
+            band.setdefault(key, []).append(value)
+
+    def forget(self, values: Iterable[int]) -> None:
+        """Removes one occurrence of every value, e.g. the chunks about to be deleted from the index."""
+        for value in values:
+            for band, key in zip(self._bands, self._band_keys(value)):
+                others = band.get(key)
+                if others and value in others:
+                    others.remove(value)
+                    if not others:
+                        del band[key]
+
+    def is_duplicate(self, value: int) -> bool:
+        for band, key in zip(self._bands, self._band_keys(value)):
+            for other in band.get(key, ()):
+                if bin(value ^ other).count("1") <= self.max_distance:
+                    return True
+        return False
+
+    def filter(self, chunks: List[Document]) -> List[Document]:
+        """The chunks that are not near duplicates of a chunk seen before, their SimHash goes in their metadata."""
+        kept = []
+        for chunk in chunks:
+            value = simhash(chunk.page_content)
+            if self.is_duplicate(value):
+                self.dropped += 1
+                registry.inc("dedup_near_duplicates_dropped_total")
+                continue
+            self._add(value)
+            chunk.metadata[SIMHASH_FIELD] = format(value, "016x")
+            kept.append(chunk)
+        return kept
+
+
+class EmbeddingDeduplicator:
+    """
+    Wraps an embed_documents function so a text is embedded once per job.
+
+    Args:
+        cache_size: number of vectors kept for texts seen again later.
+        batch_size: texts per endpoint call, only used to count the calls saved.
+    """
+
+    def __init__(self, cache_size: int = DEDUP_CACHE_SIZE, batch_size: int = 5):
+        self.cache_size = cache_size
+        self.batch_size = batch_size
+        self._cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._in_flight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.texts = 0
+        self.embedded = 0
+        self.calls = 0
+        self.calls_without_dedup = 0
+
+    def embed_documents(self, texts: List[str], embed: Callable[[List[str]], np.ndarray]) -> np.ndarray:
+        keys = [dedup_key(text) for text in texts]
+        vectors: Dict[str, np.ndarray] = {}
+        claimed: Dict[str, str] = {}
+        waiting: Dict[str, Future] = {}
+        with self._lock:
+            for key, text in zip(keys, texts):
+                if key in vectors or key in claimed or key in waiting:
+                    continue
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    vectors[key] = self._cache[key]
+                elif key in self._in_flight:
+                    waiting[key] = self._in_flight[key]
+                else:
+                    claimed[key] = text
+                    self._in_flight[key] = Future()
+        # our own texts first, another worker may be waiting for them
+        if claimed:
+            try:
+                embedded = np.asarray(embed(list(claimed.values())), dtype=np.float32)
+            except BaseException as e:
+                with self._lock:
+                    for key in claimed:
+                        self._in_flight.pop(key).set_exception(e)
+                raise
+            with self._lock:
+                for key, vector in zip(claimed, embedded):
+                    vectors[key] = vector
+                    self._cache[key] = vector
+                    self._in_flight.pop(key).set_result(vector)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        for key, future in waiting.items():
+            # raises when the other worker failed, the batch is then retried and embeds the text itself
+            vectors[key] = future.result()
+        calls = -(-len(claimed) // self.batch_size)
+        calls_without_dedup = -(-len(texts) // self.batch_size)
+        with self._lock:
+            self.texts += len(texts)
+            self.embedded += len(claimed)
+            self.calls += calls
+            self.calls_without_dedup += calls_without_dedup
+        registry.inc("dedup_texts_total", len(texts))
+        registry.inc("dedup_embeddings_saved_total", len(texts) - len(claimed))
+        registry.inc("dedup_embedding_calls_saved_total", calls_without_dedup - calls)
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.stack([vectors[key] for key in keys])
+
+    def summary(self) -> str:
+        with self._lock:
+            return (f"{self.embedded} of {self.texts} chunk texts embedded, {self.texts - self.embedded} reused, "
+                    f"{self.calls} embedding calls instead of {self.calls_without_dedup} "
+                    f"({self.calls_without_dedup - self.calls} saved)")
+
+
+def seen_simhashes(values: Iterable[Optional[str]]) -> List[int]:
+    """SimHashes of the SIMHASH_FIELD metadata read back from the index, chunks without it are skipped."""
+    # one per chunk, chunks with the same simhash are forgotten one at a time
+    return [int(value, 16) for value in values if value]
@@ -0,0 +1,141 @@
+"""
+Concurrent batch embedding engine used by SagemakerEndpointEmbeddingsJumpStart.
+
+The input texts are split into batches and up to `max_in_flight` batches are
+sent to the endpoint at the same time, the results are put back together in
+input order. When the endpoint throttles, the number of in-flight requests is
+halved and the batch is retried after an exponential backoff (with jitter),
+every successful request then grows the limit back towards `max_in_flight`.
+"""
+import time
+import random
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# error codes/messages that mean "slow down" rather than "this request is broken",
+# langchain wraps the botocore error into a ValueError so we also look at the message
+THROTTLING_MARKERS = ("ThrottlingException", "TooManyRequestsException", "Throttling",
+                      "SlowDown", "ServiceUnavailable")
+
+
+def is_throttling_error(e: Exception) -> bool:
+    response = getattr(e, "response", None) or {}
+    code = response.get("Error", {}).get("Code", "")
+    message = f"{code} {e}"
+    return any(marker in message for marker in THROTTLING_MARKERS)
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Caps the number of requests in flight, the cap is halved on throttling
+    and increased by 1/cap for every successful request (AIMD).
+    """
+
+    def __init__(self, max_in_flight: int):
+        self.max_in_flight = max(1, max_in_flight)
+        self._limit = float(self.max_in_flight)
+        self._in_flight = 0
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self) -> int:
+        return max(1, int(self._limit))
+
+    def acquire(self) -> None:
+        with self._cond:
+            while self._in_flight >= self.limit:
+                self._cond.wait()
+            self._in_flight += 1
+
+    def release(self, throttled: bool = False) -> None:
+        with self._cond:
+            self._in_flight -= 1
+            if throttled:
+                self._limit = max(1.0, self._limit / 2)
+            elif self._limit < self.max_in_flight:
+                self._limit = min(float(self.max_in_flight), self._limit + 1 / self._limit)
+            self._cond.notify_all()
+
+
+class ConcurrentEmbeddingEngine:
+    """
+    Args:
+        embed_batch: function that embeds one batch of texts with a single
+            endpoint call, e.g. SagemakerEndpointEmbeddings._embedding_func.
+        batch_size: number of texts per endpoint call.
+        max_in_flight: maximum number of endpoint calls running at the same time.
+        max_retries: how many times a throttled batch is retried before giving up.
+        initial_backoff: first backoff in seconds, doubled on every retry.
+        max_backoff: upper bound for the backoff in seconds.
+    """
+
+    def __init__(self,
+                 embed_batch: Callable[[List[str]], List[List[float]]],
+                 batch_size: int = 5,
+                 max_in_flight: int = 4,
+                 max_retries: int = 6,
+                 initial_backoff: float = 0.25,
+                 max_backoff: float = 8.0):
+        self.embed_batch = embed_batch
+        self.batch_size = max(1, batch_size)
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.limiter = AdaptiveConcurrencyLimiter(self.max_in_flight)
+
+    def _batches(self, texts: List[str], batch_size: Optional[int]) -> List[List[str]]:
+        _batch_size = max(1, batch_size or self.batch_size)
+        return [texts[i:i + _batch_size] for i in range(0, len(texts), _batch_size)]
+
+    def _embed_with_retry(self, batch: List[str]) -> List[List[float]]:
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            try:
+                result = self.embed_batch(batch)
+            except Exception as e:
+                throttled = is_throttling_error(e)
+                self.limiter.release(throttled=throttled)
+                if not throttled or attempt >= self.max_retries:
+                    raise
+                delay = min(self.max_backoff, self.initial_backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+                logger.warning(f"embedding endpoint throttled, attempt={attempt + 1}, "
+                               f"in-flight limit={self.limiter.limit}, retrying in {delay:.2f} seconds")
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self.limiter.release()
+            if len(result) != len(batch):
+                raise ValueError(f"endpoint returned {len(result)} embeddings for a batch of {len(batch)} texts")
+            return result
+
+    def embed(self, texts: List[str], batch_size: Optional[int] = None) -> List[List[float]]:
+        """Embed texts from a synchronous caller, results are in input order."""
+        batches = self._batches(texts, batch_size)
+        if len(batches) <= 1 or self.max_in_flight == 1:
+            results = [self._embed_with_retry(batch) for batch in batches]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_in_flight, len(batches))) as pool:
+                # map keeps the order of the batches regardless of completion order
+                results = list(pool.map(self._embed_with_retry, batches))
+        return [embedding for result in results for embedding in result]
+
+    async def aembed(self, texts: List[str], batch_size: Optional[int] = None) -> List[List[float]]:
+        """Embed texts from a coroutine without blocking the event loop."""
+        batches = self._batches(texts, batch_size)
+        if len(batches) == 0:
+            return []
+        loop = asyncio.get_running_loop()
+        pool = ThreadPoolExecutor(max_workers=min(self.max_in_flight, len(batches)))
+        try:
+            results = await asyncio.gather(*[loop.run_in_executor(pool, self._embed_with_retry, batch)
+                                             for batch in batches])
+        finally:
+            pool.shutdown(wait=False)
+        return [embedding for result in results for embedding in result]
@@ -1,61 +1,135 @@
-import time
+import os
 import json
+import asyncio
+import boto3
 import logging
-from typing import List
+import numpy as np
+from functools import partial
+from typing import List, Optional, Sequence
+from botocore.config import Config
+from pydantic import PrivateAttr
 from langchain.embeddings import SagemakerEndpointEmbeddings
 from langchain.embeddings.sagemaker_endpoint import EmbeddingsContentHandler
+from embedding_engine import ConcurrentEmbeddingEngine
+from embedding_cache import EmbeddingCache, open_embedding_cache
+from response_codecs import get_codec
+from metrics import registry, stage
 
 
 logger = logging.getLogger(__name__)
 
+# persistent embedding cache (see embedding_cache.py), empty disables it
+EMBEDDING_CACHE_DIR = os.environ.get("EMBEDDING_CACHE_DIR", "")
+EMBEDDING_CACHE_MAX_MB = int(os.environ.get("EMBEDDING_CACHE_MAX_MB", "4096"))
+
 # extend the SagemakerEndpointEmbeddings class from langchain to provide a custom embedding function
 class SagemakerEndpointEmbeddingsJumpStart(SagemakerEndpointEmbeddings):
+    # number of texts per endpoint call and number of endpoint calls in flight
+    batch_size: int = 5
+    max_in_flight: int = 4
+    max_retries: int = 6
+
+    _engine: Optional[ConcurrentEmbeddingEngine] = PrivateAttr(default=None)
+    # texts already embedded by this endpoint are read from it rather than sent again
+    _cache: Optional[EmbeddingCache] = PrivateAttr(default=None)
+
+    @property
+    def cache(self) -> Optional[EmbeddingCache]:
+        return self._cache
+
+    @property
+    def engine(self) -> ConcurrentEmbeddingEngine:
+        # created lazily so the adaptive concurrency limit is kept across calls
+        if self._engine is None:
+            self._engine = ConcurrentEmbeddingEngine(self._embedding_func,
+                                                     batch_size=self.batch_size,
+                                                     max_in_flight=self.max_in_flight,
+                                                     max_retries=self.max_retries)
+        return self._engine
+
     def embed_documents(
             self, texts: List[str], 
-            chunk_size: int = 5
-    ) -> List[List[float]]:
+            chunk_size: Optional[int] = None
+    ) -> np.ndarray:
         """Compute doc embeddings using a SageMaker Inference Endpoint.
 
         Args:
             texts: The list of texts to embed.
             chunk_size: The chunk size defines how many input texts will
                 be grouped together as request. If None, will use the
-                chunk size specified by the class.
+                batch size specified by the class.
 
         Returns:
-            List of embeddings, one for each text.
+            float32 array with one row of embeddings for each text.
         """
 
-        results = []
-        _chunk_size = len(texts) if chunk_size > len(texts) else chunk_size
-        st = time.time()
-        for i in range(0, len(texts), _chunk_size):
-            response = self._embedding_func(texts[i:i + _chunk_size])
-            results.extend(response)
-        time_taken = time.time() - st
-        logger.info(f"Embedding {len(texts)} documents took {time_taken} seconds")
-        return results
+        with stage("embed_documents"):
+            if self._cache is None:
+                results = self.engine.embed(texts, batch_size=chunk_size)
+            else:
+                results, missing = self._lookup(texts)
+                if missing:
+                    results = self._cache.fill(self.endpoint_name, texts, results, missing,
+                                               self.engine.embed(missing, batch_size=chunk_size))
+        registry.inc("embedded_texts_total", len(texts) if self._cache is None else len(missing))
+        return _stack(results)
+
+    async def aembed_documents(
+            self, texts: List[str],
+            chunk_size: Optional[int] = None
+    ) -> np.ndarray:
+        """Same as embed_documents but can be awaited from an asyncio event loop."""
+        with stage("embed_documents"):
+            if self._cache is None:
+                results = await self.engine.aembed(texts, batch_size=chunk_size)
+            else:
+                # sqlite and segment file reads and writes, on the default executor rather than the event loop
+                loop = asyncio.get_running_loop()
+                results, missing = await loop.run_in_executor(None, self._lookup, texts)
+                if missing:
+                    embedded = await self.engine.aembed(missing, batch_size=chunk_size)
+                    results = await loop.run_in_executor(None, partial(self._cache.fill, self.endpoint_name, texts,
+                                                                       results, missing, embedded))
+        registry.inc("embedded_texts_total", len(texts) if self._cache is None else len(missing))
+        return _stack(results)
+
+    def _lookup(self, texts: List[str]):
+        results, missing = self._cache.lookup(self.endpoint_name, texts)
+        registry.inc("embedding_cache_hits_total", len(texts) - sum(result is None for result in results))
+        registry.inc("embedding_cache_misses_total", sum(result is None for result in results))
+        return results, missing
+
+
+def _stack(rows: List[np.ndarray]) -> np.ndarray:
+    # one contiguous array for the whole call instead of a list of rows
+    if len(rows) == 0:
+        return np.empty((0, 0), dtype=np.float32)
+    return np.stack(rows).astype(np.float32, copy=False)
 
 # class for serializing/deserializing requests/responses to/from the embeddings model
 class ContentHandler(EmbeddingsContentHandler):
     content_type = "application/json"
-    accepts = "application/json"
+    # the response codec (see response_codecs.py) decides the format the endpoint answers with
+    codec = get_codec()
+    accepts = codec.accept
 
     def transform_input(self, prompt: str, model_kwargs={}) -> bytes:
 
         input_str = json.dumps({"text_inputs": prompt, **model_kwargs})
         return input_str.encode('utf-8') 
 
-    def transform_output(self, output: bytes) -> str:
+    def transform_output(self, output: bytes) -> np.ndarray:
+        # float32 rows rather than lists of python floats, parsed without building python objects
+        return self.codec.decode_embeddings(output)
 
-        response_json = json.loads(output.read().decode("utf-8"))
-        embeddings = response_json["embedding"]
-        if len(embeddings) == 1:
-            return [embeddings[0]]
-        return embeddings
 
-
-def create_sagemaker_embeddings_from_js_model(embeddings_model_endpoint_name: str, aws_region: str) -> SagemakerEndpointEmbeddingsJumpStart:
+def create_sagemaker_embeddings_from_js_model(embeddings_model_endpoint_name: str, aws_region: str,
+                                              batch_size: int = 5,
+                                              max_in_flight: int = 4,
+                                              max_pool_connections: int = 10,
+                                              cache_dir: Optional[str] = None,
+                                              cache_input_dirs: Sequence[str] = (),
+                                              cache_max_mb: int = EMBEDDING_CACHE_MAX_MB) -> SagemakerEndpointEmbeddingsJumpStart:
     # all set to create the objects for the ContentHandler and 
     # SagemakerEndpointEmbeddingsJumpStart classes
     content_handler = ContentHandler()
@@ -65,6 +139,18 @@ def create_sagemaker_embeddings_from_js_model(embeddings_model_endpoint_name: st
     embeddings = SagemakerEndpointEmbeddingsJumpStart( 
         endpoint_name=embeddings_model_endpoint_name,
         region_name=aws_region, 
-        content_handler=content_handler
+        content_handler=content_handler,
+        batch_size=batch_size,
+        max_in_flight=max_in_flight
+    )
+    # replace the default client with one whose keep-alive connection pool is
+    # big enough for all the requests in flight, so connections are reused
+    embeddings.client = boto3.Session().client(
+        "sagemaker-runtime",
+        region_name=aws_region,
+        config=Config(max_pool_connections=max(max_pool_connections, max_in_flight), tcp_keepalive=True)
     )
+    # EMBEDDING_CACHE_DIR when no cache dir is given, an empty one disables the cache
+    embeddings._cache = open_embedding_cache(EMBEDDING_CACHE_DIR if cache_dir is None else cache_dir,
+                                             cache_max_mb << 20, input_dirs=cache_input_dirs)
     return embeddings
\ No newline at end of file
@@ -0,0 +1,166 @@
+"""
+Exports the embedded chunks as a FAISS artifact the query API can load in
+process instead of querying OpenSearch.
+
+The artifact is a directory with:
+    index.faiss        HNSW (flat or scalar quantized vectors) or IVF-PQ index,
+                       optionally behind a PCA projection, faiss ids are line numbers
+    docs.jsonl         one {"text": ..., "metadata": ...} line per vector
+    docs.offsets.npy   byte offset of every line in docs.jsonl, so the API can
+                       memory-map the docstore and read single documents
+    meta.json          dimension, index type, document count and the files
+    vectors.f16.npy    optional fp16 copy of the vectors, the API memory-maps it
+                       to rescore the candidates of a compressed index
+
+Vectors are spooled to a float32 file while the pipeline runs and the index
+is built from a memory map of that file at the end, so the exporter does not
+keep the vectors in Python lists.
+"""
+import os
+import json
+import logging
+import threading
+import numpy as np
+from typing import Dict, Iterator, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = "index.faiss"
+DOCS_FILE = "docs.jsonl"
+OFFSETS_FILE = "docs.offsets.npy"
+META_FILE = "meta.json"
+RESCORE_FILE = "vectors.f16.npy"
+_VECTORS_SPOOL_FILE = "vectors.f32.tmp"
+
+# hnsw_fp16 and hnsw_sq8 store the vectors with 2 and 1 bytes per dimension
+FAISS_INDEX_TYPES = ("hnsw", "hnsw_fp16", "hnsw_sq8", "ivfpq")
+
+
+class FaissExporter:
+    """
+    Args:
+        output_dir: directory the artifact is written to, e.g. a processing job output.
+        index_type: one of FAISS_INDEX_TYPES, "hnsw" (exact vectors, fastest queries),
+            "hnsw_fp16" / "hnsw_sq8" (scalar quantized vectors) or "ivfpq" (most compressed).
+        hnsw_m: number of neighbours per node of the HNSW graph.
+        hnsw_ef_construction: size of the candidate list while building the graph.
+        ivf_nlist: number of IVF cells, derived from the number of vectors when None.
+        pq_m: number of PQ sub-quantizers, must divide the vector dimension.
+        pq_nbits: bits per sub-quantizer code.
+        pca_dim: the vectors are projected on their first pca_dim principal components
+            before they are indexed, None keeps all dimensions.
+        rescore: also write the fp16 vectors so the API can rescore the candidates.
+    """
+
+    def __init__(self,
+                 output_dir: str,
+                 index_type: str = "hnsw",
+                 hnsw_m: int = 32,
+                 hnsw_ef_construction: int = 200,
+                 ivf_nlist: int = None,
+                 pq_m: int = 64,
+                 pq_nbits: int = 8,
+                 pca_dim: int = None,
+                 rescore: bool = False):
+        if index_type not in FAISS_INDEX_TYPES:
+            raise ValueError(f"unsupported faiss index type={index_type}")
+        self.output_dir = output_dir
+        self.index_type = index_type
+        self.hnsw_m = hnsw_m
+        self.hnsw_ef_construction = hnsw_ef_construction
+        self.ivf_nlist = ivf_nlist
+        self.pq_m = pq_m
+        self.pq_nbits = pq_nbits
+        self.pca_dim = pca_dim
+        self.rescore = rescore
+        self.dim = None
+        self.count = 0
+        self._offsets: List[int] = []
+        self._lock = threading.Lock()
+        os.makedirs(output_dir, exist_ok=True)
+        self._docs = open(os.path.join(output_dir, DOCS_FILE), "wb")
+        self._vectors = open(os.path.join(output_dir, _VECTORS_SPOOL_FILE), "wb")
+
+    def add(self, chunks: List, vectors: np.ndarray) -> None:
+        array = np.asarray(vectors, dtype=np.float32)
+        with self._lock:
+            if self.dim is None:
+                self.dim = array.shape[1]
+            for chunk in chunks:
+                self._offsets.append(self._docs.tell())
+                line = json.dumps({"text": chunk.page_content, "metadata": chunk.metadata})
+                self._docs.write(line.encode("utf-8") + b"\n")
+            self._vectors.write(array.tobytes())
+            self.count += len(chunks)
+
+    def tee(self, embedded_batches: Iterator[Tuple[List, np.ndarray]]) -> Iterator[Tuple[List, np.ndarray]]:
+        """Adds every batch to the export and passes it on, e.g. to the OpenSearch bulk indexer."""
+        for chunks, vectors in embedded_batches:
+            self.add(chunks, vectors)
+            yield chunks, vectors
+
+    def _build_index(self, vectors: np.ndarray):
+        import faiss
+        n = vectors.shape[0]
+        index_type = self.index_type
+        pca_dim = self.pca_dim if self.pca_dim and self.pca_dim < self.dim else None
+        dim = pca_dim or self.dim
+        nlist = self.ivf_nlist or max(1, min(int(4 * np.sqrt(n)), n // 39))
+        # PQ needs 2^nbits training points per sub-quantizer and a dimension it divides
+        if index_type == "ivfpq" and (n < max(39 * nlist, 2 ** self.pq_nbits) or dim % self.pq_m != 0):
+            logger.warning(f"not enough vectors ({n}) or pq_m={self.pq_m} does not divide dim={dim}, "
+                           f"falling back to an hnsw index")
+            index_type = "hnsw"
+        if index_type == "ivfpq":
+            quantizer = faiss.IndexFlatL2(dim)
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, self.pq_m, self.pq_nbits)
+        elif index_type == "hnsw":
+            index = faiss.IndexHNSWFlat(dim, self.hnsw_m)
+        else:
+            qtype = faiss.ScalarQuantizer.QT_fp16 if index_type == "hnsw_fp16" else faiss.ScalarQuantizer.QT_8bit
+            index = faiss.IndexHNSWSQ(dim, qtype, self.hnsw_m)
+        if index_type != "ivfpq":
+            index.hnsw.efConstruction = self.hnsw_ef_construction
+        if pca_dim:
+            index = faiss.IndexPreTransform(faiss.PCAMatrix(self.dim, pca_dim), index)
+        if not index.is_trained:
+            sample_size = 256 * nlist if index_type == "ivfpq" else 20000
+            sample = vectors[np.sort(np.random.default_rng(0).choice(n, size=min(n, sample_size), replace=False))]
+            index.train(np.ascontiguousarray(sample))
+        for i in range(0, n, 10000):
+            index.add(np.ascontiguousarray(vectors[i:i + 10000]))
+        return index, index_type
+
+    def finalize(self) -> Dict:
+        """Builds and writes the index, returns the artifact metadata."""
+        import faiss
+        self._docs.close()
+        self._vectors.close()
+        spool_path = os.path.join(self.output_dir, _VECTORS_SPOOL_FILE)
+        if self.count == 0:
+            os.remove(spool_path)
+            logger.warning("no vectors to export, faiss artifact not written")
+            return {}
+        vectors = np.memmap(spool_path, dtype=np.float32, mode="r", shape=(self.count, self.dim))
+        index, index_type = self._build_index(vectors)
+        faiss.write_index(index, os.path.join(self.output_dir, INDEX_FILE))
+        np.save(os.path.join(self.output_dir, OFFSETS_FILE), np.asarray(self._offsets, dtype=np.int64))
+        files = [INDEX_FILE, DOCS_FILE, OFFSETS_FILE]
+        if self.rescore:
+            rescore_vectors = np.lib.format.open_memmap(os.path.join(self.output_dir, RESCORE_FILE), mode="w+",
+                                                        dtype=np.float16, shape=(self.count, self.dim))
+            for i in range(0, self.count, 10000):
+                rescore_vectors[i:i + 10000] = vectors[i:i + 10000]
+            rescore_vectors.flush()
+            del rescore_vectors
+            files.append(RESCORE_FILE)
+        meta = {"dim": self.dim, "count": self.count, "index_type": index_type, "metric": "l2",
+                "pca_dim": self.pca_dim if self.pca_dim and self.pca_dim < self.dim else None,
+                "index_bytes": os.path.getsize(os.path.join(self.output_dir, INDEX_FILE)),
+                "files": files}
+        with open(os.path.join(self.output_dir, META_FILE), "w") as f:
+            json.dump(meta, f)
+        del vectors
+        os.remove(spool_path)
+        logger.info(f"faiss artifact written to {self.output_dir}, {meta}")
+        return meta
@@ -0,0 +1,209 @@
+"""
+Parallel loading of the ReadTheDocs pages.
+
+Parsing the pages with BeautifulSoup is single core and slow, the files are
+parsed by a pool of processes instead and the documents are yielded as they
+finish (not in file order). Only the main content area is extracted, with the
+fastest parser available:
+
+    lexbor       selectolax's lexbor backend, when selectolax is installed
+    lxml         BeautifulSoup with lxml, building only the main content tags
+    html.parser  BeautifulSoup with the standard library parser, same as before
+
+All of them give the text clean_readthedocs_html gives with html.parser
+(same whitespace handling as BeautifulSoup's get_text), so switching parser
+does not change the chunks or their ids.
+
+With a cache directory the extracted text of every page is saved under the
+hash of the file, unchanged pages are never parsed twice. Entries are written
+atomically, several workers or jobs can share the directory.
+"""
+import io
+import os
+import time
+import hashlib
+import logging
+import multiprocessing as mp
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+from langchain.docstore.document import Document
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+PARSERS = ("auto", "lexbor", "lxml", "html.parser")
+# bump when the extraction changes, the cached texts of older versions are not used
+EXTRACTION_VERSION = 1
+# files submitted per worker ahead of the consumer
+FILES_IN_FLIGHT_PER_WORKER = 4
+# fewer pages to parse are parsed in process, the workers take a few seconds to
+# start (spawned, they import the job's main module) which is more than they save
+MIN_FILES_FOR_POOL = 64
+
+# text under these tags is not part of get_text, whitespace under these is kept as is
+_SKIPPED_TAGS = {"script", "style", "template"}
+_PRESERVE_WHITESPACE_TAGS = {"pre", "textarea"}
+_ASCII_SPACES = " \n\t\f\r"
+
+
+def available_parser() -> str:
+    try:
+        from selectolax.lexbor import LexborHTMLParser  # noqa: F401
+        return "lexbor"
+    except ImportError:
+        pass
+    try:
+        import lxml  # noqa: F401
+        return "lxml"
+    except ImportError:
+        return "html.parser"
+
+
+def _join_lines(text: str) -> str:
+    return "\n".join([t for t in text.split("\n") if t])
+
+
+def _is_main_content(name: str, attrs: dict) -> bool:
+    return (name == "main" and attrs.get("id") == "main-content") or (name == "div" and attrs.get("role") == "main")
+
+
+def _soup_main_text(html: str, features: str) -> str:
+    from bs4 import BeautifulSoup, SoupStrainer
+    # only the main content tags (and what is under them) are turned into a tree
+    soup = BeautifulSoup(html, features, parse_only=SoupStrainer(_is_main_content))
+    text = soup.find_all("main", {"id": "main-content"})
+    if len(text) == 0:
+        text = soup.find_all("div", {"role": "main"})
+    return _join_lines(text[0].get_text() if len(text) != 0 else "")
+
+
+def _lexbor_main_text(html: str) -> str:
+    from selectolax.lexbor import LexborHTMLParser
+    tree = LexborHTMLParser(html)
+    node = tree.css_first("main#main-content") or tree.css_first('div[role="main"]')
+    if node is None:
+        return ""
+    parts: List[str] = []
+
+    def _walk(parent, preserve: bool) -> None:
+        child = parent.child
+        while child is not None:
+            tag = child.tag
+            if tag == "-text":
+                text = child.text_content
+                # BeautifulSoup collapses strings made of ascii whitespace only
+                if not preserve and not text.strip(_ASCII_SPACES):
+                    text = "\n" if "\n" in text else " "
+                parts.append(text)
+            elif tag not in _SKIPPED_TAGS and not tag.startswith(("-", "_", "!")):
+                _walk(child, preserve or tag in _PRESERVE_WHITESPACE_TAGS)
+            child = child.next
+
+    _walk(node, False)
+    return _join_lines("".join(parts))
+
+
+def extract_main_text(html: str, parser: str = "auto") -> str:
+    """Main content of a ReadTheDocs page, same text as clean_readthedocs_html(html, features="html.parser")."""
+    parser = available_parser() if parser == "auto" else parser
+    if parser == "lexbor":
+        return _lexbor_main_text(html)
+    if parser in ("lxml", "html.parser"):
+        return _soup_main_text(html, parser)
+    raise ValueError(f"unsupported html parser={parser}, expected one of {PARSERS}")
+
+
+class TextCache:
+    """Extracted texts on disk, keyed by the hash of the page file."""
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.txt")
+
+    def get(self, key: str) -> Optional[str]:
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, key: str, text: str) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+
+def _read(path: str) -> Tuple[bytes, str]:
+    # content of a page file and its cache key
+    with open(path, "rb") as f:
+        data = f.read()
+    return data, hashlib.sha256(data + f"\x00{EXTRACTION_VERSION}".encode()).hexdigest()
+
+
+def _parse_file(path: str, parser: str, cache_dir: Optional[str], encoding: Optional[str],
+                errors: Optional[str]) -> Tuple[str, str]:
+    # runs in the pool workers
+    data, key = _read(path)
+    # decoded like open(path, encoding=encoding, errors=errors).read() would, newlines included
+    text = extract_main_text(io.TextIOWrapper(io.BytesIO(data), encoding=encoding, errors=errors).read(), parser)
+    if cache_dir:
+        TextCache(cache_dir).set(key, text)
+    return path, text
+
+
+def iter_readthedocs_documents_parallel(path: str, workers: Optional[int] = None, cache_dir: Optional[str] = None,
+                                        parser: str = "auto", encoding: Optional[str] = None,
+                                        errors: Optional[str] = None) -> Iterator[Document]:
+    """
+    Same documents as iter_readthedocs_documents(path) (with html.parser), parsed
+    by `workers` processes (default one per cpu) and yielded as they are ready.
+    Pages found in the cache are yielded first, the pool is only started when
+    at least MIN_FILES_FOR_POOL pages have to be parsed.
+    """
+    workers = workers or os.cpu_count() or 1
+    parser = available_parser() if parser == "auto" else parser
+    files = [str(p) for p in Path(path).rglob("*") if not p.is_dir()]
+    logger.info(f"loading {len(files)} files from {path} with {workers} workers, parser={parser}, "
+                f"cache_dir={cache_dir or None}")
+    st = time.time()
+    to_parse = files
+    if cache_dir:
+        cache, to_parse = TextCache(cache_dir), []
+        for file in files:
+            text = cache.get(_read(file)[1])
+            if text is None:
+                to_parse.append(file)
+                continue
+            registry.inc("html_pages_cached_total")
+            yield Document(page_content=text, metadata={"source": file})
+    if workers <= 1 or len(to_parse) < MIN_FILES_FOR_POOL:
+        for file in to_parse:
+            source, text = _parse_file(file, parser, cache_dir, encoding, errors)
+            registry.inc("html_pages_parsed_total")
+            yield Document(page_content=text, metadata={"source": source})
+    else:
+        # spawned rather than forked, the ingestion pipeline already runs threads
+        with ProcessPoolExecutor(max_workers=min(workers, len(to_parse)), mp_context=mp.get_context("spawn")) as pool:
+            remaining = iter(to_parse)
+            pending = set()
+            while True:
+                # a bounded number of files ahead, the consumer may be slower than the parsing
+                for file in remaining:
+                    pending.add(pool.submit(_parse_file, file, parser, cache_dir, encoding, errors))
+                    if len(pending) >= workers * FILES_IN_FLIGHT_PER_WORKER:
+                        break
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    source, text = future.result()
+                    registry.inc("html_pages_parsed_total")
+                    yield Document(page_content=text, metadata={"source": source})
+    logger.info(f"{len(files)} files loaded in {time.time() - st:.2f}s, {len(files) - len(to_parse)} from the cache, "
+                f"{len(to_parse)} parsed")
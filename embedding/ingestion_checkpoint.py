@@ -0,0 +1,194 @@
+"""
+Durable progress of the ingestion job, so a restarted job skips the pages a
+previous run already finished instead of starting over.
+
+A page (source) is finished once every chunk the manifest planned for it is
+indexed. It is then appended to a jsonl checkpoint file with the hash of its
+text, flushed and fsynced, so a killed job loses at most the pages that were
+in flight. On start every *.jsonl file of the checkpoint directory is read
+(one file per processing job instance, the instances of a ShardedByS3Key job
+share the directory through S3) and a page is skipped when its text has the
+same hash as the checkpointed one.
+
+The entries are only valid for the index and the chunking they were written
+for: every entry carries a scope (index name and uuid, embeddings model, chunk
+size and overlap) and the entries of other scopes are ignored. A page whose
+chunks were rejected by the cluster or whose embeddings kept failing is not
+checkpointed and is processed again by the next run.
+"""
+import os
+import json
+import time
+import socket
+import logging
+import threading
+from typing import Dict, List, Optional
+from langchain.docstore.document import Document
+from ingestion_manifest import content_hash
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# written by SageMaker in every processing job container
+RESOURCE_CONFIG_FILE = "/opt/ml/config/resourceconfig.json"
+
+
+def current_host() -> str:
+    try:
+        with open(RESOURCE_CONFIG_FILE) as f:
+            return json.load(f)["current_host"]
+    except (OSError, ValueError, KeyError):
+        return socket.gethostname()
+
+
+def host_count() -> int:
+    """Number of instances of the processing job, 1 outside of sagemaker."""
+    try:
+        with open(RESOURCE_CONFIG_FILE) as f:
+            return len(json.load(f)["hosts"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return 1
+
+
+def checkpoint_scope(index_name: str, index_uuid: str, embeddings_model: str, chunk_size: int,
+                     chunk_overlap: int) -> str:
+    return f"{index_name}/{index_uuid}/{embeddings_model}/{chunk_size}/{chunk_overlap}"
+
+
+class IngestionCheckpoint:
+    """
+    Args:
+        checkpoint_dir: where this instance writes its checkpoint file, the files found there are loaded.
+        input_dirs: more directories to load checkpoint files from, e.g. those of a previous job.
+        name: name of the checkpoint file of this instance, the host name by default.
+    """
+
+    def __init__(self, checkpoint_dir: str, input_dirs: Optional[List[str]] = None, name: Optional[str] = None):
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.path = os.path.join(checkpoint_dir, f"{name or current_host()}.jsonl")
+        # scope -> source -> entry
+        self._entries: Dict[str, Dict[str, Dict]] = {}
+        for directory in [checkpoint_dir] + list(input_dirs or []):
+            self._load(directory)
+        self.scope: Optional[str] = None
+        self._lock = threading.Lock()
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def _load(self, directory: str) -> None:
+        if not os.path.isdir(directory):
+            return
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith(".jsonl"):
+                continue
+            loaded = 0
+            with open(os.path.join(directory, name), encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line of a killed job may be cut
+                        continue
+                    self._entries.setdefault(entry["scope"], {})[entry["source"]] = entry
+                    loaded += 1
+            logger.info(f"{loaded} checkpoint entries loaded from {os.path.join(directory, name)}")
+
+    def completed(self, source: str, text_hash: str) -> Optional[Dict]:
+        """The checkpoint entry of the source when it was finished with this text, None otherwise."""
+        if self.scope is None:
+            return None
+        entry = self._entries.get(self.scope, {}).get(source)
+        return entry if entry is not None and entry["hash"] == text_hash else None
+
+    def mark_completed(self, source: str, text_hash: str, chunks: int, stale_ids: List[str]) -> None:
+        if self.scope is None:
+            # only pages without chunks can finish before the index is created, nothing to save there
+            return
+        entry = {"scope": self.scope, "source": source, "hash": text_hash, "chunks": chunks,
+                 # deleted at the end of the run, a resumed run still has to delete them
+                 "stale_ids": stale_ids, "time": round(time.time(), 3)}
+        with self._lock:
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._entries.setdefault(self.scope, {})[source] = entry
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+class SourceTracker:
+    """
+    Chunks of every source still waiting to be indexed, a source is
+    checkpointed when the last one is indexed. Chunks are identified by their
+    chunk id, which is also the id of their document in the index.
+    """
+
+    def __init__(self, checkpoint: Optional[IngestionCheckpoint] = None):
+        self.checkpoint = checkpoint
+        self._lock = threading.Lock()
+        # source -> [text hash, chunks, pending chunk ids, stale ids, failed]
+        self._sources: Dict[str, list] = {}
+        self._source_of: Dict[str, str] = {}
+        self.skipped = 0
+        self.completed = 0
+        self.failed = 0
+
+    def skip(self, doc: Document) -> Optional[Dict]:
+        """The checkpoint entry when the page was already finished, it is then not processed again."""
+        if self.checkpoint is None:
+            return None
+        entry = self.checkpoint.completed(doc.metadata["source"], content_hash(doc.page_content))
+        if entry is not None:
+            with self._lock:
+                self.skipped += 1
+            registry.inc("ingestion_sources_skipped_total")
+        return entry
+
+    def start(self, doc: Document, to_index: List[Document], stale_ids: List[str]) -> None:
+        """Called with the chunks of a page that go through the pipeline, before they are embedded."""
+        source = doc.metadata["source"]
+        pending = {chunk.metadata["chunk_id"] for chunk in to_index}
+        with self._lock:
+            self._sources[source] = [content_hash(doc.page_content), len(to_index), pending, stale_ids, False]
+            for _id in pending:
+                self._source_of[_id] = source
+        if not pending:
+            # nothing new or changed in that page
+            self._finish(source)
+
+    def indexed(self, chunk_id: str, ok: bool) -> None:
+        with self._lock:
+            source = self._source_of.pop(chunk_id, None)
+            if source is None:
+                return
+            state = self._sources[source]
+            state[2].discard(chunk_id)
+            state[4] = state[4] or not ok
+            done = not state[2]
+        if done:
+            self._finish(source)
+
+    def failed_chunks(self, chunks: List[Document]) -> None:
+        """Chunks that could not be embedded, their sources are not checkpointed."""
+        for chunk in chunks:
+            self.indexed(chunk.metadata["chunk_id"], False)
+
+    def _finish(self, source: str) -> None:
+        with self._lock:
+            text_hash, chunks, _, stale_ids, failed = self._sources.pop(source)
+            if failed:
+                self.failed += 1
+            else:
+                self.completed += 1
+        if failed:
+            registry.inc("ingestion_sources_failed_total")
+            return
+        registry.inc("ingestion_sources_completed_total")
+        if self.checkpoint is not None:
+            self.checkpoint.mark_completed(source, text_hash, chunks, stale_ids)
+
+    def progress(self) -> str:
+        with self._lock:
+            return (f"sources: {self.completed} completed, {self.skipped} skipped, {self.failed} failed, "
+                    f"{len(self._sources)} in flight")
@@ -0,0 +1,93 @@
+"""
+Content addressed chunk ids and a manifest of what is already in the index,
+used to re-ingest only new or changed chunks.
+
+A chunk id is derived from the source path, the chunk offset in the source,
+the hash of the chunk text and the embeddings model, so re-running the job on
+unchanged documents produces the same ids. The manifest is read back from the
+index itself (ids and sources only, no vectors) which keeps it correct even
+when several processing job instances write to the same index.
+"""
+import copy
+import hashlib
+import logging
+from typing import Dict, Iterable, List, Set, Tuple
+from langchain.docstore.document import Document
+from opensearchpy import OpenSearch
+from opensearchpy.helpers import scan
+
+logger = logging.getLogger(__name__)
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def chunk_id(source: str, offset: int, text_hash: str, embeddings_model: str) -> str:
+    key = f"{source}\x00{offset}\x00{text_hash}\x00{embeddings_model}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:40]
+
+
+def split_documents_with_ids(text_splitter, docs: Iterable[Document], embeddings_model: str) -> List[Document]:
+    """
+    Same as text_splitter.create_documents but every chunk gets its offset in
+    the source document, its content hash and a deterministic chunk id in the metadata.
+    """
+    chunks = []
+    for doc in docs:
+        cursor = 0
+        for i, text in enumerate(text_splitter.split_text(doc.page_content)):
+            offset = doc.page_content.find(text, cursor)
+            if offset == -1:
+                # the splitter may have altered the text, fall back to the chunk position
+                offset = -(i + 1)
+            else:
+                cursor = offset + 1
+            metadata = copy.deepcopy(doc.metadata)
+            metadata['chunk_offset'] = offset
+            metadata['content_hash'] = content_hash(text)
+            metadata['chunk_id'] = chunk_id(metadata.get('source', ''), offset, metadata['content_hash'], embeddings_model)
+            chunks.append(Document(page_content=text, metadata=metadata))
+    return chunks
+
+
+class IndexManifest:
+    """Ids of the chunks already in the index, grouped by source."""
+
+    def __init__(self, ids_by_source: Dict[str, Set[str]] = None, simhashes: Dict[str, str] = None):
+        self.ids_by_source = ids_by_source or {}
+        # chunk id -> simhash metadata of the chunks indexed with the near-duplicate filter on
+        self.simhashes = simhashes or {}
+
+    @classmethod
+    def from_index(cls, client: OpenSearch, index_name: str) -> "IndexManifest":
+        ids_by_source: Dict[str, Set[str]] = {}
+        simhashes: Dict[str, str] = {}
+        for hit in scan(client, index=index_name, size=1000,
+                        query={"_source": ["metadata.source", "metadata.simhash"], "query": {"match_all": {}}}):
+            metadata = hit.get("_source", {}).get("metadata", {})
+            ids_by_source.setdefault(metadata.get("source", ""), set()).add(hit["_id"])
+            if metadata.get("simhash"):
+                simhashes[hit["_id"]] = metadata["simhash"]
+        logger.info(f"manifest of index={index_name}: {sum(len(ids) for ids in ids_by_source.values())} chunks "
+                    f"from {len(ids_by_source)} sources")
+        return cls(ids_by_source, simhashes)
+
+    def plan_source(self, source: str, chunks: List[Document]) -> Tuple[List[Document], List[str]]:
+        """
+        Returns the chunks of one source that need to be embedded and indexed
+        and the ids of that source that are no longer produced.
+        """
+        indexed = self.ids_by_source.get(source, set())
+        current = set()
+        to_index = []
+        for chunk in chunks:
+            _id = chunk.metadata['chunk_id']
+            if _id not in indexed and _id not in current:
+                to_index.append(chunk)
+            current.add(_id)
+        return to_index, list(indexed - current)
+
+    def ids_of_missing_sources(self, seen_sources: Set[str]) -> List[str]:
+        """Ids of all the sources that were not seen in this run."""
+        return [_id for source, ids in self.ids_by_source.items() if source not in seen_sources for _id in ids]
@@ -0,0 +1,273 @@
+"""
+Streaming ingestion pipeline: documents flow through stages (load -> split ->
+embed -> index) connected by bounded queues, every stage runs in its own
+worker threads so parsing, embedding and indexing overlap and memory is
+bounded by the queue sizes instead of the corpus size.
+
+A stage is a function taking an iterator of input items and yielding output
+items, so it can be 1:1, 1:n (split) or n:1 (batching). The workers of a stage
+pull the next item as soon as they are done with the previous one, so a slow
+item only holds up its own worker. Throughput (overall and since the previous
+report), queue depth and the time taken to produce an item (waits on the input
+queue and on a full output queue excluded) of every stage are logged
+periodically and returned at the end.
+"""
+import time
+import queue
+import random
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar
+from langchain.docstore.document import Document
+from metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+# marks the end of a queue, one is sent per consumer
+_DONE = object()
+
+T = TypeVar("T")
+
+
+def retry_with_backoff(fn: Callable[[], T], max_retries: int = 3, initial_backoff: float = 1.0,
+                       max_backoff: float = 30.0, description: str = "work unit") -> T:
+    """
+    Calls fn until it succeeds, at most max_retries + 1 times, sleeping an
+    exponential backoff with jitter between attempts. The last error is raised.
+    """
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except Exception as e:
+            if attempt >= max_retries:
+                raise
+            delay = min(max_backoff, initial_backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+            logger.warning(f"{description} failed, attempt={attempt + 1}/{max_retries + 1}, "
+                           f"retrying in {delay:.2f} seconds, error={e}")
+            time.sleep(delay)
+            attempt += 1
+
+
+def clean_readthedocs_html(data: str, **bs_kwargs) -> str:
+    """Main content of a ReadTheDocs page, same extraction as langchain's ReadTheDocsLoader."""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(data, **bs_kwargs)
+    text = soup.find_all("main", {"id": "main-content"})
+    if len(text) == 0:
+        text = soup.find_all("div", {"role": "main"})
+    if len(text) != 0:
+        text = text[0].get_text()
+    else:
+        text = ""
+    return "\n".join([t for t in text.split("\n") if t])
+
+
+def iter_readthedocs_documents(path: str, encoding: Optional[str] = None, errors: Optional[str] = None,
+                               **bs_kwargs) -> Iterator[Document]:
+    """Like ReadTheDocsLoader(path).load() but yields the documents one at a time."""
+    for p in Path(path).rglob("*"):
+        if p.is_dir():
+            continue
+        with open(p, encoding=encoding, errors=errors) as f:
+            text = clean_readthedocs_html(f.read(), **bs_kwargs)
+        yield Document(page_content=text, metadata={"source": str(p)})
+
+
+def _units(item: Any) -> int:
+    # a count is taken as is, a batch (or a tuple starting with one) counts as its
+    # number of chunks, anything else as one
+    if isinstance(item, int):
+        return item
+    if isinstance(item, tuple) and len(item) > 0 and isinstance(item[0], list):
+        return len(item[0])
+    return len(item) if isinstance(item, list) else 1
+
+
+class StageStats:
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.units = 0
+        self.started = None
+        self.finished = None
+        self.item_seconds = Histogram()
+        self._lock = threading.Lock()
+
+    def record(self, item: Any, seconds: Optional[float] = None) -> None:
+        with self._lock:
+            self.items += 1
+            self.units += _units(item)
+        if seconds is not None:
+            self.item_seconds.observe(max(seconds, 0.0))
+
+    @property
+    def elapsed(self) -> float:
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def as_dict(self) -> Dict[str, Any]:
+        elapsed = self.elapsed
+        return {"stage": self.name, "workers": self.workers, "items": self.items, "units": self.units,
+                "seconds": round(elapsed, 2),
+                "units_per_second": round(self.units / elapsed, 2) if elapsed > 0 else 0.0,
+                "item_seconds_p50": round(self.item_seconds.quantile(0.5), 4),
+                "item_seconds_p95": round(self.item_seconds.quantile(0.95), 4)}
+
+
+class Pipeline:
+    """
+    Args:
+        source: iterable feeding the first stage, consumed in its own thread.
+        stages: (name, function, number of workers) for every stage, in order.
+        queue_size: maximum number of items waiting between two stages.
+        report_interval: seconds between two progress log lines.
+        progress: returns extra text for the progress log lines, e.g. the checkpointed sources.
+    """
+
+    def __init__(self,
+                 source: Iterable,
+                 stages: List[Tuple[str, Callable[[Iterator], Iterator], int]],
+                 source_name: str = "load",
+                 queue_size: int = 8,
+                 report_interval: float = 30.0,
+                 progress: Optional[Callable[[], str]] = None):
+        self.source = source
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self.stats = [StageStats(source_name, 1)] + [StageStats(name, workers) for name, _, workers in stages]
+        self.report_interval = report_interval
+        self.progress = progress
+        # (time, units) of every stage at the previous report
+        self._last_report = [(time.time(), 0) for _ in self.stats]
+        self._stop = threading.Event()
+        self._errors: List[BaseException] = []
+        self._remaining = [workers for _, _, workers in stages]
+        self._lock = threading.Lock()
+
+    def _put(self, q: queue.Queue, item: Any) -> None:
+        # never block forever, a failed stage downstream must not deadlock its producers
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def _iter_queue(self, q: queue.Queue, waited: Optional[List[float]] = None) -> Iterator:
+        # the time spent waiting for input is added to waited[0]
+        while not self._stop.is_set():
+            st = time.perf_counter()
+            try:
+                item = q.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            finally:
+                if waited is not None:
+                    waited[0] += time.perf_counter() - st
+            if item is _DONE:
+                return
+            yield item
+
+    def _close(self, index: int) -> None:
+        """Signals the end of the input of stage `index` to all its workers."""
+        if index < len(self.stages):
+            for _ in range(self.stages[index][2]):
+                self._put(self.queues[index], _DONE)
+
+    def _fail(self, e: BaseException) -> None:
+        logger.error(f"ingestion pipeline stage failed, error={e}")
+        with self._lock:
+            self._errors.append(e)
+        self._stop.set()
+
+    def _run_source(self) -> None:
+        stats = self.stats[0]
+        stats.started = time.time()
+        try:
+            last = time.perf_counter()
+            for item in self.source:
+                if self._stop.is_set():
+                    break
+                stats.record(item, time.perf_counter() - last)
+                self._put(self.queues[0], item)
+                last = time.perf_counter()
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            stats.finished = time.time()
+            self._close(0)
+
+    def _run_worker(self, index: int) -> None:
+        _, fn, _ = self.stages[index]
+        stats = self.stats[index + 1]
+        with self._lock:
+            if stats.started is None:
+                stats.started = time.time()
+        waited = [0.0]
+        try:
+            last = time.perf_counter()
+            for item in fn(self._iter_queue(self.queues[index], waited)):
+                stats.record(item, time.perf_counter() - last - waited[0])
+                waited[0] = 0.0
+                if index + 1 < len(self.stages):
+                    self._put(self.queues[index + 1], item)
+                last = time.perf_counter()
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            with self._lock:
+                self._remaining[index] -= 1
+                last = self._remaining[index] == 0
+            if last:
+                stats.finished = time.time()
+                self._close(index + 1)
+
+    def report(self) -> None:
+        parts = []
+        now = time.time()
+        for i, stats in enumerate(self.stats):
+            depth = f", queue={self.queues[i].qsize()}" if i < len(self.queues) else ""
+            last_time, last_units = self._last_report[i]
+            recent = (stats.units - last_units) / (now - last_time) if now > last_time else 0.0
+            self._last_report[i] = (now, stats.units)
+            parts.append(f"{stats.name}: {stats.units} units, "
+                         f"{stats.units / stats.elapsed if stats.elapsed > 0 else 0.0:.1f}/s, now {recent:.1f}/s, "
+                         f"p95={stats.item_seconds.quantile(0.95) * 1000:.0f}ms/item{depth}")
+        if self.progress is not None:
+            parts.append(self.progress())
+        logger.info("pipeline progress | " + " | ".join(parts))
+
+    def run(self) -> List[Dict[str, Any]]:
+        threads = [threading.Thread(target=self._run_source, name="stage-source", daemon=True)]
+        for index, (name, _, workers) in enumerate(self.stages):
+            threads.extend(threading.Thread(target=self._run_worker, args=(index,), name=f"stage-{name}-{i}", daemon=True)
+                           for i in range(workers))
+        for thread in threads:
+            thread.start()
+        last_report = time.time()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(timeout=0.5)
+                if time.time() - last_report >= self.report_interval:
+                    self.report()
+                    last_report = time.time()
+        self.report()
+        if self._errors:
+            raise self._errors[0]
+        return [stats.as_dict() for stats in self.stats]
+
+
+def batched(items: Iterator, batch_size: int) -> Iterator[List]:
+    """Groups a stream of items into lists of batch_size items."""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,222 @@
+"""
+In-process latency histograms and throughput counters.
+
+- stage("embed") times a block into the stage_seconds histogram and, while a
+  request is being served, into the timings of that request (they are
+  returned in the Server-Timing header).
+- registry.inc() counts units of work (documents, chunks, endpoint calls...).
+- registry.as_dict() / registry.prometheus() render everything for a metrics
+  endpoint or the end of a job.
+- sampled() tells whether the current request is one whose payloads (query,
+  documents, prompt, answer) are logged, so the hot path only pays for
+  verbose logging on a small share of the requests.
+
+The same module is used by the lambda app and the embedding job.
+"""
+import os
+import time
+import bisect
+import random
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# share of the requests logged in full, 1.0 logs every request
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "0.01"))
+
+
+class Histogram:
+    """Fixed buckets, the quantiles are interpolated within a bucket like Prometheus does."""
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q: float) -> float:
+        with self._lock:
+            counts, count = list(self.counts), self.count
+        if count == 0:
+            return 0.0
+        rank, cumulative = q * count, 0
+        for i, n in enumerate(counts):
+            if n and cumulative + n >= rank:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                low = self.buckets[i - 1] if i > 0 else 0.0
+                return low + (self.buckets[i] - low) * (rank - cumulative) / n
+            cumulative += n
+        return self.buckets[-1]
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            count, total = self.count, self.sum
+        return {"count": count, "sum": round(total, 6), "mean": round(total / count, 6) if count else 0.0,
+                "p50": round(self.quantile(0.5), 6), "p95": round(self.quantile(0.95), 6),
+                "p99": round(self.quantile(0.99), 6)}
+
+
+def _labels_key(labels: Dict[str, Any]) -> Tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._histograms: Dict[Tuple[str, Tuple], Histogram] = {}
+        self._counters: Dict[Tuple[str, Tuple], float] = {}
+        self._started = time.time()
+        self._lock = threading.Lock()
+
+    def histogram(self, name: str, **labels) -> Histogram:
+        key = (name, _labels_key(labels))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram())
+        return histogram
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        self.histogram(name, **labels).observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def counter(self, name: str, **labels) -> float:
+        return self._counters.get((name, _labels_key(labels)), 0)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+            self._started = time.time()
+
+    def as_dict(self) -> Dict[str, Any]:
+        # counters come with their rate since the start (or the last reset)
+        elapsed = max(time.time() - self._started, 1e-9)
+        with self._lock:
+            histograms, counters = list(self._histograms.items()), list(self._counters.items())
+        return {"uptime_seconds": round(elapsed, 2),
+                "histograms": [dict(name=name, labels=dict(labels), **histogram.as_dict())
+                               for (name, labels), histogram in sorted(histograms, key=lambda x: x[0])],
+                "counters": [{"name": name, "labels": dict(labels), "value": value,
+                              "per_second": round(value / elapsed, 3)}
+                             for (name, labels), value in sorted(counters)]}
+
+    def prometheus(self) -> str:
+        """Text exposition format, histograms in seconds."""
+        def _fmt(labels: Tuple, extra: Tuple = ()) -> str:
+            pairs = list(labels) + list(extra)
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}" if pairs else ""
+
+        with self._lock:
+            histograms, counters = sorted(self._histograms.items(), key=lambda x: x[0]), sorted(self._counters.items())
+        lines, typed = [], set()
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            with histogram._lock:
+                counts, count, total = list(histogram.counts), histogram.count, histogram.sum
+            cumulative = 0
+            for bound, n in zip(histogram.buckets, counts):
+                cumulative += n
+                lines.append(f"{name}_bucket{_fmt(labels, (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_bucket{_fmt(labels, (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_fmt(labels)} {total}")
+            lines.append(f"{name}_count{_fmt(labels)} {count}")
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{_fmt(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+class Timings:
+    """Stage durations of one request, in the order the stages ran."""
+
+    def __init__(self, route: str = "", sampled: Optional[bool] = None):
+        self.route = route
+        self.sampled = random.random() < LOG_SAMPLE_RATE if sampled is None else sampled
+        self.started = time.perf_counter()
+        self.stages: List[Tuple[str, float]] = []
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.stages.append((name, seconds))
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def totals(self) -> Dict[str, float]:
+        # a stage that ran several times is reported once with its total
+        totals: Dict[str, float] = {}
+        with self._lock:
+            for name, seconds in self.stages:
+                totals[name] = totals.get(name, 0.0) + seconds
+        return totals
+
+    def server_timing(self, total: Optional[float] = None) -> str:
+        parts = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.totals().items()]
+        if total is not None:
+            parts.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(parts)
+
+
+_current_timings: contextvars.ContextVar = contextvars.ContextVar("timings", default=None)
+
+
+def start_timings(route: str = "", sampled: Optional[bool] = None) -> Tuple[Timings, Any]:
+    """Timings of a new request, pass the returned token to end_timings once it is served."""
+    timings = Timings(route, sampled)
+    return timings, _current_timings.set(timings)
+
+
+def end_timings(token: Any) -> None:
+    _current_timings.reset(token)
+
+
+def current_timings() -> Optional[Timings]:
+    return _current_timings.get()
+
+
+def sampled() -> bool:
+    timings = _current_timings.get()
+    if timings is not None:
+        return timings.sampled
+    return random.random() < LOG_SAMPLE_RATE
+
+
+@contextmanager
+def stage(name: str, histogram: str = "stage_seconds", **labels) -> Iterator[None]:
+    """Times the block into `histogram` (labelled with the stage and the route) and the request timings."""
+    st = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - st
+        timings = _current_timings.get()
+        if timings is not None:
+            timings.add(name, elapsed)
+            if timings.route:
+                labels.setdefault("route", timings.route)
+        registry.observe(histogram, elapsed, stage=name, **labels)
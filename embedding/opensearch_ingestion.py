@@ -5,26 +5,37 @@ import sys
 #  as in the dockerfile we copy the helper code into this folder so here we need to add its path 
 #  so the Python import can find the helper code
 sys.path.append('/opt/ml/processing/image_code/')
-from embedding_helper import create_sagemaker_embeddings_from_js_model
+from embedding_helper import EMBEDDING_CACHE_DIR, EMBEDDING_CACHE_MAX_MB, create_sagemaker_embeddings_from_js_model
+from ingestion_manifest import IndexManifest, split_documents_with_ids
+from ingestion_pipeline import Pipeline, batched, retry_with_backoff
+from ingestion_checkpoint import IngestionCheckpoint, SourceTracker, checkpoint_scope, current_host, host_count
+from chunk_dedup import DEDUP_CACHE_SIZE, EmbeddingDeduplicator, NearDuplicateFilter, seen_simhashes
+from html_loader import PARSERS, iter_readthedocs_documents_parallel
+from bulk_indexer import BulkIndexer
+from faiss_export import FaissExporter, FAISS_INDEX_TYPES
+from vector_quantization import ENCODINGS, KNN_ENGINES, RESCORE_FIELD, VectorEncoding, encoding_from_mapping
+from bulk_load import (BULK_LOAD_SETTINGS, check_alias, finish_bulk_load, fresh_index_name, restore_settings,
+                       settings_after_load, start_bulk_load, swap_alias)
+from metrics import registry
 
 import glob
 import time
 import json
 import logging
 import argparse
+import threading
 import numpy as np
-import multiprocessing as mp
 from itertools import repeat
 from functools import partial
 import sagemaker, boto3, json
-from typing import List, Tuple
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+from urllib.parse import urlparse
 from sagemaker.session import Session
 # from credentials import get_credentials
 from opensearchpy.client import OpenSearch
-from langchain.document_loaders import ReadTheDocsLoader
-from langchain.vectorstores import OpenSearchVectorSearch
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from opensearchpy import OpenSearch, RequestsHttpConnection
+from opensearchpy.exceptions import RequestError
 from requests_aws4auth.aws4auth import AWS4Auth
 
 
@@ -36,40 +47,161 @@ logger = logging.getLogger()
 logging.basicConfig(format='%(asctime)s,%(module)s,%(processName)s,%(levelname)s,%(message)s', level=logging.INFO, stream=sys.stderr)
 
 region = 'ap-southeast-2'
-ssm = boto3.client('ssm', region_name=region)
-access_key = ssm.get_parameter(Name='ACCESS_KEY', WithDecryption=True)['Parameter']['Value']
-secret_key = ssm.get_parameter(Name='SECRET_KEY', WithDecryption=True)['Parameter']['Value']
 service = 'es'
 
-aws4auth = AWS4Auth(access_key, secret_key, region, service)
-def check_if_index_exists(index_name:str, region: str, host:str, http_auth) -> OpenSearch:
-    aos_client = OpenSearch(
-        hosts = [{'host': host.replace("https://", ""), 'port': 443}],
+def get_aws4auth() -> AWS4Auth:
+    # fetched when the job starts rather than at import time so the helpers
+    # in this module can be imported (e.g. by the benchmarks) without SSM access
+    ssm = boto3.client('ssm', region_name=region)
+    access_key = ssm.get_parameter(Name='ACCESS_KEY', WithDecryption=True)['Parameter']['Value']
+    secret_key = ssm.get_parameter(Name='SECRET_KEY', WithDecryption=True)['Parameter']['Value']
+    return AWS4Auth(access_key, secret_key, region, service)
+
+def create_opensearch_client(host:str, http_auth, pool_maxsize:int = 10) -> OpenSearch:
+    # one client per job, its keep-alive connection pool is shared by all the bulk requests
+    url = urlparse(host if "://" in host else f"https://{host}")
+    use_ssl = url.scheme == "https"
+    return OpenSearch(
+        hosts = [{'host': url.hostname, 'port': url.port or (443 if use_ssl else 80)}],
         http_auth = http_auth,
-        use_ssl = True,
-        verify_certs = True,
+        use_ssl = use_ssl,
+        verify_certs = use_ssl,
+        timeout = 300,
+        pool_maxsize = pool_maxsize,
         connection_class = RequestsHttpConnection
     )
+
+def check_if_index_exists(index_name:str, region: str, host:str, http_auth) -> OpenSearch:
+    aos_client = create_opensearch_client(host, http_auth)
     exists = aos_client.indices.exists(index_name)
     logger.info(f"index_name={index_name}, exists={exists}")
     return exists
 
-def process_shard(shard, embeddings_model_endpoint_name:str, aws_region:str, os_index_name:str, os_domain_ep:str, os_http_auth) -> int: 
-    logger.info(f'Starting process_shard of {len(shard)} chunks.')
-    st = time.time()
-    embeddings = create_sagemaker_embeddings_from_js_model(embeddings_model_endpoint_name, aws_region)
-    docsearch = OpenSearchVectorSearch(index_name=os_index_name,
-                                       embedding_function=embeddings,
-                                       opensearch_url=os_domain_ep,
-                                       timeout = 300,
-                                       use_ssl = True,
-                                       verify_certs = True,
-                                       connection_class = RequestsHttpConnection,
-                                       http_auth=os_http_auth)    
-    docsearch.add_documents(documents=shard)
-    et = time.time() - st
-    logger.info(f'Shard completed in {et} seconds.')
-    return 0
+def create_knn_index(aos_client: OpenSearch, index_name:str, dim:int, encoding: Optional[VectorEncoding] = None,
+                     m:int = 16, ef_construction:int = 512, ef_search:int = 512, engine: Optional[str] = None,
+                     settings: Optional[Dict] = None) -> None:
+    # with the default float32 encoding and hnsw parameters this is the same
+    # k-NN mapping langchain's OpenSearchVectorSearch creates, the encoding is
+    # kept in _meta so the query side can encode its vectors the same way.
+    # settings are more index settings, e.g. {"index.number_of_shards": 2}
+    encoding = encoding or VectorEncoding()
+    properties = {"vector_field": {"type": "knn_vector", "dimension": dim,
+                                   **encoding.knn_method(m, ef_construction, engine)}}
+    if encoding.rescore:
+        # binary fields are neither indexed nor in doc values, only in _source
+        properties[RESCORE_FIELD] = {"type": "binary"}
+    index_settings = {"knn": True, "knn.algo_param.ef_search": ef_search}
+    for key, value in (settings or {}).items():
+        index_settings[key[len("index."):] if key.startswith("index.") else key] = value
+    mapping = {
+        "settings": {"index": index_settings},
+        "mappings": {"_meta": encoding.to_meta(), "properties": properties},
+    }
+    try:
+        aos_client.indices.create(index=index_name, body=mapping)
+    except RequestError as e:
+        # another processing job instance may have created it in the meantime
+        if e.error != "resource_already_exists_exception":
+            raise
+    logger.info(f"created index={index_name} with dimension={dim}, {encoding}, "
+                f"{encoding.bytes_per_vector(dim)} vector bytes per document, settings={index_settings}")
+
+def get_index_encoding(aos_client: OpenSearch, index_name:str) -> VectorEncoding:
+    return encoding_from_mapping(aos_client.indices.get_mapping(index=index_name))
+
+def get_index_uuid(aos_client: OpenSearch, index_name:str) -> str:
+    # changes when the index is deleted and created again, the response is keyed by the concrete index name
+    response = aos_client.indices.get(index=index_name)
+    return next(iter(response.values()))["settings"]["index"]["uuid"]
+
+# pipeline stages, each one takes an iterator over its input and yields its output
+def split_stage(docs: Iterator, text_splitter, manifest: IndexManifest, embeddings_model:str,
+                seen_sources: Set[str], ids_to_delete: List[str], batch_size:int,
+                tracker: Optional[SourceTracker] = None,
+                near_duplicates: Optional[NearDuplicateFilter] = None) -> Iterator[List]:
+    tracker = tracker or SourceTracker()
+    def _new_or_changed_chunks():
+        for doc in docs:
+            source = doc.metadata['source']
+            seen_sources.add(source)
+            entry = tracker.skip(doc)
+            if entry is not None:
+                # finished by a previous run, which may have died before deleting its stale chunks
+                ids_to_delete.extend(entry['stale_ids'])
+                continue
+            # add a custom metadata field, such as timestamp
+            doc.metadata['timestamp'] = time.time()
+            doc.metadata['embeddings_model'] = embeddings_model
+            chunks = split_documents_with_ids(text_splitter, [doc], embeddings_model)
+            to_index, stale_ids = manifest.plan_source(source, chunks)
+            ids_to_delete.extend(stale_ids)
+            if near_duplicates is not None:
+                # the stale chunks of the page are deleted, an edit near the top of the page re-ids the
+                # unchanged chunks below it and they must not be dropped as near duplicates of their old ids
+                near_duplicates.forget(seen_simhashes(manifest.simhashes.get(_id) for _id in stale_ids))
+                # boilerplate close to a chunk of another page is not indexed at all
+                to_index = near_duplicates.filter(to_index)
+            tracker.start(doc, to_index, stale_ids)
+            yield from to_index
+    yield from batched(_new_or_changed_chunks(), batch_size)
+
+def embed_stage(batches: Iterator[List], embeddings, max_retries:int = 0, initial_backoff:float = 1.0,
+                tracker: Optional[SourceTracker] = None,
+                deduplicator: Optional[EmbeddingDeduplicator] = None) -> Iterator[Tuple[List, np.ndarray]]:
+    # the engine already retries throttled requests, a batch is retried as a whole on any other
+    # error, when it keeps failing its pages are left for the next run rather than failing the job
+    embed = embeddings.embed_documents
+    if deduplicator is not None:
+        # chunks with the same text (after normalization) share one vector, it is embedded once
+        embed = partial(deduplicator.embed_documents, embed=embeddings.embed_documents)
+    for batch in batches:
+        texts = [chunk.page_content for chunk in batch]
+        try:
+            vectors = retry_with_backoff(partial(embed, texts), max_retries, initial_backoff,
+                                         description=f"embedding of a batch of {len(batch)} chunks")
+        except Exception as e:
+            if tracker is None:
+                raise
+            logger.error(f"giving up on a batch of {len(batch)} chunks from "
+                         f"{len({chunk.metadata['source'] for chunk in batch})} sources, error={e}")
+            registry.inc("ingestion_batches_failed_total")
+            tracker.failed_chunks(batch)
+            continue
+        yield batch, vectors
+
+def make_index_stage(indexer: Optional[BulkIndexer], index_exists:bool, exporter: Optional[FaissExporter] = None,
+                     tracker: Optional[SourceTracker] = None, on_index_created=None,
+                     index_options: Optional[Dict] = None):
+    lock = threading.Lock()
+    state = {'index_exists': index_exists}
+    tracker = tracker or SourceTracker()
+
+    def _create_index_once(vectors: np.ndarray) -> None:
+        # the index is created with the dimension of the first vectors we get,
+        # they are also the sample the int8 scale of byte vectors is taken from
+        with lock:
+            if not state['index_exists']:
+                indexer.encoding.calibrate(vectors)
+                create_knn_index(indexer.client, indexer.index_name, vectors.shape[1], indexer.encoding,
+                                 **(index_options or {}))
+                state['index_exists'] = True
+                if on_index_created is not None:
+                    on_index_created()
+
+    def index_stage(embedded_batches: Iterator[Tuple[List, np.ndarray]]) -> Iterator[int]:
+        if exporter is not None:
+            embedded_batches = exporter.tee(embedded_batches)
+        if indexer is None:
+            for chunks, _ in embedded_batches:
+                for chunk in chunks:
+                    tracker.indexed(chunk.metadata['chunk_id'], True)
+                yield len(chunks)
+            return
+        for ok in indexer.index_embedded_batches(embedded_batches, before_first=_create_index_once,
+                                                 on_result=tracker.indexed):
+            if ok:
+                yield 1
+    return index_stage
 
 
 if __name__ == "__main__":
@@ -81,8 +213,73 @@ if __name__ == "__main__":
     parser.add_argument("--chunk-size-for-doc-split", type=int, default=200)
     parser.add_argument("--chunk-overlap-for-doc-split", type=int, default=30)
     parser.add_argument("--input-data-dir", type=str, default="/opt/ml/processing/input_data")
+    # number of embedding workers, each one keeps up to --embeddings-max-in-flight requests in flight
     parser.add_argument("--process-count", type=int, default=1)
+    parser.add_argument("--bulk-size", type=int, default=MAX_OS_DOCS_PER_PUT)
+    parser.add_argument("--bulk-max-in-flight", type=int, default=2)
+    parser.add_argument("--pipeline-queue-size", type=int, default=8)
+    parser.add_argument("--embeddings-batch-size", type=int, default=5)
+    parser.add_argument("--embeddings-max-in-flight", type=int, default=4)
     parser.add_argument("--create-index-hint-file", type=str, default="_create_index_hint")
+    # only safe when this instance sees the whole corpus, i.e. not with ShardedByS3Key across several instances
+    parser.add_argument("--delete-missing-sources", action="store_true")
+    # where the vectors go, the faiss artifact is what the query API loads for vectordb_type=faiss
+    parser.add_argument("--vector-store", type=str, default="opensearch", choices=["opensearch", "faiss", "both"])
+    parser.add_argument("--faiss-output-dir", type=str, default="/opt/ml/processing/output/faiss")
+    parser.add_argument("--faiss-index-type", type=str, default="hnsw", choices=list(FAISS_INDEX_TYPES))
+    # number of PQ sub-quantizers and PCA output dimension (0 keeps all dimensions) of the faiss index
+    parser.add_argument("--faiss-pq-m", type=int, default=64)
+    parser.add_argument("--faiss-pca-dim", type=int, default=0)
+    # how new opensearch indexes store the vectors, existing indexes keep the encoding they were created with
+    parser.add_argument("--vector-encoding", type=str, default="float32", choices=list(ENCODINGS))
+    # keep an fp16 copy of every vector outside of the k-NN index to rescore the candidates of quantized searches
+    parser.add_argument("--store-rescore-vectors", action="store_true")
+    # processes parsing the html pages (0 is one per cpu), the parser is the fastest one installed by default
+    parser.add_argument("--parse-workers", type=int, default=0)
+    parser.add_argument("--html-parser", type=str, default="auto", choices=list(PARSERS))
+    # extracted page texts by file hash, e.g. a directory synced with s3 between runs, empty disables the cache
+    parser.add_argument("--html-cache-dir", type=str, default="")
+    # how new indexes are created, an existing index keeps its engine, hnsw graphs and shards (0 is the cluster default)
+    parser.add_argument("--knn-engine", type=str, default="", choices=[""] + list(KNN_ENGINES))
+    parser.add_argument("--hnsw-m", type=int, default=16)
+    parser.add_argument("--hnsw-ef-construction", type=int, default=512)
+    parser.add_argument("--hnsw-ef-search", type=int, default=512)
+    parser.add_argument("--index-shards", type=int, default=0)
+    # replicas of the index once loaded, -1 keeps those of an existing index and the cluster default for a new one
+    parser.add_argument("--index-replicas", type=int, default=-1)
+    # refresh and replicas off while loading, then restored, segments force-merged down to
+    # --force-merge-segments per shard (0 skips it) and optionally the k-NN graphs loaded in memory
+    parser.add_argument("--bulk-load", action="store_true")
+    parser.add_argument("--force-merge-segments", type=int, default=1)
+    parser.add_argument("--knn-warmup", action="store_true")
+    # loads a new index (--fresh-index-name, <index name>-<utc time> by default) and then points the
+    # --opensearch-index-name alias to it, the whole corpus has to be in this instance
+    parser.add_argument("--fresh-index", action="store_true")
+    parser.add_argument("--fresh-index-name", type=str, default="")
+    # the indexes the alias pointed to before, or the index of that name from before the fresh index mode
+    parser.add_argument("--delete-previous-index", action="store_true")
+    # finished pages are appended to <dir>/<host>.jsonl and skipped by the next run, e.g. a directory
+    # uploaded continuously to s3, the input dir holds the checkpoints of a previous job, empty disables it
+    parser.add_argument("--checkpoint-dir", type=str, default="")
+    parser.add_argument("--checkpoint-input-dir", type=str, default="")
+    # retries of a batch of chunks whose embedding failed with something else than throttling
+    parser.add_argument("--unit-max-retries", type=int, default=3)
+    parser.add_argument("--unit-initial-backoff", type=float, default=2.0)
+    # chunks of different pages with the same text are embedded once, the vectors of the last
+    # --dedup-cache-size distinct texts are kept for the texts seen again later
+    parser.add_argument("--no-dedup", dest="dedup", action="store_false")
+    parser.add_argument("--dedup-cache-size", type=int, default=DEDUP_CACHE_SIZE)
+    # chunks within --near-duplicate-max-distance bits (simhash) of a chunk already kept are not indexed
+    parser.add_argument("--near-duplicate-filter", action="store_true")
+    parser.add_argument("--near-duplicate-max-distance", type=int, default=3)
+    # persistent cache of the embeddings by endpoint and text, in a <dir>/<host> sub-directory so the caches
+    # of several instances can be uploaded to the same s3 prefix, the caches of the other sub-directories and
+    # of the input dir (e.g. the upload of a previous job) are read on a miss, empty disables it
+    parser.add_argument("--embedding-cache-dir", type=str, default=EMBEDDING_CACHE_DIR)
+    parser.add_argument("--embedding-cache-input-dir", type=str, default="")
+    parser.add_argument("--embedding-cache-max-mb", type=int, default=EMBEDDING_CACHE_MAX_MB)
+    # stage stats and embedding latency histograms of the run as json, e.g. in /opt/ml/processing/output
+    parser.add_argument("--metrics-output-file", type=str, default="")
     args, _ = parser.parse_known_args()
 
     logger.info("Received arguments {}".format(args))
@@ -90,9 +287,6 @@ if __name__ == "__main__":
     files = glob.glob(os.path.join(args.input_data_dir, "*.*"))
     logger.info(f"there are {len(files)} files to process in the {args.input_data_dir} folder")
 
-
-
-    loader = ReadTheDocsLoader(args.input_data_dir)
     text_splitter = RecursiveCharacterTextSplitter(
         # Set a really small chunk size, just to show.
         chunk_size=args.chunk_size_for_doc_split,
@@ -100,61 +294,213 @@ if __name__ == "__main__":
         length_function=len,
     )
 
-    st = time.time()
-    logger.info('Loading documents...')
-    docs = loader.load()
+    t1 = time.time()
 
+    use_opensearch = args.vector_store in ("opensearch", "both")
+    use_faiss = args.vector_store in ("faiss", "both")
 
-    # add a custom metadata field, such as timestamp
-    for doc in docs:
-        doc.metadata['timestamp'] = time.time()
-        doc.metadata['embeddings_model'] = args.embeddings_model_endpoint_name
-    chunks = text_splitter.create_documents([doc.page_content for doc in docs], metadatas=[doc.metadata for doc in docs])
-    et = time.time() - st
-    logger.info(f'Time taken: {et} seconds. {len(chunks)} chunks generated') 
+    embeddings = create_sagemaker_embeddings_from_js_model(args.embeddings_model_endpoint_name, args.region,
+                                                           batch_size=args.embeddings_batch_size,
+                                                           max_in_flight=args.embeddings_max_in_flight,
+                                                           max_pool_connections=args.process_count * args.embeddings_max_in_flight,
+                                                           cache_dir=os.path.join(args.embedding_cache_dir, current_host())
+                                                           if args.embedding_cache_dir else "",
+                                                           cache_input_dirs=[args.embedding_cache_input_dir,
+                                                                             args.embedding_cache_dir],
+                                                           cache_max_mb=args.embedding_cache_max_mb)
+    embedding_cache = embeddings.cache
 
-    db_shards = (len(chunks) // MAX_OS_DOCS_PER_PUT) + 1
-    print(f'Loading chunks into vector store ... using {db_shards} shards') 
-    st = time.time()
-    shards = np.array_split(chunks, db_shards)
-    
-    t1 = time.time()
+    indexer = None
+    index_exists = False
+    manifest = IndexManifest()
+    index_name = args.opensearch_index_name
+    index_options = {}
+    settings_to_restore = None
+    if use_opensearch:
+        aws4auth = get_aws4auth()
+        # clients are created once and shared by all the workers, their connection
+        # pools are sized for the number of requests that can be in flight
+        aos_client = create_opensearch_client(args.opensearch_cluster_domain, aws4auth,
+                                              pool_maxsize=max(10, args.bulk_max_in_flight))
+        if args.fresh_index:
+            # fails before anything is loaded when the alias could not be swapped at the end
+            check_alias(aos_client, args.opensearch_index_name, args.delete_previous_index)
+            index_name = args.fresh_index_name or fresh_index_name(args.opensearch_index_name)
+            logger.info(f"loading the fresh index={index_name} for alias={args.opensearch_index_name}")
+        index_exists = check_if_index_exists(index_name = index_name, region = args.region, host = args.opensearch_cluster_domain, http_auth = aws4auth)
+        encoding = VectorEncoding(args.vector_encoding, rescore=args.store_rescore_vectors)
+        if index_exists:
+            encoding = get_index_encoding(aos_client, index_name)
+            if encoding.name != args.vector_encoding or encoding.rescore != args.store_rescore_vectors:
+                logger.warning(f"index={index_name} already exists with {encoding}, "
+                               f"--vector-encoding={args.vector_encoding} is ignored")
+        elif args.fresh_index and aos_client.indices.exists(args.opensearch_index_name):
+            previous = get_index_encoding(aos_client, args.opensearch_index_name)
+            if previous.name == encoding.name and previous.scale is not None:
+                # byte vectors keep the int8 scale of the index they replace, queries encoded with it stay right
+                # until the query API reads the mapping of the fresh index
+                encoding.scale = previous.scale
+                logger.info(f"index={index_name} keeps the vector scale={encoding.scale} of alias={args.opensearch_index_name}")
+        indexer = BulkIndexer(aos_client, index_name,
+                              bulk_size=args.bulk_size, max_in_flight=args.bulk_max_in_flight, encoding=encoding)
+
+        index_settings = {}
+        if args.index_shards > 0:
+            index_settings["index.number_of_shards"] = args.index_shards
+        if args.index_replicas >= 0:
+            index_settings["index.number_of_replicas"] = args.index_replicas
+        if args.bulk_load and index_exists:
+            settings_to_restore = settings_after_load(aos_client, index_name,
+                                                      args.index_replicas if args.index_replicas >= 0 else None)
+            start_bulk_load(aos_client, index_name)
+        elif args.bulk_load:
+            # created in bulk-load mode, None restores the defaults
+            settings_to_restore = {"index.refresh_interval": None,
+                                   "index.number_of_replicas": index_settings.get("index.number_of_replicas")}
+            index_settings.update(BULK_LOAD_SETTINGS)
+        index_options = {"m": args.hnsw_m, "ef_construction": args.hnsw_ef_construction,
+                         "ef_search": args.hnsw_ef_search, "engine": args.knn_engine or None,
+                         "settings": index_settings}
+        if not index_exists:
+            # an engine the encoding can not use fails now rather than when the first batch is indexed
+            encoding.knn_method(args.hnsw_m, args.hnsw_ef_construction, args.knn_engine or None)
+
+        if index_exists is False:
+            path = os.path.join(args.input_data_dir, args.create_index_hint_file)
+            logger.info(f"index {index_name} does not exist but {path} file is present so will create index")
+        elif use_faiss:
+            # the faiss artifact is rebuilt from scratch so every chunk has to go through the pipeline
+            logger.info(f"index={index_name} does exists but a faiss export needs all the chunks")
+        else:
+            logger.info(f"index={index_name} does exists, only new or changed chunks will be indexed")
+            manifest = IndexManifest.from_index(aos_client, index_name)
+
+    checkpoint = None
+    set_checkpoint_scope = None
+    if args.checkpoint_dir and use_faiss:
+        # the artifact is built from the chunks of this run only, skipping pages would leave them out
+        logger.warning("--checkpoint-dir is ignored with a faiss export, it needs every chunk")
+    elif args.checkpoint_dir:
+        checkpoint = IngestionCheckpoint(args.checkpoint_dir,
+                                         input_dirs=[args.checkpoint_input_dir] if args.checkpoint_input_dir else None)
+
+        def set_checkpoint_scope():
+            checkpoint.scope = checkpoint_scope(index_name, get_index_uuid(aos_client, index_name),
+                                                args.embeddings_model_endpoint_name,
+                                                args.chunk_size_for_doc_split, args.chunk_overlap_for_doc_split)
+            logger.info(f"checkpointing finished pages to {checkpoint.path}, scope={checkpoint.scope}")
+        # without an index nothing was finished yet, the scope is set once it is created
+        if index_exists:
+            set_checkpoint_scope()
+    tracker = SourceTracker(checkpoint)
+
+    deduplicator = None
+    if args.dedup:
+        deduplicator = EmbeddingDeduplicator(args.dedup_cache_size, batch_size=args.embeddings_batch_size)
+    near_duplicates = None
+    if args.near_duplicate_filter:
+        near_duplicates = NearDuplicateFilter(args.near_duplicate_max_distance,
+                                              seen=seen_simhashes(manifest.simhashes.values()))
+        logger.info(f"near-duplicate filter with max_distance={args.near_duplicate_max_distance}, "
+                    f"{len(manifest.simhashes)} chunks of the index already seen")
+
+    exporter = None
+    if use_faiss:
+        if host_count() > 1:
+            # with ShardedByS3Key every instance would only export its own part of the corpus
+            raise ValueError(f"the faiss export needs the whole corpus on a single instance, this job has "
+                             f"{host_count()}, see processing_job_excutor.py --faiss")
+        logger.info(f"exporting a faiss {args.faiss_index_type} artifact to {args.faiss_output_dir}")
+        exporter = FaissExporter(args.faiss_output_dir, index_type=args.faiss_index_type,
+                                 pq_m=args.faiss_pq_m, pca_dim=args.faiss_pca_dim or None,
+                                 rescore=args.store_rescore_vectors)
+
+    # documents are parsed, split, embedded and indexed as a stream, only
+    # new or changed chunks are embedded and upserted
+    seen_sources = set()
+    ids_to_delete = []
+    pipeline = Pipeline(iter_readthedocs_documents_parallel(args.input_data_dir,
+                                                            workers=args.parse_workers or None,
+                                                            cache_dir=args.html_cache_dir or None,
+                                                            parser=args.html_parser),
+                        [("split", partial(split_stage,
+                                           text_splitter=text_splitter,
+                                           manifest=manifest,
+                                           embeddings_model=args.embeddings_model_endpoint_name,
+                                           seen_sources=seen_sources,
+                                           ids_to_delete=ids_to_delete,
+                                           batch_size=MAX_OS_DOCS_PER_PUT,
+                                           tracker=tracker,
+                                           near_duplicates=near_duplicates), 1),
+                         ("embed", partial(embed_stage, embeddings=embeddings,
+                                           max_retries=args.unit_max_retries,
+                                           initial_backoff=args.unit_initial_backoff,
+                                           tracker=tracker,
+                                           deduplicator=deduplicator), args.process_count),
+                         ("index", make_index_stage(indexer, index_exists, exporter, tracker,
+                                                    on_index_created=set_checkpoint_scope,
+                                                    index_options=index_options), 1)],
+                        queue_size=args.pipeline_queue_size,
+                        progress=tracker.progress)
+    try:
+        stage_stats = pipeline.run()
+    except BaseException:
+        if settings_to_restore is not None and aos_client.indices.exists(index_name):
+            # an existing index must not stay without refresh and replicas
+            restore_settings(aos_client, index_name, settings_to_restore)
+        raise
+    for stats in stage_stats:
+        logger.info(f"stage stats: {stats}")
+    logger.info(tracker.progress())
+    if deduplicator is not None:
+        logger.info(f"dedup: {deduplicator.summary()}")
+    if near_duplicates is not None:
+        logger.info(f"{near_duplicates.dropped} near-duplicate chunks dropped")
+    if embedding_cache is not None:
+        logger.info(f"embedding cache: {embedding_cache.stats()}")
+        embedding_cache.close()
+    if checkpoint is not None:
+        checkpoint.close()
+
+    if exporter is not None:
+        exporter.finalize()
+
+    if indexer is not None:
+        # drop what is no longer produced
+        if args.delete_missing_sources:
+            ids_to_delete.extend(manifest.ids_of_missing_sources(seen_sources))
+        if len(ids_to_delete) > 0:
+            deleted = indexer.delete(ids_to_delete)
+            logger.info(f'{deleted} stale chunks deleted')
+
+        summary = indexer.summary()
+        logger.info(f"{summary['indexed']} chunks indexed, {summary['failed']} rejected")
+        if summary['failed'] > 0:
+            logger.error(f"first rejected chunks: {summary['errors']}")
+
+        created = index_exists or aos_client.indices.exists(index_name)
+        if created and settings_to_restore is not None:
+            finish_bulk_load(aos_client, index_name, settings_to_restore,
+                             max_num_segments=args.force_merge_segments, warmup=args.knn_warmup)
+        elif created:
+            aos_client.indices.refresh(index=index_name)
 
-    index_exists = check_if_index_exists(index_name = args.opensearch_index_name, region = args.region, host = args.opensearch_cluster_domain, http_auth = aws4auth)
-
-    embeddings = create_sagemaker_embeddings_from_js_model(args.embeddings_model_endpoint_name, args.region)
-    
-
-    if index_exists is False:
-        path = os.path.join(args.input_data_dir, args.create_index_hint_file)
-        logger.info(f"index {args.opensearch_index_name} does not exist but {path} file is present so will create index")
-        # by default langchain would create a k-NN index and the embeddings would be ingested as a k-NN vector type
-        docsearch = OpenSearchVectorSearch.from_documents(index_name=args.opensearch_index_name,
-                                                        documents=shards[0],
-                                                        embedding=embeddings,
-                                                        opensearch_url=args.opensearch_cluster_domain,
-                                                        timeout = 300,
-                                                        use_ssl = True,
-                                                        verify_certs = True,
-                                                        connection_class = RequestsHttpConnection,
-                                                        http_auth=aws4auth
-                                                        )
-
-        # we now need to start the loop below for the second shard
-        shard_start_index = 1 
-    else:
-        logger.info(f"index={args.opensearch_index_name} does exists, going to call add_documents")
-        shard_start_index = 0
-
-    with mp.Pool(processes = args.process_count) as pool:
-        results = pool.map(partial(process_shard,
-                                   embeddings_model_endpoint_name=args.embeddings_model_endpoint_name,
-                                   aws_region=args.region,
-                                   os_index_name=args.opensearch_index_name,
-                                   os_domain_ep=args.opensearch_cluster_domain,
-                                   os_http_auth=aws4auth),
-                           shards[shard_start_index:])
+        if args.fresh_index and not created:
+            logger.warning(f"nothing was indexed, alias={args.opensearch_index_name} is left as it is")
+        elif args.fresh_index and (tracker.failed > 0 or summary['failed'] > 0):
+            # the previous index is complete, the fresh one is not
+            logger.error(f"index={index_name} is incomplete, alias={args.opensearch_index_name} is left as it is")
+        elif args.fresh_index:
+            swap_alias(aos_client, args.opensearch_index_name, index_name, delete_previous=args.delete_previous_index)
     t2 = time.time()
     logger.info(f'run time in seconds: {t2-t1:.2f}')
+    job_metrics = {"run_seconds": round(t2 - t1, 2), "stages": stage_stats, "metrics": registry.as_dict()}
+    logger.info(f"metrics: {json.dumps(job_metrics['metrics'])}")
+    if args.metrics_output_file:
+        os.makedirs(os.path.dirname(args.metrics_output_file) or ".", exist_ok=True)
+        with open(args.metrics_output_file, "w") as f:
+            json.dump(job_metrics, f, indent=2)
+    if tracker.failed > 0:
+        # a new run with the same checkpoint directory only redoes these pages
+        logger.error(f"{tracker.failed} sources were not fully indexed")
     logger.info("all done")
-    
\ No newline at end of file
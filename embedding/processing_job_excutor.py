@@ -1,7 +1,9 @@
+import sys
 import boto3
 import logging
-from sagemaker.processing import ScriptProcessor, ProcessingInput
+from sagemaker.processing import ScriptProcessor, ProcessingInput, ProcessingOutput
 import time
+from urllib.parse import urlparse
 from sagemaker.session import Session
 
 
@@ -46,18 +48,92 @@ inputs = [ProcessingInput(source=processing_job_data_input,
                     s3_data_type='S3Prefix',
                     s3_data_distribution_type='ShardedByS3Key')]
 
+# every instance appends the pages it finished to its own checkpoint file, uploaded
+# as it is written, so a job that died can be resumed with --resume: the new job
+# skips the pages any instance of the previous one finished
+checkpoint_s3_uri = f"s3://{urlparse(processing_job_data_input).netloc}/{base_job_name}-checkpoints/{opensearch_index}"
+outputs = [ProcessingOutput(source='/opt/ml/processing/checkpoint',
+                            destination=checkpoint_s3_uri,
+                            s3_upload_mode='Continuous')]
+arguments = ["--checkpoint-dir", "/opt/ml/processing/checkpoint"]
+if "--resume" in sys.argv:
+    # the prefix must not be empty, only resume after a job that checkpointed something
+    inputs.append(ProcessingInput(source=checkpoint_s3_uri,
+                                  destination='/opt/ml/processing/checkpoint_input',
+                                  s3_data_type='S3Prefix',
+                                  s3_data_distribution_type='FullyReplicated'))
+    arguments += ["--checkpoint-input-dir", "/opt/ml/processing/checkpoint_input"]
+logger.info(f"checkpoints in {checkpoint_s3_uri}, resume={'--resume' in sys.argv}")
+
+# every instance keeps the embeddings it computed or reused in <cache dir>/<host>, uploaded at the
+# end of the job, the next job reads the caches of all the instances so unchanged chunk texts
+# (even after re-chunking) are not sent to the embeddings endpoint again
+embedding_cache_s3_uri = f"s3://{urlparse(processing_job_data_input).netloc}/{base_job_name}-embedding-cache/{embedding_endpoint_name}"
+outputs.append(ProcessingOutput(source='/opt/ml/processing/embedding_cache',
+                                destination=embedding_cache_s3_uri,
+                                s3_upload_mode='EndOfJob'))
+arguments += ["--embedding-cache-dir", "/opt/ml/processing/embedding_cache"]
+
+def embedding_cache_input(inputs, arguments):
+    cache_url = urlparse(embedding_cache_s3_uri)
+    if session.client('s3').list_objects_v2(Bucket=cache_url.netloc, Prefix=cache_url.path.lstrip('/'), MaxKeys=1)['KeyCount'] > 0:
+        # an input with an empty prefix fails the job, there is none before the first job
+        inputs.append(ProcessingInput(source=embedding_cache_s3_uri,
+                                      destination='/opt/ml/processing/embedding_cache_input',
+                                      s3_data_type='S3Prefix',
+                                      s3_data_distribution_type='FullyReplicated'))
+        arguments += ["--embedding-cache-input-dir", "/opt/ml/processing/embedding_cache_input"]
+    logger.info(f"embedding cache in {embedding_cache_s3_uri}, previous cache={'--embedding-cache-input-dir' in arguments}")
+
+embedding_cache_input(inputs, arguments)
+
 #run the processing job
 st = time.time()
 processor.run(code="opensearch_ingestion.py",
               inputs=inputs,
-              outputs=[],
+              outputs=outputs,
               arguments=["--opensearch-cluster-domain", opensearch_domain_endpoint,
                          "--opensearch-index-name", opensearch_index,
                          "--region", region,
                          "--embeddings-model-endpoint-name", embedding_endpoint_name,
                          "--input-data-dir", "/opt/ml/processing/input_data",
-                         "--process-count", "2"])
+                         "--process-count", "2"] + arguments)
 time_taken = time.time() - st
 logger.info(f"processing job completed, total time taken={time_taken}s")
 preprocessing_job_description = processor.jobs[-1].describe()
-logger.info(preprocessing_job_description)
\ No newline at end of file
+logger.info(preprocessing_job_description)
+
+# the faiss artifact needs the whole corpus in one index, it is exported by a second job on a
+# single instance with the corpus fully replicated. It runs after the first job uploaded its
+# embedding cache so the chunks are not sent to the embeddings endpoint again
+if "--faiss" in sys.argv:
+    faiss_index_s3_uri = f"s3://{urlparse(processing_job_data_input).netloc}/{base_job_name}-faiss/{opensearch_index}"
+    faiss_processor = ScriptProcessor(role = processing_job_role,
+                                      base_job_name = f"{base_job_name}-faiss",
+                                      image_uri = processing_job_image_uri,
+                                      instance_type = instance_type,
+                                      instance_count = 1,
+                                      command = ['python3'],
+                                      sagemaker_session = sagemaker_session)
+    faiss_inputs = [ProcessingInput(source=processing_job_data_input,
+                                    destination='/opt/ml/processing/input_data',
+                                    s3_data_type='S3Prefix',
+                                    s3_data_distribution_type='FullyReplicated')]
+    faiss_outputs = [ProcessingOutput(source='/opt/ml/processing/output/faiss',
+                                      destination=faiss_index_s3_uri,
+                                      s3_upload_mode='EndOfJob')]
+    # the cache of this job is not uploaded, the one of the opensearch job stays the previous cache
+    faiss_arguments = ["--embedding-cache-dir", "/opt/ml/processing/embedding_cache"]
+    embedding_cache_input(faiss_inputs, faiss_arguments)
+    st = time.time()
+    faiss_processor.run(code="opensearch_ingestion.py",
+                        inputs=faiss_inputs,
+                        outputs=faiss_outputs,
+                        arguments=["--region", region,
+                                   "--embeddings-model-endpoint-name", embedding_endpoint_name,
+                                   "--input-data-dir", "/opt/ml/processing/input_data",
+                                   "--process-count", "2",
+                                   "--vector-store", "faiss",
+                                   "--faiss-output-dir", "/opt/ml/processing/output/faiss"] + faiss_arguments)
+    logger.info(f"faiss export completed, total time taken={time.time() - st}s, "
+                f"set FAISS_INDEX_URI={faiss_index_s3_uri} in the lambda environment")
\ No newline at end of file
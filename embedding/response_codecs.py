@@ -0,0 +1,112 @@
+"""
+Decoding of the SageMaker endpoint responses.
+
+An embeddings response is {"embedding": [[...], ...]}, for a batch of
+4096-dimensional vectors that is hundreds of KB of text. The codecs return
+the embeddings as one contiguous (rows, dim) float32 array:
+
+    json    application/json, parsed with orjson when it is installed (about
+            5x faster than json on these payloads) and copied into the array
+            in one pass over the rows
+    npy     application/x-npy, for endpoints that can return the array in npy
+            format (e.g. with a custom inference script), no text to parse at
+            all. The array is a single copy of the body after its header
+
+The bodies are read with StreamingBody.read, which checks the bytes read
+against the content length of the response, the payloads are never decoded
+to str.
+
+EMBEDDINGS_RESPONSE_CODEC selects the codec of the embedding requests, it
+sets their Accept header. The same module is used by the lambda app and the
+embedding job.
+"""
+import io
+import os
+import json
+import numpy as np
+from itertools import chain
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# "json" or "npy"
+EMBEDDINGS_RESPONSE_CODEC = os.environ.get("EMBEDDINGS_RESPONSE_CODEC", "json")
+
+Body = Union[bytes, bytearray, memoryview, Any]
+
+
+def read_body(body: Body) -> Union[bytes, bytearray]:
+    """All the bytes of a response body, `body` is bytes or a file-like object such as a botocore StreamingBody."""
+    if isinstance(body, (bytes, bytearray)):
+        return body
+    if isinstance(body, memoryview):
+        return body.tobytes()
+    # a botocore StreamingBody raises when fewer bytes than its content length were read
+    return body.read()
+
+
+def loads(body: Body) -> Any:
+    data = read_body(body)
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class JsonCodec:
+    accept = "application/json"
+
+    def decode(self, body: Body) -> Any:
+        return loads(body)
+
+    def decode_embeddings(self, body: Body) -> np.ndarray:
+        rows = loads(body)["embedding"]
+        if len(rows) == 0:
+            return np.empty((0, 0), dtype=np.float32)
+        if not isinstance(rows[0], list):
+            rows = [rows]
+        dim = len(rows[0])
+        if any(len(row) != dim for row in rows):
+            raise ValueError(f"embeddings of different dimensions in one response, {[len(row) for row in rows]}")
+        # fromiter fills the array straight from the floats, without the nested sequence checks of np.asarray
+        return np.fromiter(chain.from_iterable(rows), dtype=np.float32, count=len(rows) * dim).reshape(len(rows), dim)
+
+
+class NpyCodec:
+    accept = "application/x-npy"
+
+    def decode(self, body: Body) -> np.ndarray:
+        return self.decode_embeddings(body)
+
+    def decode_embeddings(self, body: Body) -> np.ndarray:
+        data = read_body(body)
+        stream = io.BytesIO(data)
+        version = np.lib.format.read_magic(stream)
+        read_header = {(1, 0): np.lib.format.read_array_header_1_0,
+                       (2, 0): np.lib.format.read_array_header_2_0}.get(version)
+        if read_header is None:
+            raise ValueError(f"unsupported npy format version={version}")
+        shape, fortran_order, dtype = read_header(stream)
+        count = int(np.prod(shape))
+        if len(data) - stream.tell() < count * dtype.itemsize:
+            raise IOError(f"npy body has {len(data) - stream.tell()} of {count * dtype.itemsize} bytes")
+        array = np.frombuffer(data, dtype=dtype, count=count, offset=stream.tell())
+        array = array.reshape(shape[::-1]).T if fortran_order else array.reshape(shape)
+        # the only copy, out of the body into a writable contiguous float32 array
+        array = np.array(array, dtype=np.float32, order="C")
+        if array.ndim == 1:
+            # a single embedding, one row like the json codec
+            return array.reshape(1, -1)
+        return array.reshape(len(array), -1) if array.ndim != 2 else array
+
+
+CODECS = {"json": JsonCodec(), "npy": NpyCodec()}
+
+
+def get_codec(name: str = EMBEDDINGS_RESPONSE_CODEC):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f"unsupported response codec={name}, expected one of {list(CODECS)}")
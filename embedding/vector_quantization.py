@@ -0,0 +1,129 @@
+"""
+Compact storage of the embeddings in the OpenSearch k-NN index.
+
+The gpt-j-6b embeddings have 4096 dimensions, as float32 knn_vectors the
+HNSW graphs need about 16 KB of native memory per chunk. The index can
+instead store them as
+
+    fp16     faiss engine with the fp16 scalar quantizer, half the memory,
+             the vectors are sent as floats and quantized by the cluster
+    byte     lucene engine byte vectors, a quarter of the memory, the vectors
+             are scaled to int8 here with one scale for all dimensions (so l2
+             distances keep their order up to rounding)
+
+The encoding and its scale are written in the _meta of the index mapping,
+the query side reads them back to encode the query vector the same way.
+
+With rescoring, every document also keeps its vector as base64 fp16 in a
+binary field that is not indexed (disk, not native memory). Queries then
+fetch `RESCORE_OVERSAMPLE` times more candidates from the quantized index
+and re-rank them with exact l2 distances on the fp16 vectors.
+
+The same module is used by the lambda app and the embedding job.
+"""
+import os
+import base64
+import numpy as np
+from typing import Any, Dict, List, Optional, Tuple
+
+ENCODINGS = ("float32", "fp16", "byte")
+KNN_ENGINES = ("nmslib", "faiss", "lucene")
+# binary field with the fp16 vectors used for rescoring
+RESCORE_FIELD = "vector_rescore"
+# candidates fetched per result when rescoring
+RESCORE_OVERSAMPLE = int(os.environ.get("VECTOR_RESCORE_OVERSAMPLE", "4"))
+# share of the values kept inside the int8 range, the rest are clipped
+BYTE_CALIBRATION_PERCENTILE = 99.9
+
+
+class VectorEncoding:
+    """
+    Args:
+        name: one of ENCODINGS.
+        scale: multiplier applied before rounding to int8, only for "byte", set by calibrate().
+        rescore: whether the documents keep their fp16 vectors for rescoring.
+    """
+
+    def __init__(self, name: str = "float32", scale: Optional[float] = None, rescore: bool = False):
+        if name not in ENCODINGS:
+            raise ValueError(f"unsupported vector encoding={name}")
+        self.name = name
+        self.scale = scale
+        self.rescore = rescore
+
+    def __repr__(self) -> str:
+        return f"VectorEncoding(name={self.name}, scale={self.scale}, rescore={self.rescore})"
+
+    @classmethod
+    def from_meta(cls, meta: Optional[Dict]) -> "VectorEncoding":
+        # indexes created before the encodings existed have no _meta, they are float32
+        meta = meta or {}
+        return cls(meta.get("vector_encoding", "float32"), meta.get("vector_scale"), meta.get("vector_rescore", False))
+
+    def to_meta(self) -> Dict[str, Any]:
+        return {"vector_encoding": self.name, "vector_scale": self.scale, "vector_rescore": self.rescore}
+
+    def calibrate(self, vectors: np.ndarray) -> None:
+        """Picks the int8 scale from a sample of the vectors, e.g. the first embedded batch."""
+        if self.name != "byte" or self.scale is not None:
+            return
+        high = float(np.percentile(np.abs(vectors), BYTE_CALIBRATION_PERCENTILE))
+        self.scale = 127.0 / high if high > 0 else 1.0
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        """Values sent in the vector field, one row per vector."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.name == "byte":
+            return np.clip(np.rint(vectors * self.scale), -128, 127).astype(np.int8)
+        return vectors
+
+    def knn_method(self, m: int = 16, ef_construction: int = 512, engine: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Mapping of the vector field for a given dimension is {"type": "knn_vector", "dimension": dim, **this}.
+        float32 vectors can use any engine (nmslib by default), fp16 needs faiss and byte lucene.
+        """
+        parameters = {"ef_construction": ef_construction, "m": m}
+        required = {"fp16": "faiss", "byte": "lucene"}.get(self.name)
+        if engine is not None and required is not None and engine != required:
+            raise ValueError(f"{self.name} vectors need the {required} engine, not {engine}")
+        if self.name == "fp16":
+            parameters["encoder"] = {"name": "sq", "parameters": {"type": "fp16"}}
+            return {"method": {"name": "hnsw", "space_type": "l2", "engine": "faiss", "parameters": parameters}}
+        if self.name == "byte":
+            return {"data_type": "byte",
+                    "method": {"name": "hnsw", "space_type": "l2", "engine": "lucene", "parameters": parameters}}
+        if engine is not None and engine not in KNN_ENGINES:
+            raise ValueError(f"unsupported k-NN engine={engine}, expected one of {KNN_ENGINES}")
+        return {"method": {"name": "hnsw", "space_type": "l2", "engine": engine or "nmslib", "parameters": parameters}}
+
+    def bytes_per_vector(self, dim: int) -> int:
+        return dim * {"float32": 4, "fp16": 2, "byte": 1}[self.name]
+
+
+def pack_rescore_vectors(vectors: np.ndarray) -> List[str]:
+    """fp16 vectors as base64 strings for the RESCORE_FIELD binary field."""
+    packed = np.ascontiguousarray(vectors, dtype=np.float16)
+    return [base64.b64encode(row.tobytes()).decode("ascii") for row in packed]
+
+
+def unpack_rescore_vectors(values: List[str]) -> np.ndarray:
+    return np.stack([np.frombuffer(base64.b64decode(value), dtype=np.float16) for value in values]).astype(np.float32)
+
+
+def rescore(query: np.ndarray, vectors: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Indexes of the k rows of `vectors` closest to the query in l2 and their squared distances, closest first."""
+    query = np.asarray(query, dtype=np.float32).reshape(-1)
+    distances = ((vectors - query) ** 2).sum(axis=1)
+    k = min(k, len(distances))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    top = np.argpartition(distances, k - 1)[:k] if k < len(distances) else np.arange(len(distances))
+    top = top[np.argsort(distances[top])]
+    return top, distances[top]
+
+
+def encoding_from_mapping(response: Dict) -> VectorEncoding:
+    """Encoding of an index from its get_mapping response, the index may be behind an alias."""
+    for index in response.values():
+        return VectorEncoding.from_meta(index.get("mappings", {}).get("_meta"))
+    return VectorEncoding()
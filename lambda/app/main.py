@@ -3,8 +3,10 @@ import subprocess
 from mangum import Mangum
 from fastapi import FastAPI
 from routers.api_v1.api import router
+from routers.api_v1.endpoints.server_timing import ServerTimingMiddleware
 
 app = FastAPI()
+app.add_middleware(ServerTimingMiddleware)
 
 app.include_router(router, prefix="/api/v1")
 
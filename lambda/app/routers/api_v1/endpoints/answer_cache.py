@@ -0,0 +1,120 @@
+"""
+Semantic cache of generated answers for /rag and /text2text.
+
+Every answer is stored together with the (normalised) query embedding and a
+key made of the generation parameters. A later query with the same parameters
+whose embedding has a cosine similarity above the threshold with a stored one
+is answered from the cache, skipping both retrieval and generation.
+
+The embeddings live in a preallocated float32 matrix so the lookup is a single
+matrix-vector product, entries are evicted by age (TTL) and by size (LRU).
+"""
+import os
+import time
+import logging
+import threading
+import numpy as np
+from typing import Any, Dict, Hashable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# cache settings, can be overridden through the lambda environment
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", "512"))
+ANSWER_CACHE_TTL_SECONDS = float(os.environ.get("ANSWER_CACHE_TTL_SECONDS", "3600"))
+ANSWER_CACHE_SIMILARITY_THRESHOLD = float(os.environ.get("ANSWER_CACHE_SIMILARITY_THRESHOLD", "0.97"))
+
+
+class SemanticAnswerCache:
+    """
+    Args:
+        max_entries: maximum number of answers kept, the least recently used
+            one is evicted when the cache is full.
+        ttl_seconds: answers older than this are never served.
+        similarity_threshold: minimum cosine similarity between the query
+            embedding and a stored one for a hit.
+    """
+
+    def __init__(self,
+                 max_entries: int = 512,
+                 ttl_seconds: float = 3600,
+                 similarity_threshold: float = 0.97):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # the embedding matrix is allocated on the first insert, once the dimension is known
+        self._vectors: Optional[np.ndarray] = None
+        self._param_ids = np.zeros(max_entries, dtype=np.int64)
+        self._created = np.zeros(max_entries, dtype=np.float64)
+        self._last_used = np.zeros(max_entries, dtype=np.float64)
+        self._valid = np.zeros(max_entries, dtype=bool)
+        self._values: List[Optional[Dict[str, Any]]] = [None] * max_entries
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def lookup(self, params_key: Hashable, embedding) -> Optional[Dict[str, Any]]:
+        """Returns the cached value of the most similar query with the same parameters, if any."""
+        query = self._normalize(embedding)
+        now = time.time()
+        with self._lock:
+            if self._vectors is None or self._vectors.shape[1] != query.shape[0]:
+                self.misses += 1
+                return None
+            candidates = self._valid & (self._param_ids == hash(params_key)) & (now - self._created <= self.ttl_seconds)
+            if not candidates.any():
+                self.misses += 1
+                return None
+            similarities = np.where(candidates, self._vectors @ query, -np.inf)
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.similarity_threshold:
+                self.misses += 1
+                return None
+            self._last_used[best] = now
+            self.hits += 1
+            logger.info(f"answer cache hit, similarity={similarities[best]:.4f}")
+            return self._values[best]
+
+    def store(self, params_key: Hashable, embedding, value: Dict[str, Any]) -> None:
+        vector = self._normalize(embedding)
+        now = time.time()
+        with self._lock:
+            if self._vectors is None or self._vectors.shape[1] != vector.shape[0]:
+                self._vectors = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+                self._valid[:] = False
+            expired = self._valid & (now - self._created > self.ttl_seconds)
+            self._valid &= ~expired
+            if not self._valid.all():
+                slot = int(np.argmin(self._valid))
+            else:
+                slot = int(np.argmin(self._last_used))
+            self._vectors[slot] = vector
+            self._param_ids[slot] = hash(params_key)
+            self._created[slot] = now
+            self._last_used[slot] = now
+            self._valid[slot] = True
+            self._values[slot] = value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._valid[:] = False
+            self._values = [None] * self.max_entries
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": int(self._valid.sum()),
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+answer_cache = SemanticAnswerCache(max_entries=ANSWER_CACHE_MAX_ENTRIES,
+                                   ttl_seconds=ANSWER_CACHE_TTL_SECONDS,
+                                   similarity_threshold=ANSWER_CACHE_SIMILARITY_THRESHOLD)
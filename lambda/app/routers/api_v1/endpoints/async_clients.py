@@ -0,0 +1,152 @@
+"""
+Async clients for the request path, so a slow generation or search does not
+hold the event loop and other requests keep being served while it is in flight.
+
+- AsyncSagemakerRuntime: InvokeEndpoint over one pooled aiohttp session,
+  signed with SigV4 from the boto3 credential chain.
+- get_async_opensearch: AsyncOpenSearch client over aiohttp, signed with the
+  same keys the sync client uses.
+- run_blocking: runs what is left synchronous (langchain chains, in-process
+  faiss search, first time initialisation) on a bounded thread pool.
+
+aiohttp sessions belong to the event loop they were created on, so the clients
+are created per loop.
+"""
+import os
+import json
+import random
+import asyncio
+import contextvars
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+from urllib.parse import quote, urlparse
+import boto3
+from botocore.auth import SigV4Auth
+from botocore.awsrequest import AWSRequest
+from botocore.credentials import Credentials
+from botocore.exceptions import ClientError
+from .config import get_parameter
+from .sagemaker_runtime import SAGEMAKER_RUNTIME_ENDPOINT_URL
+
+logger = logging.getLogger(__name__)
+
+ASYNC_MAX_CONNECTIONS = int(os.environ.get("ASYNC_MAX_CONNECTIONS", "64"))
+ASYNC_REQUEST_TIMEOUT_SECONDS = float(os.environ.get("ASYNC_REQUEST_TIMEOUT_SECONDS", "300"))
+ASYNC_MAX_RETRIES = int(os.environ.get("ASYNC_MAX_RETRIES", "3"))
+# threads available to the remaining synchronous calls
+BLOCKING_EXECUTOR_MAX_WORKERS = int(os.environ.get("BLOCKING_EXECUTOR_MAX_WORKERS", "16"))
+
+_RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+
+_blocking_executor = ThreadPoolExecutor(max_workers=BLOCKING_EXECUTOR_MAX_WORKERS, thread_name_prefix="blocking")
+
+
+async def run_blocking(fn: Callable, *args, **kwargs) -> Any:
+    """Runs a synchronous call on the bounded executor and awaits its result."""
+    loop = asyncio.get_running_loop()
+    # the context goes along so stage timings recorded in the thread land in the current request
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(_blocking_executor, functools.partial(context.run, fn, *args, **kwargs))
+
+
+class AsyncSagemakerRuntime:
+    """
+    Args:
+        region: region of the endpoints.
+        endpoint_url: runtime endpoint, the regional one when None.
+        max_connections: size of the connection pool.
+        timeout: seconds before a call is abandoned.
+        max_retries: retries of throttled or failed (5xx) calls, with jittered backoff.
+    """
+
+    def __init__(self,
+                 region: str,
+                 endpoint_url: Optional[str] = None,
+                 max_connections: int = ASYNC_MAX_CONNECTIONS,
+                 timeout: float = ASYNC_REQUEST_TIMEOUT_SECONDS,
+                 max_retries: int = ASYNC_MAX_RETRIES):
+        self.region = region
+        self.endpoint_url = (endpoint_url or f"https://runtime.sagemaker.{region}.amazonaws.com").rstrip("/")
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self._credentials = boto3.Session().get_credentials()
+        self._sessions: Dict[int, Any] = {}
+
+    def _session(self):
+        import aiohttp
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(id(loop))
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_connections),
+                                            timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self._sessions[id(loop)] = session
+        return session
+
+    def _signed_headers(self, url: str, body: bytes, content_type: str, accept: str) -> Dict[str, str]:
+        if self._credentials is None:
+            raise ValueError("no AWS credentials found to sign the sagemaker runtime request")
+        request = AWSRequest(method="POST", url=url, data=body, headers={"Content-Type": content_type, "Accept": accept})
+        SigV4Auth(self._credentials.get_frozen_credentials(), "sagemaker", self.region).add_auth(request)
+        return dict(request.headers.items())
+
+    @staticmethod
+    def _client_error(status: int, headers: Any, body: bytes) -> ClientError:
+        # same shape as the botocore error so callers can handle both clients alike
+        code = headers.get("x-amzn-ErrorType", "").split(":")[0] or str(status)
+        try:
+            message = json.loads(body).get("message", "")
+        except ValueError:
+            message = body.decode("utf-8", errors="replace")
+        return ClientError({"Error": {"Code": code, "Message": message},
+                            "ResponseMetadata": {"HTTPStatusCode": status}}, "InvokeEndpoint")
+
+    async def invoke_endpoint(self, EndpointName: str, Body: bytes, ContentType: str = "application/json",
+                              Accept: str = "application/json") -> bytes:
+        """Same arguments as the boto3 call, returns the response body."""
+        url = f"{self.endpoint_url}/endpoints/{quote(EndpointName, safe='')}/invocations"
+        for attempt in range(self.max_retries + 1):
+            headers = self._signed_headers(url, Body, ContentType, Accept)
+            async with self._session().post(url, data=Body, headers=headers) as response:
+                body = await response.read()
+                if response.status == 200:
+                    return body
+                error = self._client_error(response.status, response.headers, body)
+            if response.status not in _RETRYABLE_STATUS or attempt == self.max_retries:
+                raise error
+            backoff = min(8.0, 0.25 * 2 ** attempt) * random.uniform(0.5, 1.0)
+            logger.warning(f"endpoint={EndpointName} returned status={response.status}, retrying in {backoff:.2f}s")
+            await asyncio.sleep(backoff)
+
+
+_sagemaker_runtimes: Dict[str, AsyncSagemakerRuntime] = {}
+
+
+def get_async_sagemaker_runtime(region: str) -> AsyncSagemakerRuntime:
+    if region not in _sagemaker_runtimes:
+        _sagemaker_runtimes[region] = AsyncSagemakerRuntime(region, SAGEMAKER_RUNTIME_ENDPOINT_URL or None)
+    return _sagemaker_runtimes[region]
+
+
+_opensearch_clients: Dict[Tuple[int, str], Any] = {}
+
+
+def get_async_opensearch(opensearch_endpoint: str):
+    """AsyncOpenSearch client of the domain, signed with the ACCESS_KEY/SECRET_KEY parameters."""
+    from opensearchpy import AsyncOpenSearch, AsyncHttpConnection, AWSV4SignerAsyncAuth
+    key = (id(asyncio.get_running_loop()), opensearch_endpoint)
+    if key not in _opensearch_clients:
+        url = urlparse(opensearch_endpoint if "://" in opensearch_endpoint else f"https://{opensearch_endpoint}")
+        use_ssl = url.scheme == "https"
+        credentials = Credentials(get_parameter('ACCESS_KEY'), get_parameter('SECRET_KEY'))
+        _opensearch_clients[key] = AsyncOpenSearch(
+            hosts=[{"host": url.hostname, "port": url.port or (443 if use_ssl else 80)}],
+            http_auth=AWSV4SignerAsyncAuth(credentials, get_parameter('REGION')),
+            use_ssl=use_ssl,
+            verify_certs=use_ssl,
+            connection_class=AsyncHttpConnection,
+            maxsize=ASYNC_MAX_CONNECTIONS,
+            timeout=ASYNC_REQUEST_TIMEOUT_SECONDS)
+    return _opensearch_clients[key]
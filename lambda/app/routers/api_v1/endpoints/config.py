@@ -0,0 +1,107 @@
+"""
+Configuration values from the AWS parameter store.
+
+All the parameters the API needs are fetched together with batched
+`get_parameters` calls the first time any of them is used (never at import
+time) and memoized for the life of the container. Optionally a snapshot is
+kept in /tmp so a restarted process in the same container can skip SSM until
+the snapshot expires.
+"""
+import os
+import json
+import time
+import boto3
+import logging
+import threading
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# every parameter used by the API, fetched in one go
+PARAMETER_NAMES: List[str] = [
+    "REGION",
+    "TEXT2TEXT_ENDPOINT_NAME",
+    "EMBEDDING_ENDPOINT_NAME",
+    "OPENSEARCH_DOMAIN_ENDPOINT",
+    "OPENSEARCH_INDEX",
+    "ACCESS_KEY",
+    "SECRET_KEY",
+]
+# get_parameters accepts at most 10 names per call
+SSM_MAX_NAMES_PER_CALL = 10
+
+# snapshot in /tmp is disabled unless a path is given
+CONFIG_SNAPSHOT_PATH = os.environ.get("CONFIG_SNAPSHOT_PATH", "")
+CONFIG_SNAPSHOT_TTL_SECONDS = float(os.environ.get("CONFIG_SNAPSHOT_TTL_SECONDS", "300"))
+
+_parameters: Optional[Dict[str, str]] = None
+_lock = threading.Lock()
+
+
+def _read_snapshot(path: str, ttl: float) -> Optional[Dict[str, str]]:
+    if not path:
+        return None
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - snapshot.get("ts", 0) > ttl or set(PARAMETER_NAMES) - set(snapshot["parameters"]):
+        return None
+    logger.info(f"configuration loaded from snapshot={path}")
+    return snapshot["parameters"]
+
+
+def _write_snapshot(path: str, parameters: Dict[str, str]) -> None:
+    if not path:
+        return
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        # the parameters include credentials, keep the file private to the user
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"ts": time.time(), "parameters": parameters}, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"could not write configuration snapshot={path}, error={e}")
+
+
+def _fetch_from_ssm(names: List[str]) -> Dict[str, str]:
+    ssm = boto3.client('ssm')
+    parameters = {}
+    for i in range(0, len(names), SSM_MAX_NAMES_PER_CALL):
+        response = ssm.get_parameters(Names=names[i:i + SSM_MAX_NAMES_PER_CALL], WithDecryption=True)
+        for parameter in response['Parameters']:
+            parameters[parameter['Name']] = parameter['Value']
+        if response.get('InvalidParameters'):
+            logger.error(f"parameters not found in the parameter store: {response['InvalidParameters']}")
+    logger.info(f"configuration loaded from parameter store, {len(parameters)} parameters")
+    return parameters
+
+
+def load_parameters() -> Dict[str, str]:
+    """Returns all the parameters, fetching them on the first call only."""
+    global _parameters
+    if _parameters is None:
+        with _lock:
+            if _parameters is None:
+                parameters = _read_snapshot(CONFIG_SNAPSHOT_PATH, CONFIG_SNAPSHOT_TTL_SECONDS)
+                if parameters is None:
+                    parameters = _fetch_from_ssm(PARAMETER_NAMES)
+                    _write_snapshot(CONFIG_SNAPSHOT_PATH, parameters)
+                _parameters = parameters
+    return _parameters
+
+
+def get_parameter(name: str) -> str:
+    parameters = load_parameters()
+    if name not in parameters:
+        raise KeyError(f"parameter {name} is not available, is it in the parameter store and in PARAMETER_NAMES?")
+    return parameters[name]
+
+
+def reset() -> None:
+    """Forget the memoized parameters, the next access fetches them again."""
+    global _parameters
+    with _lock:
+        _parameters = None
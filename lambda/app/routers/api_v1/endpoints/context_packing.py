@@ -0,0 +1,258 @@
+"""
+Post-processing of the retrieved chunks before they are stuffed into the prompt.
+
+The ingestion job splits the pages into small overlapping chunks, so a search
+often returns neighbouring chunks of the same page that repeat each other.
+Pasting them all into the flan-t5 prompt makes it longer (slower generation)
+and pushes the end of the context past what the model reads. The retrieved
+candidates go through:
+
+    threshold   candidates scoring below CONTEXT_MIN_SCORE are dropped
+                (vector retrieval only, fused hybrid scores are on another scale)
+    merge       overlapping or adjacent chunks of the same source become one
+                passage, using the chunk offsets written by the ingestion job
+                (or the overlapping text for chunks indexed without offsets)
+    mmr         maximal marginal relevance orders the passages, relevant ones
+                first but not those redundant with what is already picked, on
+                hashed term vectors of the passages, all in numpy
+    budget      the passages are added in that order while they hold at most
+                k chunks together and fit in CONTEXT_TOKEN_BUDGET tokens
+
+The search fetches CONTEXT_CANDIDATES_FACTOR times more chunks than the
+request asks for, so there is something to choose from.
+"""
+import os
+import re
+import zlib
+import logging
+import numpy as np
+from typing import Any, Dict, List, Optional, Tuple
+from langchain.docstore.document import Document
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_PACKING = os.environ.get("CONTEXT_PACKING", "true").lower() == "true"
+# chunks retrieved per requested document
+CONTEXT_CANDIDATES_FACTOR = int(os.environ.get("CONTEXT_CANDIDATES_FACTOR", "2"))
+# 0 keeps every candidate, knn scores are 1 / (1 + squared l2 distance)
+CONTEXT_MIN_SCORE = float(os.environ.get("CONTEXT_MIN_SCORE", "0"))
+# 1 ranks on relevance only, lower values favour diversity
+CONTEXT_MMR_LAMBDA = float(os.environ.get("CONTEXT_MMR_LAMBDA", "0.7"))
+# flan-t5 was trained on 512 token inputs, the question and template are not counted
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "400"))
+
+# metadata key of the retrieval score, set by the searches
+SCORE_FIELD = "score"
+# largest gap between two chunks of a source that are still merged, the separators the splitter dropped
+MERGE_MAX_GAP = 2
+# shortest repeated text that counts as an overlap when the chunks have no offsets
+MIN_TEXT_OVERLAP = 20
+MMR_FEATURES = 1024
+
+_TOKEN = re.compile(r"\w+|[^\w\s]")
+_WORD = re.compile(r"\w+")
+
+
+def count_tokens(text: str) -> int:
+    """Words and punctuation marks, a close estimate of the t5 sentencepiece count on english text."""
+    return len(_TOKEN.findall(text))
+
+
+def _truncate(text: str, max_tokens: int) -> str:
+    ends = [m.end() for m in _TOKEN.finditer(text)]
+    return text if len(ends) <= max_tokens else text[:ends[max_tokens - 1]]
+
+
+def _offset(doc: Document) -> Optional[int]:
+    # split_documents_with_ids writes a negative offset when the chunk was not found verbatim
+    offset = doc.metadata.get("chunk_offset")
+    return offset if isinstance(offset, int) and offset >= 0 else None
+
+
+def _text_overlap(left: str, right: str) -> int:
+    """Length of the longest end of `left` that `right` starts with, 0 below MIN_TEXT_OVERLAP."""
+    for n in range(min(len(left), len(right)) - 1, MIN_TEXT_OVERLAP - 1, -1):
+        if left.endswith(right[:n]):
+            return n
+    return 0
+
+
+class _Passage:
+    """Consecutive chunks of one source, ranked by its best chunk."""
+
+    def __init__(self, doc: Document, rank: int):
+        self.docs = [doc]
+        self.ranks = [rank]
+        self.text = doc.page_content
+        self.start = _offset(doc)
+
+    @property
+    def rank(self) -> int:
+        return min(self.ranks)
+
+    @property
+    def end(self) -> Optional[int]:
+        return None if self.start is None else self.start + len(self.text)
+
+    def append(self, doc: Document, rank: int, overlap: int) -> None:
+        self.text = self.text + doc.page_content[overlap:] if overlap >= 0 else self.text + "\n" + doc.page_content
+        self.docs.append(doc)
+        self.ranks.append(rank)
+
+    def prepend(self, doc: Document, rank: int, overlap: int) -> None:
+        self.text = doc.page_content + self.text[overlap:] if overlap >= 0 else doc.page_content + "\n" + self.text
+        self.docs.insert(0, doc)
+        self.ranks.insert(0, rank)
+        self.start = _offset(doc)
+
+    def score(self) -> Optional[float]:
+        scores = [doc.metadata[SCORE_FIELD] for doc in self.docs if doc.metadata.get(SCORE_FIELD) is not None]
+        return max(scores) if scores else None
+
+    def document(self) -> Document:
+        if len(self.docs) == 1:
+            return self.docs[0]
+        best = self.docs[self.ranks.index(self.rank)]
+        metadata = dict(best.metadata, merged_chunks=len(self.docs))
+        metadata.pop("chunk_id", None)
+        metadata.pop("content_hash", None)
+        metadata.pop("simhash", None)
+        if self.start is not None:
+            metadata["chunk_offset"] = self.start
+        if self.score() is not None:
+            metadata[SCORE_FIELD] = self.score()
+        return Document(page_content=self.text, metadata=metadata)
+
+
+def _try_merge(passage: _Passage, doc: Document, rank: int) -> bool:
+    offset = _offset(doc)
+    if passage.start is not None and offset is not None:
+        end = offset + len(doc.page_content)
+        if passage.start <= offset <= passage.end + MERGE_MAX_GAP and end > passage.end:
+            passage.append(doc, rank, passage.end - offset)
+            return True
+        if offset <= passage.start <= end + MERGE_MAX_GAP and passage.end > end:
+            passage.prepend(doc, rank, end - passage.start)
+            return True
+        # contained in the passage, e.g. the same chunk indexed twice
+        return passage.start <= offset and end <= passage.end
+    if doc.page_content in passage.text:
+        return True
+    overlap = _text_overlap(passage.text, doc.page_content)
+    if overlap:
+        passage.append(doc, rank, overlap)
+        return True
+    overlap = _text_overlap(doc.page_content, passage.text)
+    if overlap:
+        passage.prepend(doc, rank, overlap)
+        return True
+    return False
+
+
+def merge_chunks(docs: List[Document]) -> List[Document]:
+    """
+    Merges the overlapping or adjacent chunks of the same source into one
+    document, in the order of their best ranked chunk. A merged document keeps
+    the metadata of its best chunk, the highest score and merged_chunks.
+    """
+    by_source: Dict[Any, List[_Passage]] = {}
+    passages: List[_Passage] = []
+    # chunks are merged in offset order so a run of neighbours becomes one passage whatever their ranks
+    ranked = sorted(enumerate(docs), key=lambda x: (str(x[1].metadata.get("source")),
+                                                   _offset(x[1]) if _offset(x[1]) is not None else -1, x[0]))
+    for rank, doc in ranked:
+        source = doc.metadata.get("source")
+        candidates = by_source.setdefault(source, []) if source is not None else []
+        if not any(_try_merge(passage, doc, rank) for passage in candidates):
+            passage = _Passage(doc, rank)
+            candidates.append(passage)
+            passages.append(passage)
+    return [passage.document() for passage in sorted(passages, key=lambda p: p.rank)]
+
+
+def _term_vectors(texts: List[str], dim: int = MMR_FEATURES) -> np.ndarray:
+    # l2 normalised bag of hashed words, the dot products are cosine similarities
+    rows, columns = [], []
+    for i, text in enumerate(texts):
+        for word in _WORD.findall(text.lower()):
+            rows.append(i)
+            columns.append(zlib.crc32(word.encode("utf-8")) % dim)
+    vectors = np.zeros((len(texts), dim), dtype=np.float32)
+    np.add.at(vectors, (np.asarray(rows, dtype=np.int64), np.asarray(columns, dtype=np.int64)), 1.0)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _relevance(docs: List[Document]) -> np.ndarray:
+    # min-max normalised scores, the retrieval order when some are missing
+    scores = [doc.metadata.get(SCORE_FIELD) for doc in docs]
+    if not scores:
+        return np.empty(0, dtype=np.float32)
+    if any(score is None for score in scores):
+        return 1.0 - np.arange(len(docs), dtype=np.float32) / max(len(docs), 1)
+    scores = np.asarray(scores, dtype=np.float32)
+    low, high = scores.min(), scores.max()
+    return (scores - low) / (high - low) if high > low else np.ones_like(scores)
+
+
+def mmr_select(relevance: np.ndarray, vectors: np.ndarray, k: int, lambda_mult: float = CONTEXT_MMR_LAMBDA) -> List[int]:
+    """Indexes of up to k rows picked by maximal marginal relevance, in the order they were picked."""
+    n = len(relevance)
+    if n == 0 or k <= 0:
+        return []
+    similarities = vectors @ vectors.T
+    selected = [int(np.argmax(relevance))]
+    # highest similarity of every row to the rows already selected
+    redundancy = similarities[selected[0]].copy()
+    available = np.ones(n, dtype=bool)
+    available[selected[0]] = False
+    while len(selected) < min(k, n):
+        marginal = lambda_mult * relevance - (1.0 - lambda_mult) * redundancy
+        marginal[~available] = -np.inf
+        i = int(np.argmax(marginal))
+        selected.append(i)
+        available[i] = False
+        np.maximum(redundancy, similarities[i], out=redundancy)
+    return selected
+
+
+def pack_context(docs: List[Document], k: int, token_budget: int = CONTEXT_TOKEN_BUDGET,
+                 min_score: Optional[float] = CONTEXT_MIN_SCORE,
+                 lambda_mult: float = CONTEXT_MMR_LAMBDA) -> Tuple[List[Document], Dict[str, int]]:
+    """
+    The documents to stuff into the prompt, out of the retrieved candidates
+    (best first), and the stats of the packing. The documents hold at most k
+    chunks, unless the best passage alone has more. Without packing the prompt
+    would have been the first k candidates, tokens_before counts those.
+    min_score=None disables the threshold.
+    """
+    tokens_before = sum(count_tokens(doc.page_content) for doc in docs[:k])
+    kept = docs
+    if min_score:
+        kept = [doc for doc in docs if doc.metadata.get(SCORE_FIELD) is None or doc.metadata[SCORE_FIELD] >= min_score]
+    passages = merge_chunks(kept)
+    order = mmr_select(_relevance(passages), _term_vectors([doc.page_content for doc in passages]), len(passages),
+                       lambda_mult)
+    packed, tokens, chunks = [], 0, 0
+    for i in order:
+        doc = passages[i]
+        # a merged passage counts as the chunks it is made of
+        size = doc.metadata.get("merged_chunks", 1)
+        if packed and chunks + size > k:
+            continue
+        n = count_tokens(doc.page_content)
+        if tokens + n > token_budget:
+            if packed:
+                # a shorter passage further down may still fit
+                continue
+            # the best passage alone is over the budget, its beginning is kept
+            doc = Document(page_content=_truncate(doc.page_content, token_budget),
+                           metadata=dict(doc.metadata, truncated=True))
+            n = count_tokens(doc.page_content)
+        packed.append(doc)
+        tokens += n
+        chunks += size
+    stats = {"candidates": len(docs), "below_min_score": len(docs) - len(kept),
+             "merged": len(kept) - len(passages), "selected": len(packed),
+             "tokens_before": tokens_before, "tokens_after": tokens, "tokens_saved": tokens_before - tokens}
+    return packed, stats
@@ -0,0 +1,350 @@
+"""
+Persistent on-disk cache of text -> embedding vector, keyed on the embeddings
+model (endpoint name) and the sha256 of the exact text. Shared by the
+ingestion job and the query API (this file is copied as is in both), a text
+that was embedded once is never sent to the endpoint again while it is cached,
+e.g. the chunks a re-chunked corpus has in common with the previous run.
+
+Layout of the cache directory:
+
+    index.sqlite      one row per entry: model, text hash, segment, byte
+                      offset, dimension, crc32 of the vector bytes, time
+                      written and time last used
+    segment-<n>.f32   little endian float32 vectors, appended to and never
+                      overwritten, read through a memory map
+
+Any number of threads and processes can read while one of them writes: the
+index is in WAL mode, a writer takes the sqlite write lock (BEGIN IMMEDIATE)
+before appending to the active segment and the rows it appends are only
+visible to the readers once the transaction commits. A vector whose crc does
+not match (e.g. written before a power loss that the index survived) is a miss.
+
+The vectors are bounded to max_bytes: once over it the oldest segment is
+dropped, the entries of it used since they were written are first copied to
+the active segment (second chance), so frequently used vectors stay.
+The directory must be on a local disk, sqlite's WAL mode does not work on
+network file systems.
+"""
+import os
+import mmap
+import time
+import zlib
+import sqlite3
+import hashlib
+import logging
+import threading
+import numpy as np
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = "index.sqlite"
+# pending last-used times are written with the next put or once there are that many
+TOUCH_FLUSH_SIZE = 256
+# keys per "IN (...)" query, below the 999 variables limit of older sqlite versions
+LOOKUP_BATCH_SIZE = 500
+_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS segments (id INTEGER PRIMARY KEY, bytes INTEGER NOT NULL, created REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS entries (model TEXT NOT NULL, key BLOB NOT NULL, segment INTEGER NOT NULL, "
+    "offset INTEGER NOT NULL, dim INTEGER NOT NULL, crc INTEGER NOT NULL, written REAL NOT NULL, "
+    "last_used REAL NOT NULL, PRIMARY KEY (model, key)) WITHOUT ROWID",
+    "CREATE INDEX IF NOT EXISTS entries_segment ON entries (segment)",
+]
+
+
+def text_key(text: str) -> bytes:
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+class EmbeddingCache:
+    """
+    Args:
+        directory: where the index and the segments are, created if needed.
+        max_bytes: upper bound of the vector bytes kept.
+        read_only: never written to, e.g. the cache of a previous job.
+        fallbacks: more caches looked up on a miss, their hits are copied into this one.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 1 << 30, read_only: bool = False,
+                 fallbacks: Sequence["EmbeddingCache"] = ()):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # a few segments per cache so evicting one drops a small part of it
+        self.segment_bytes = max(max_bytes // 8, 1 << 16)
+        self.read_only = read_only
+        self.fallbacks = list(fallbacks)
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+        self.corrupt = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # segment id -> read-only memory map of the segment file
+        self._maps: Dict[int, mmap.mmap] = {}
+        # (model, key) -> time last used, not written yet
+        self._touched: Dict[Tuple[str, bytes], float] = {}
+        if not read_only:
+            os.makedirs(directory, exist_ok=True)
+            with self._transaction() as db:
+                for statement in _SCHEMA:
+                    db.execute(statement)
+
+    def _connection(self) -> sqlite3.Connection:
+        # one connection per thread, and per process as the job forks its parsers
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(os.path.join(self.directory, INDEX_FILE), timeout=60, isolation_level=None,
+                                 check_same_thread=False)
+            if not self.read_only:
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        db = self._connection()
+        # the write lock is taken now rather than at the first write, so writers never deadlock
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"segment-{segment}.f32")
+
+    def _read(self, segment: int, offset: int, size: int) -> Optional[bytes]:
+        with self._lock:
+            mapped = self._maps.get(segment)
+            if mapped is None or len(mapped) < offset + size:
+                # first read of the segment, or it grew since it was mapped
+                if mapped is not None:
+                    mapped.close()
+                    del self._maps[segment]
+                try:
+                    with open(self._segment_path(segment), "rb") as f:
+                        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except (OSError, ValueError):
+                    # evicted in the meantime
+                    return None
+                self._maps[segment] = mapped
+            # a copy, the map can be closed while the vector is still used
+            return mapped[offset:offset + size] if len(mapped) >= offset + size else None
+
+    def _lookup(self, model: str, keys: List[bytes]) -> Dict[bytes, np.ndarray]:
+        found = {}
+        db = self._connection()
+        for i in range(0, len(keys), LOOKUP_BATCH_SIZE):
+            batch = keys[i:i + LOOKUP_BATCH_SIZE]
+            try:
+                rows = db.execute(f"SELECT key, segment, offset, dim, crc FROM entries WHERE model = ? AND key IN "
+                                  f"({','.join('?' * len(batch))})", [model] + batch).fetchall()
+            except sqlite3.OperationalError as e:
+                # e.g. a read-only cache without an index
+                logger.warning(f"embedding cache {self.directory} lookup failed, error={e}")
+                return found
+            for key, segment, offset, dim, crc in rows:
+                data = self._read(segment, offset, dim * 4)
+                if data is None:
+                    continue
+                if zlib.crc32(data) != crc:
+                    with self._lock:
+                        self.corrupt += 1
+                    continue
+                found[key] = np.array(np.frombuffer(data, dtype="<f4"), dtype=np.float32)
+        return found
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """The cached vector of every text, None for the ones not cached."""
+        keys = [text_key(text) for text in texts]
+        found = self._lookup(model, list(dict.fromkeys(keys)))
+        missing = [key for key in dict.fromkeys(keys) if key not in found]
+        copied = {}
+        for fallback in self.fallbacks:
+            if not missing:
+                break
+            from_fallback = fallback._lookup(model, missing)
+            copied.update(from_fallback)
+            missing = [key for key in missing if key not in from_fallback]
+        found.update(copied)
+        rows = [found.get(key) for key in keys]
+        with self._lock:
+            self.hits += sum(row is not None for row in rows)
+            self.misses += sum(row is None for row in rows)
+            if not self.read_only:
+                now = time.time()
+                for key in found:
+                    self._touched[(model, key)] = now
+                flush = len(self._touched) >= TOUCH_FLUSH_SIZE
+        if copied and not self.read_only:
+            self._store(model, list(copied.items()))
+        elif not self.read_only and flush:
+            with self._transaction() as db:
+                self._flush_touched(db)
+        return rows
+
+    def put_many(self, model: str, texts: List[str], vectors) -> None:
+        if self.read_only or len(texts) == 0:
+            return
+        self._store(model, list({text_key(text): np.asarray(vector, dtype=np.float32)
+                                 for text, vector in zip(texts, vectors)}.items()))
+
+    def _flush_touched(self, db: sqlite3.Connection) -> None:
+        with self._lock:
+            touched, self._touched = self._touched, {}
+        db.executemany("UPDATE entries SET last_used = ? WHERE model = ? AND key = ?",
+                       [(t, model, key) for (model, key), t in touched.items()])
+
+    def _append(self, db: sqlite3.Connection, entries: List[Tuple[str, bytes, bytes]]) -> None:
+        """Appends (model, key, vector bytes) to the active segment, within a write transaction."""
+        row = db.execute("SELECT id, bytes FROM segments ORDER BY id DESC LIMIT 1").fetchone()
+        segment, size = row if row is not None else (None, 0)
+        writes: Dict[int, List[Tuple[int, bytes]]] = {}
+        now = time.time()
+        rows = []
+        for model, key, data in entries:
+            if segment is None or (size > 0 and size + len(data) > self.segment_bytes):
+                if segment is not None:
+                    db.execute("UPDATE segments SET bytes = ? WHERE id = ?", (size, segment))
+                segment = db.execute("INSERT INTO segments (bytes, created) VALUES (0, ?)", (now,)).lastrowid
+                size = 0
+            writes.setdefault(segment, []).append((size, data))
+            # written and last used are the same until the entry is hit again
+            rows.append((model, key, segment, size, len(data) // 4, zlib.crc32(data), now, now))
+            size += len(data)
+        db.execute("UPDATE segments SET bytes = ? WHERE id = ?", (size, segment))
+        # the vectors are in the files before the rows pointing to them are committed
+        for segment, chunks in writes.items():
+            fd = os.open(self._segment_path(segment), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                for offset, data in chunks:
+                    os.pwrite(fd, data, offset)
+            finally:
+                os.close(fd)
+        db.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def _store(self, model: str, vectors: List[Tuple[bytes, np.ndarray]]) -> None:
+        evicted_segments = []
+        with self._transaction() as db:
+            self._flush_touched(db)
+            existing = set()
+            keys = [key for key, _ in vectors]
+            for i in range(0, len(keys), LOOKUP_BATCH_SIZE):
+                batch = keys[i:i + LOOKUP_BATCH_SIZE]
+                existing.update(key for key, in db.execute(
+                    f"SELECT key FROM entries WHERE model = ? AND key IN ({','.join('?' * len(batch))})",
+                    [model] + batch))
+            # another process may have stored some of them since they were looked up
+            new = [(model, key, vector.astype("<f4").tobytes()) for key, vector in vectors if key not in existing]
+            if new:
+                self._append(db, new)
+            evicted_segments = self._evict(db)
+        with self._lock:
+            self.stored += len(new)
+            for segment in evicted_segments:
+                mapped = self._maps.pop(segment, None)
+                if mapped is not None:
+                    mapped.close()
+        for segment in evicted_segments:
+            try:
+                # readers that mapped it keep their map, new lookups no longer point to it
+                os.remove(self._segment_path(segment))
+            except OSError:
+                pass
+
+    def _evict(self, db: sqlite3.Connection) -> List[int]:
+        evicted = []
+        while True:
+            total, count = db.execute("SELECT COALESCE(SUM(bytes), 0), COUNT(*) FROM segments").fetchone()
+            if total <= self.max_bytes or count <= 1:
+                return evicted
+            segment = db.execute("SELECT MIN(id) FROM segments").fetchone()[0]
+            # entries used since they were written get a second chance, at most half a segment
+            # of them so every eviction frees space
+            survivors, size = [], 0
+            for model, key, offset, dim, crc, last_used in db.execute(
+                    "SELECT model, key, offset, dim, crc, last_used FROM entries WHERE segment = ? "
+                    "AND last_used > written ORDER BY last_used DESC", (segment,)):
+                if size + dim * 4 > self.segment_bytes // 2:
+                    break
+                data = self._read(segment, offset, dim * 4)
+                if data is not None and zlib.crc32(data) == crc:
+                    survivors.append((model, key, data))
+                    size += len(data)
+            dropped = db.execute("DELETE FROM entries WHERE segment = ?", (segment,)).rowcount
+            db.execute("DELETE FROM segments WHERE id = ?", (segment,))
+            if survivors:
+                self._append(db, survivors)
+            with self._lock:
+                self.evicted += dropped - len(survivors)
+            evicted.append(segment)
+            logger.info(f"embedding cache {self.directory}: segment {segment} evicted, "
+                        f"{dropped - len(survivors)} entries dropped, {len(survivors)} kept")
+
+    def lookup(self, model: str, texts: List[str]) -> Tuple[List[Optional[np.ndarray]], List[str]]:
+        """The cached vectors of the texts (None when not cached) and the distinct texts to embed."""
+        rows = self.get_many(model, texts)
+        return rows, list(dict.fromkeys(text for text, row in zip(texts, rows) if row is None))
+
+    def fill(self, model: str, texts: List[str], rows: List[Optional[np.ndarray]], missing: List[str],
+             vectors: Sequence) -> List[np.ndarray]:
+        """Stores the vectors of the missing texts and returns the vectors of all the texts."""
+        self.put_many(model, missing, vectors)
+        computed = dict(zip(missing, vectors))
+        return [row if row is not None else np.asarray(computed[text], dtype=np.float32)
+                for text, row in zip(texts, rows)]
+
+    def embed(self, model: str, texts: List[str], embed: Callable[[List[str]], Sequence]) -> List[np.ndarray]:
+        """The vectors of the texts, the ones not cached are embedded with embed (once per distinct text) and stored."""
+        rows, missing = self.lookup(model, texts)
+        if not missing:
+            return rows
+        return self.fill(model, texts, rows, missing, embed(missing))
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "stored": self.stored, "evicted": self.evicted,
+                    "corrupt": self.corrupt, "hit_rate": self.hits / lookups if lookups else 0.0}
+
+    def close(self) -> None:
+        if not self.read_only:
+            if self._touched:
+                with self._transaction() as db:
+                    self._flush_touched(db)
+            # everything in index.sqlite, e.g. before the directory is uploaded
+            self._connection().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        with self._lock:
+            for mapped in self._maps.values():
+                mapped.close()
+            self._maps.clear()
+        db = getattr(self._local, "db", None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+
+
+def open_embedding_cache(directory: str, max_bytes: int = 1 << 30,
+                         input_dirs: Sequence[str] = ()) -> Optional[EmbeddingCache]:
+    """
+    The cache in directory, None when directory is empty. The caches found in
+    input_dirs (or their sub-directories, one per instance of a previous job)
+    are looked up read-only on a miss.
+    """
+    if not directory:
+        return None
+    fallbacks = []
+    for input_dir in input_dirs:
+        if not input_dir or not os.path.isdir(input_dir):
+            continue
+        for path in [input_dir] + sorted(os.path.join(input_dir, name) for name in os.listdir(input_dir)):
+            if os.path.isfile(os.path.join(path, INDEX_FILE)) and os.path.abspath(path) != os.path.abspath(directory):
+                fallbacks.append(EmbeddingCache(path, read_only=True))
+    logger.info(f"embedding cache in {directory}, max_bytes={max_bytes}, "
+                f"{len(fallbacks)} previous caches: {[cache.directory for cache in fallbacks]}")
+    return EmbeddingCache(directory, max_bytes, fallbacks=fallbacks)
@@ -0,0 +1,141 @@
+"""
+In-process vector store backed by the FAISS artifact exported by the
+ingestion job (see embedding/faiss_export.py for the layout).
+
+The index is memory-mapped when its type allows it and the docstore is a
+jsonl file plus an offsets array, both memory-mapped, so only the documents
+that are returned are ever parsed. The artifact is read from a local
+directory (e.g. a Lambda layer) or downloaded once from S3 into /tmp.
+
+When the artifact has the fp16 copy of its vectors (compressed indexes
+exported with rescoring), it is memory-mapped as well and every search
+re-ranks RESCORE_OVERSAMPLE times more candidates on their exact distances.
+"""
+import os
+import json
+import mmap
+import boto3
+import hashlib
+import logging
+import numpy as np
+from typing import Any, Iterable, List, Optional
+from urllib.parse import urlparse
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores.base import VectorStore
+from .vector_quantization import RESCORE_OVERSAMPLE, rescore
+from .context_packing import SCORE_FIELD
+
+logger = logging.getLogger(__name__)
+
+# local directory or s3://bucket/prefix of the artifact
+FAISS_INDEX_URI = os.environ.get("FAISS_INDEX_URI", "/opt/faiss_index")
+FAISS_LOCAL_CACHE_DIR = os.environ.get("FAISS_LOCAL_CACHE_DIR", "/tmp/faiss_index")
+# search time knobs, efSearch for hnsw and nprobe for ivf indexes
+FAISS_EF_SEARCH = int(os.environ.get("FAISS_EF_SEARCH", "64"))
+FAISS_NPROBE = int(os.environ.get("FAISS_NPROBE", "16"))
+
+INDEX_FILE = "index.faiss"
+DOCS_FILE = "docs.jsonl"
+OFFSETS_FILE = "docs.offsets.npy"
+META_FILE = "meta.json"
+RESCORE_FILE = "vectors.f16.npy"
+
+
+def _download_from_s3(uri: str, cache_dir: str) -> str:
+    url = urlparse(uri)
+    local_dir = os.path.join(cache_dir, hashlib.sha256(uri.encode("utf-8")).hexdigest()[:16])
+    if os.path.exists(os.path.join(local_dir, META_FILE)):
+        return local_dir
+    os.makedirs(local_dir, exist_ok=True)
+    s3 = boto3.client("s3")
+    prefix = url.path.lstrip("/").rstrip("/")
+    # meta.json lists the files (older artifacts do not), it is moved in place
+    # last since its presence marks a complete download
+    meta_path = os.path.join(local_dir, META_FILE + ".tmp")
+    s3.download_file(url.netloc, f"{prefix}/{META_FILE}", meta_path)
+    with open(meta_path) as f:
+        files = json.load(f).get("files", [INDEX_FILE, DOCS_FILE, OFFSETS_FILE])
+    for name in files:
+        s3.download_file(url.netloc, f"{prefix}/{name}", os.path.join(local_dir, name))
+    os.replace(meta_path, os.path.join(local_dir, META_FILE))
+    logger.info(f"faiss artifact downloaded from {uri} to {local_dir}")
+    return local_dir
+
+
+class MmapDocstore:
+    """Documents of the artifact, read on demand from the memory-mapped jsonl file."""
+
+    def __init__(self, path: str):
+        self.offsets = np.load(os.path.join(path, OFFSETS_FILE), mmap_mode="r")
+        self._file = open(os.path.join(path, DOCS_FILE), "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def get(self, i: int) -> Document:
+        start = int(self.offsets[i])
+        end = int(self.offsets[i + 1]) if i + 1 < len(self.offsets) else len(self._mmap)
+        entry = json.loads(self._mmap[start:end])
+        return Document(page_content=entry["text"], metadata=entry["metadata"])
+
+
+class FaissVectorStore(VectorStore):
+    def __init__(self, index: Any, docstore: MmapDocstore, embedding_function: Embeddings,
+                 rescore_vectors: Optional[np.ndarray] = None):
+        self.index = index
+        self.docstore = docstore
+        self.embedding_function = embedding_function
+        self.rescore_vectors = rescore_vectors
+
+    @classmethod
+    def load(cls, uri: str, embedding_function: Embeddings) -> "FaissVectorStore":
+        import faiss
+        path = _download_from_s3(uri, FAISS_LOCAL_CACHE_DIR) if uri.startswith("s3://") else uri
+        index_path = os.path.join(path, INDEX_FILE)
+        try:
+            index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+            # not every index type can be memory-mapped (e.g. hnsw)
+            index = faiss.read_index(index_path)
+        parameters = faiss.ParameterSpace()
+        for name, value in (("efSearch", FAISS_EF_SEARCH), ("nprobe", FAISS_NPROBE)):
+            try:
+                parameters.set_index_parameter(index, name, value)
+            except RuntimeError:
+                pass
+        docstore = MmapDocstore(path)
+        rescore_path = os.path.join(path, RESCORE_FILE)
+        rescore_vectors = np.load(rescore_path, mmap_mode="r") if os.path.exists(rescore_path) else None
+        logger.info(f"faiss index loaded from {path}, ntotal={index.ntotal}, docs={len(docstore)}, "
+                    f"rescoring={rescore_vectors is not None}")
+        return cls(index, docstore, embedding_function, rescore_vectors)
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        query = np.asarray(embedding, dtype=np.float32).reshape(1, -1)
+        if self.rescore_vectors is None:
+            distances, ids = self.index.search(query, k)
+            return [self._document(int(i), d) for i, d in zip(ids[0], distances[0]) if i >= 0]
+        _, ids = self.index.search(query, k * RESCORE_OVERSAMPLE)
+        candidates = np.sort(ids[0][ids[0] >= 0])
+        # only the pages of the candidate rows are read from the memory map
+        order, distances = rescore(query, self.rescore_vectors[candidates].astype(np.float32), k)
+        return [self._document(int(candidates[i]), d) for i, d in zip(order, distances)]
+
+    def _document(self, i: int, distance: float) -> Document:
+        # squared l2 distance to the same score as the opensearch l2 space
+        doc = self.docstore.get(i)
+        doc.metadata[SCORE_FIELD] = float(1.0 / (1.0 + distance))
+        return doc
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return self.similarity_search_by_vector(self.embedding_function.embed_query(query), k, **kwargs)
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, **kwargs: Any) -> List[str]:
+        raise NotImplementedError("the faiss artifact is read-only, it is built by the ingestion job")
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None,
+                   **kwargs: Any) -> "FaissVectorStore":
+        raise NotImplementedError("the faiss artifact is built by the ingestion job")
@@ -1,13 +1,8 @@
 import os
-import boto3
 from enum import Enum
+from collections.abc import Mapping
 from pydantic import BaseModel
-
-# fetch value from aws parameter store
-ssm = boto3.client('ssm')
-region = ssm.get_parameter(Name='REGION', WithDecryption=True)['Parameter']['Value']
-text2text_endpoint_name = ssm.get_parameter(Name='TEXT2TEXT_ENDPOINT_NAME', WithDecryption=True)['Parameter']['Value']
-embedding_endpoint_name = ssm.get_parameter(Name='EMBEDDING_ENDPOINT_NAME', WithDecryption=True)['Parameter']['Value']
+from .config import get_parameter
 
 
 class Text2TextModelName(str, Enum):
@@ -18,6 +13,15 @@ class EmbeddingsModelName(str, Enum):
 
 class VectorDBType(str, Enum):
     opensearch = "opensearch"
+    faiss = "faiss"
+
+class RetrievalMode(str, Enum):
+    vector = "vector"
+    hybrid = "hybrid"
+
+class FusionMethod(str, Enum):
+    rrf = "rrf"
+    weighted = "weighted"
 
 class Request(BaseModel):
     query: str
@@ -32,9 +36,31 @@ class Request(BaseModel):
     text_generation_model_name: Text2TextModelName = Text2TextModelName.flan_t5_xl
     embeddings_generation_model_name: EmbeddingsModelName = EmbeddingsModelName.gpt_j_6b
     vectordb_type: VectorDBType = VectorDBType.opensearch
+    use_cache: bool = True
+    # hybrid runs a lexical and a k-NN query and fuses them, opensearch only
+    retrieval_mode: RetrievalMode = RetrievalMode.vector
+    fusion_method: FusionMethod = FusionMethod.rrf
+    lexical_weight: float = 0.5
+    vector_weight: float = 0.5
+    # answer as server-sent events, tokens are sent as they are generated
+    stream: bool = False
+
+
+class _SagemakerEndpointMapping(Mapping):
+    """model name -> endpoint name, resolved from the parameter store on first use"""
+    _parameter_names = {
+        Text2TextModelName.flan_t5_xl: 'TEXT2TEXT_ENDPOINT_NAME',
+        EmbeddingsModelName.gpt_j_6b: 'EMBEDDING_ENDPOINT_NAME'
+    }
+
+    def __getitem__(self, model_name):
+        return get_parameter(self._parameter_names[model_name])
+
+    def __iter__(self):
+        return iter(self._parameter_names)
+
+    def __len__(self):
+        return len(self._parameter_names)
 
 
-sagemaker_endpoint_mapping = {
-    Text2TextModelName.flan_t5_xl: text2text_endpoint_name,
-    EmbeddingsModelName.gpt_j_6b: embedding_endpoint_name
-}
\ No newline at end of file
+sagemaker_endpoint_mapping = _SagemakerEndpointMapping()
@@ -0,0 +1,276 @@
+"""
+Hybrid retrieval: a lexical (BM25) match query and a k-NN query are sent to
+the same OpenSearch index in one _msearch round trip and their rankings are
+fused, either with reciprocal rank fusion or with a weighted sum of the
+min-max normalised scores.
+
+The lexical side finds exact API names and error strings the embeddings miss,
+so a smaller top-k is enough to get the right chunks into the prompt.
+
+The k-NN queries follow the vector encoding of the index (see
+vector_quantization.py): the query vector is encoded like the documents and,
+when the index keeps fp16 copies of the vectors, more candidates are fetched
+and re-ranked on them.
+"""
+import os
+import logging
+from typing import Any, Dict, List, Optional, Tuple, Union
+from langchain.docstore.document import Document
+from .metrics import sampled
+from .context_packing import SCORE_FIELD
+from .vector_quantization import (RESCORE_FIELD, RESCORE_OVERSAMPLE, VectorEncoding, encoding_from_mapping,
+                                  rescore, unpack_rescore_vectors)
+
+logger = logging.getLogger(__name__)
+
+# number of hits fetched from each side before fusion, at least k
+HYBRID_CANDIDATES = int(os.environ.get("HYBRID_CANDIDATES", "20"))
+# rank constant of reciprocal rank fusion, higher values flatten the rank differences
+HYBRID_RRF_K = int(os.environ.get("HYBRID_RRF_K", "60"))
+
+TEXT_FIELD = "text"
+VECTOR_FIELD = "vector_field"
+METADATA_FIELD = "metadata"
+
+# index or alias name -> the concrete index its mapping was read from and its encoding, read on first use
+_index_encodings: Dict[str, Tuple[str, VectorEncoding]] = {}
+
+
+def _cache_encoding(index_name: str, response: Dict) -> VectorEncoding:
+    encoding = encoding_from_mapping(response)
+    # the response is keyed by the concrete index, an alias can be swapped to another one later
+    concrete_index = next(iter(response), index_name)
+    logger.info(f"index={index_name} ({concrete_index}) vectors are stored with {encoding}")
+    _index_encodings[index_name] = (concrete_index, encoding)
+    return encoding
+
+
+def index_encoding(client: Any, index_name: str) -> VectorEncoding:
+    cached = _index_encodings.get(index_name)
+    if cached is not None:
+        return cached[1]
+    try:
+        response = client.indices.get_mapping(index=index_name)
+    except Exception as e:
+        # not cached, the mapping is read again on the next search
+        logger.warning(f"could not read the mapping of index={index_name}, assuming float32 vectors, error={e}")
+        return VectorEncoding()
+    return _cache_encoding(index_name, response)
+
+
+async def aindex_encoding(client: Any, index_name: str) -> VectorEncoding:
+    """index_encoding with an AsyncOpenSearch client."""
+    cached = _index_encodings.get(index_name)
+    if cached is not None:
+        return cached[1]
+    try:
+        response = await client.indices.get_mapping(index=index_name)
+    except Exception as e:
+        logger.warning(f"could not read the mapping of index={index_name}, assuming float32 vectors, error={e}")
+        return VectorEncoding()
+    return _cache_encoding(index_name, response)
+
+
+def check_concrete_index(index_name: str, hits: List[Dict]) -> None:
+    """
+    Forgets the encoding of index_name when the hits come from another index
+    than the one it was read from, i.e. the alias was swapped to a fresh index
+    (see embedding/bulk_load.py), the next search reads the new mapping.
+    """
+    cached = _index_encodings.get(index_name)
+    if cached is None:
+        return
+    swapped = next((hit["_index"] for hit in hits if hit.get("_index", cached[0]) != cached[0]), None)
+    if swapped is not None:
+        logger.info(f"index={index_name} now points to {swapped} instead of {cached[0]}, its encoding is read again")
+        _index_encodings.pop(index_name, None)
+
+
+def lexical_query(query: str, size: int) -> Dict:
+    return {"size": size,
+            "_source": [TEXT_FIELD, METADATA_FIELD],
+            "query": {"match": {TEXT_FIELD: {"query": query}}}}
+
+
+def knn_query(vector: List[float], size: int, encoding: Optional[VectorEncoding] = None) -> Dict:
+    # same query as OpenSearchVectorSearch's approximate search, without returning the vectors
+    encoding = encoding or VectorEncoding()
+    source = [TEXT_FIELD, METADATA_FIELD]
+    if encoding.rescore:
+        size *= RESCORE_OVERSAMPLE
+        source.append(RESCORE_FIELD)
+    return {"size": size,
+            "_source": source,
+            "query": {"knn": {VECTOR_FIELD: {"vector": encoding.encode(vector).tolist(), "k": size}}}}
+
+
+def knn_hits(hits: List[Dict], vector: List[float], size: int, encoding: Optional[VectorEncoding] = None) -> List[Dict]:
+    """Top `size` hits of a knn_query, re-ranked on their exact l2 distances when the index keeps fp16 vectors."""
+    if encoding is None or not encoding.rescore:
+        return hits[:size]
+    hits = [hit for hit in hits if hit["_source"].get(RESCORE_FIELD)]
+    if not hits:
+        return []
+    order, distances = rescore(vector, unpack_rescore_vectors([hit["_source"][RESCORE_FIELD] for hit in hits]), size)
+    rescored = []
+    for i, distance in zip(order, distances):
+        # same score as the l2 space of the k-NN plugin
+        rescored.append(dict(hits[i], _score=float(1.0 / (1.0 + distance))))
+    return rescored
+
+
+def reciprocal_rank_fusion(rankings: List[List[Dict]], weights: List[float], rrf_k: int = HYBRID_RRF_K) -> List[Tuple[float, Dict]]:
+    """Fuses lists of hits by weighted reciprocal rank, best first."""
+    fused: Dict[str, List] = {}
+    for hits, weight in zip(rankings, weights):
+        for rank, hit in enumerate(hits, start=1):
+            entry = fused.setdefault(hit["_id"], [0.0, hit])
+            entry[0] += weight / (rrf_k + rank)
+    return sorted(((score, hit) for score, hit in fused.values()), key=lambda x: -x[0])
+
+
+def weighted_score_fusion(rankings: List[List[Dict]], weights: List[float]) -> List[Tuple[float, Dict]]:
+    """
+    Fuses lists of hits by a weighted sum of their scores, best first. BM25 and
+    k-NN scores are on different scales so they are min-max normalised per list.
+    """
+    fused: Dict[str, List] = {}
+    for hits, weight in zip(rankings, weights):
+        if not hits:
+            continue
+        scores = [hit["_score"] or 0.0 for hit in hits]
+        low, high = min(scores), max(scores)
+        for hit, score in zip(hits, scores):
+            normalised = (score - low) / (high - low) if high > low else 1.0
+            entry = fused.setdefault(hit["_id"], [0.0, hit])
+            entry[0] += weight * normalised
+    return sorted(((score, hit) for score, hit in fused.values()), key=lambda x: -x[0])
+
+
+def _to_documents(hits: List[Dict], scores: Optional[List[float]] = None) -> List[Document]:
+    # the score goes in the metadata, context packing thresholds and ranks on it
+    scores = scores or [hit.get("_score") for hit in hits]
+    return [Document(page_content=hit["_source"].get(TEXT_FIELD, ""),
+                     metadata=dict(hit["_source"].get(METADATA_FIELD) or {}, **{SCORE_FIELD: score}))
+            for hit, score in zip(hits, scores)]
+
+
+def fuse(lexical_hits: List[Dict], knn_hits: List[Dict], k: int, fusion_method: str = "rrf",
+         lexical_weight: float = 0.5, vector_weight: float = 0.5) -> List[Document]:
+    rankings, weights = [lexical_hits, knn_hits], [lexical_weight, vector_weight]
+    if fusion_method == "rrf":
+        fused = reciprocal_rank_fusion(rankings, weights)
+    elif fusion_method == "weighted":
+        fused = weighted_score_fusion(rankings, weights)
+    else:
+        raise ValueError(f"unsupported fusion method={fusion_method}")
+    return _to_documents([hit for _, hit in fused[:k]], [score for score, _ in fused[:k]])
+
+
+def _hybrid_body(index_name: str, query: str, vector: List[float], size: int,
+                 encoding: Optional[VectorEncoding] = None) -> List[Dict]:
+    return [{"index": index_name}, lexical_query(query, size),
+            {"index": index_name}, knn_query(vector, size, encoding)]
+
+
+def _fuse_responses(index_name: str, responses: List[Dict], k: int, fusion_method: str,
+                    lexical_weight: float, vector_weight: float,
+                    vector: List[float], size: int, encoding: Optional[VectorEncoding] = None) -> List[Document]:
+    for response in responses:
+        if "error" in response:
+            raise ValueError(f"hybrid search failed, error={response['error']}")
+    lexical_hits, vector_hits = (response["hits"]["hits"] for response in responses)
+    check_concrete_index(index_name, vector_hits)
+    vector_hits = knn_hits(vector_hits, vector, size, encoding)
+    if sampled():
+        logger.info(f"hybrid search, lexical hits={len(lexical_hits)}, knn hits={len(vector_hits)}, "
+                    f"fusion={fusion_method}, weights=({lexical_weight}, {vector_weight})")
+    return fuse(lexical_hits, vector_hits, k, fusion_method, lexical_weight, vector_weight)
+
+
+def hybrid_similarity_search(vector_db: Any, query: str, k: int = 4, fusion_method: str = "rrf",
+                             lexical_weight: float = 0.5, vector_weight: float = 0.5,
+                             candidates: int = HYBRID_CANDIDATES) -> List[Document]:
+    """
+    Top k documents of `vector_db` (an OpenSearchVectorSearch) for the query,
+    the lexical and the k-NN query run together in one _msearch request.
+    """
+    vector = vector_db.embedding_function.embed_query(query)
+    encoding = index_encoding(vector_db.client, vector_db.index_name)
+    size = max(k, candidates)
+    responses = vector_db.client.msearch(body=_hybrid_body(vector_db.index_name, query, vector, size, encoding))["responses"]
+    return _fuse_responses(vector_db.index_name, responses, k, fusion_method, lexical_weight, vector_weight,
+                           vector, size, encoding)
+
+
+def similarity_search_by_vector(vector_db: Any, vector: List[float], k: int = 4) -> List[Document]:
+    """
+    k-NN search of `vector_db` (an OpenSearchVectorSearch), same results as its
+    similarity_search for float32 indexes, also works with quantized ones.
+    """
+    encoding = index_encoding(vector_db.client, vector_db.index_name)
+    response = vector_db.client.search(index=vector_db.index_name, body=knn_query(vector, k, encoding))
+    check_concrete_index(vector_db.index_name, response["hits"]["hits"])
+    return _to_documents(knn_hits(response["hits"]["hits"], vector, k, encoding))
+
+
+async def asimilarity_search_by_vector(client: Any, index_name: str, vector: List[float], k: int = 4) -> List[Document]:
+    """k-NN search with an AsyncOpenSearch client, same results as similarity_search_by_vector."""
+    encoding = await aindex_encoding(client, index_name)
+    response = await client.search(index=index_name, body=knn_query(vector, k, encoding))
+    check_concrete_index(index_name, response["hits"]["hits"])
+    return _to_documents(knn_hits(response["hits"]["hits"], vector, k, encoding))
+
+
+async def ahybrid_similarity_search(client: Any, index_name: str, query: str, vector: List[float], k: int = 4,
+                                    fusion_method: str = "rrf", lexical_weight: float = 0.5,
+                                    vector_weight: float = 0.5, candidates: int = HYBRID_CANDIDATES) -> List[Document]:
+    """hybrid_similarity_search with an AsyncOpenSearch client and an already computed query embedding."""
+    encoding = await aindex_encoding(client, index_name)
+    size = max(k, candidates)
+    response = await client.msearch(body=_hybrid_body(index_name, query, vector, size, encoding))
+    return _fuse_responses(index_name, response["responses"], k, fusion_method, lexical_weight, vector_weight,
+                           vector, size, encoding)
+
+
+def msearch_similarity_search(vector_db: Any, searches: List[Dict],
+                              candidates: int = HYBRID_CANDIDATES) -> List[Union[List[Document], Exception]]:
+    """
+    Runs many searches against the index of `vector_db` in one _msearch request.
+
+    Every search is a dict with the query text, its embedding as vector, k and
+    optionally hybrid=True with fusion_method, lexical_weight and vector_weight.
+    Returns the documents of every search in input order, or the exception of
+    a search that failed.
+    """
+    encoding = index_encoding(vector_db.client, vector_db.index_name) if searches else None
+    body, slices, sizes = [], [], []
+    for search in searches:
+        start = len(body) // 2
+        if search.get("hybrid"):
+            size = max(search["k"], candidates)
+            body += [{"index": vector_db.index_name}, lexical_query(search["query"], size)]
+        else:
+            size = search["k"]
+        body += [{"index": vector_db.index_name}, knn_query(search["vector"], size, encoding)]
+        slices.append((start, len(body) // 2))
+        sizes.append(size)
+    if not body:
+        return []
+    responses = vector_db.client.msearch(body=body)["responses"]
+    results: List[Union[List[Document], Exception]] = []
+    for search, (start, end), size in zip(searches, slices, sizes):
+        items = responses[start:end]
+        error: Optional[Dict] = next((item["error"] for item in items if "error" in item), None)
+        if error is not None:
+            results.append(ValueError(f"search failed, error={error}"))
+            continue
+        check_concrete_index(vector_db.index_name, items[-1]["hits"]["hits"])
+        vector_hits = knn_hits(items[-1]["hits"]["hits"], search["vector"], size, encoding)
+        if search.get("hybrid"):
+            results.append(fuse(items[0]["hits"]["hits"], vector_hits, search["k"], search.get("fusion_method", "rrf"),
+                                search.get("lexical_weight", 0.5), search.get("vector_weight", 0.5)))
+        else:
+            results.append(_to_documents(vector_hits))
+    logger.info(f"msearch of {len(searches)} searches in {len(body) // 2} queries")
+    return results
@@ -2,35 +2,88 @@ import os
 import json
 import boto3
 import logging
-from typing import List, Callable
+import numpy as np
+from typing import Dict, List, Callable, Optional
+from pydantic import PrivateAttr, root_validator
 from urllib.parse import urlparse
 from langchain.vectorstores import OpenSearchVectorSearch
 from langchain.embeddings import SagemakerEndpointEmbeddings
 from .fastapi_request import Request, sagemaker_endpoint_mapping, EmbeddingsModelName
 from langchain.embeddings.sagemaker_endpoint import EmbeddingsContentHandler
 from langchain.llms.sagemaker_endpoint import LLMContentHandler
-import time
 from requests_aws4auth import AWS4Auth
 from opensearchpy import RequestsHttpConnection
 from langchain import SagemakerEndpoint
+from .embedding_engine import ConcurrentEmbeddingEngine
+from .embedding_cache import EmbeddingCache, open_embedding_cache
+from .query_cache import CachedEmbeddings, query_embedding_cache
+from .config import get_parameter
+from .faiss_store import FaissVectorStore
+from .async_clients import get_async_sagemaker_runtime, run_blocking
+from .sagemaker_runtime import get_sagemaker_runtime_client
+from .metrics import registry, stage
+from .response_codecs import get_codec, loads
 
 
 logger = logging.getLogger(__name__)
 
-#  fetch value from aws parameter store
-
-ssm = boto3.client('ssm')
-region = ssm.get_parameter(Name='REGION', WithDecryption=True)['Parameter']['Value']
-access_key = ssm.get_parameter(Name='ACCESS_KEY', WithDecryption=True)['Parameter']['Value']
-secret_key = ssm.get_parameter(Name='SECRET_KEY', WithDecryption=True)['Parameter']['Value']
 service = 'es'
+_aws4auth = None
+
+# persistent embedding cache (see embedding_cache.py) on a local disk, e.g. /tmp/embedding-cache,
+# shared by the requests of a warm container, empty disables it
+EMBEDDING_CACHE_DIR = os.environ.get("EMBEDDING_CACHE_DIR", "")
+# /tmp is 512 MB by default
+EMBEDDING_CACHE_MAX_MB = int(os.environ.get("EMBEDDING_CACHE_MAX_MB", "256"))
+_embedding_cache: Optional[EmbeddingCache] = None
+
+
+def _get_aws4auth() -> AWS4Auth:
+    # built on first use so importing the module does not hit the parameter store
+    global _aws4auth
+    if _aws4auth is None:
+        _aws4auth = AWS4Auth(get_parameter('ACCESS_KEY'), get_parameter('SECRET_KEY'),
+                             get_parameter('REGION'), service)
+    return _aws4auth
+
+
+def _get_embedding_cache() -> Optional[EmbeddingCache]:
+    # one for the container, opened on first use
+    global _embedding_cache
+    if _embedding_cache is None and EMBEDDING_CACHE_DIR:
+        _embedding_cache = open_embedding_cache(EMBEDDING_CACHE_DIR, EMBEDDING_CACHE_MAX_MB << 20)
+    return _embedding_cache
 
-aws4auth = AWS4Auth(access_key, secret_key, region, service)
 
 class SagemakerEndpointEmbeddingsJumpStart(SagemakerEndpointEmbeddings):
+    # number of texts per endpoint call and number of endpoint calls in flight
+    batch_size: int = 5
+    max_in_flight: int = 4
+    max_retries: int = 6
+
+    _engine: Optional[ConcurrentEmbeddingEngine] = PrivateAttr(default=None)
+    # texts already embedded by this endpoint are read from it rather than sent again
+    _cache: Optional[EmbeddingCache] = PrivateAttr(default=None)
+
+    @root_validator()
+    def validate_environment(cls, values: Dict) -> Dict:
+        # replaces langchain's validator, which creates a new session and client per instance
+        values["client"] = get_sagemaker_runtime_client(values["region_name"])
+        return values
+
+    @property
+    def engine(self) -> ConcurrentEmbeddingEngine:
+        # created lazily so the adaptive concurrency limit is kept across calls
+        if self._engine is None:
+            self._engine = ConcurrentEmbeddingEngine(self._embedding_func,
+                                                     batch_size=self.batch_size,
+                                                     max_in_flight=self.max_in_flight,
+                                                     max_retries=self.max_retries)
+        return self._engine
+
     def embed_documents(
             self, texts: List[str], 
-            chunk_size: int = 5
+            chunk_size: Optional[int] = None
     ) -> List[List[float]]:
         """Compute doc embeddings using a SageMaker Inference Endpoint.
 
@@ -38,21 +91,82 @@ class SagemakerEndpointEmbeddingsJumpStart(SagemakerEndpointEmbeddings):
             texts: The list of texts to embed.
             chunk_size: The chunk size defines how many input texts will
                 be grouped together as request. If None, will use the
-                chunk size specified by the class.
+                batch size specified by the class.
 
         Returns:
             List of embeddings, one for each text.
         """
-        results = []
-        _chunk_size = len(texts) if chunk_size > len(texts) else chunk_size
-        st = time.time()
-        for i in range(0, len(texts), _chunk_size):
-            response = self._embedding_func(texts[i:i + _chunk_size])
-            results.extend(response)
-        time_taken = time.time() - st
-        logger.info(f"Embedding completes and it took {time_taken} seconds")
+        with stage("embed_documents"):
+            if self._cache is None:
+                results = self.engine.embed(texts, batch_size=chunk_size)
+            else:
+                results, missing = self._lookup(texts)
+                if missing:
+                    results = self._cache.fill(self.endpoint_name, texts, results, missing,
+                                               self.engine.embed(missing, batch_size=chunk_size))
+        registry.inc("embedded_texts_total", len(texts) if self._cache is None else len(missing))
+        return results
+
+    async def aembed_documents(
+            self, texts: List[str],
+            chunk_size: Optional[int] = None
+    ) -> List[List[float]]:
+        """Same as embed_documents but can be awaited from an asyncio event loop."""
+        with stage("embed_documents"):
+            if self._cache is None:
+                results = await self.engine.aembed(texts, batch_size=chunk_size)
+            else:
+                # sqlite and segment file reads and writes, off the event loop
+                results, missing = await run_blocking(self._lookup, texts)
+                if missing:
+                    results = await run_blocking(self._cache.fill, self.endpoint_name, texts, results, missing,
+                                                 await self.engine.aembed(missing, batch_size=chunk_size))
+        registry.inc("embedded_texts_total", len(texts) if self._cache is None else len(missing))
         return results
 
+    def _lookup(self, texts: List[str]):
+        results, missing = self._cache.lookup(self.endpoint_name, texts)
+        registry.inc("embedding_cache_hits_total", len(texts) - sum(result is None for result in results))
+        registry.inc("embedding_cache_misses_total", sum(result is None for result in results))
+        return results, missing
+
+    def embed_query(self, text: str) -> List[float]:
+        if self._cache is None:
+            return super().embed_query(text)
+        results, missing = self._lookup([text])
+        if missing:
+            results = self._cache.fill(self.endpoint_name, [text], results, missing, [super().embed_query(text)])
+        return results[0]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        """embed_query through the async runtime client, the event loop is not blocked."""
+        if self._cache is not None:
+            # the cache waits on the sqlite write lock, it is used from the blocking executor
+            results, missing = await run_blocking(self._lookup, [text])
+            if missing:
+                results = await run_blocking(self._cache.fill, self.endpoint_name, [text], results, missing,
+                                             [await self._aembed_query(text)])
+            return results[0]
+        return await self._aembed_query(text)
+
+    async def _aembed_query(self, text: str) -> List[float]:
+        runtime = get_async_sagemaker_runtime(self.region_name)
+        body = self.content_handler.transform_input([text.replace("\n", " ")], self.model_kwargs or {})
+        response = await runtime.invoke_endpoint(EndpointName=self.endpoint_name,
+                                                 Body=body,
+                                                 ContentType=self.content_handler.content_type,
+                                                 Accept=self.content_handler.accepts)
+        return self.content_handler.transform_output(response)[0]
+
+
+class PooledSagemakerEndpoint(SagemakerEndpoint):
+    """SagemakerEndpoint on the shared runtime client instead of a client per instance."""
+
+    @root_validator()
+    def validate_environment(cls, values: Dict) -> Dict:
+        values["client"] = get_sagemaker_runtime_client(values["region_name"])
+        return values
+
 # class for serializing/deserializing requests/responses to/from the embeddings model
 class ContentHandlerForEmbeddings(EmbeddingsContentHandler):
     """
@@ -60,18 +174,17 @@ class ContentHandlerForEmbeddings(EmbeddingsContentHandler):
     from the output
     """
     content_type = "application/json"
-    accepts = "application/json"
+    # the response codec (see response_codecs.py) decides the format the endpoint answers with
+    codec = get_codec()
+    accepts = codec.accept
 
     def transform_input(self, prompt: str, model_kwargs={}) -> bytes:
         input_str = json.dumps({"text_inputs": prompt, **model_kwargs})
         return input_str.encode('utf-8')
     
-    def transform_output(self, output: bytes) -> List[str]:
-        response_json = json.loads(output.read().decode("utf-8"))
-        embeddings = response_json["embedding"]
-        if len(embeddings) == 1:
-            return [embeddings[0]]
-        return embeddings
+    def transform_output(self, output: bytes) -> np.ndarray:
+        # one float32 row per text, the body is parsed without building python lists
+        return self.codec.decode_embeddings(output)
 
 # class for serializing/deserializing requests/responses to/from the llm model
 class ContentHandlerForTextGeneration(LLMContentHandler):
@@ -87,8 +200,7 @@ class ContentHandlerForTextGeneration(LLMContentHandler):
         return input_str.encode('utf-8')
     
     def transform_output(self, output: bytes) -> str:
-        response_json = json.loads(output.read().decode("utf-8"))
-        return response_json["generated_texts"][0]
+        return loads(output)["generated_texts"][0]
 
 
 # create the embedding
@@ -111,9 +223,20 @@ def _create_sagemaker_embeddings(endpoint_name: str, region: str) -> SagemakerEn
         region_name=region,
         content_handler=content_handler_for_embeddings
     )
+    # texts asked again (repeated or evaluation queries) are not sent to the endpoint
+    embeddings._cache = _get_embedding_cache()
     logger.info(f"embeddings type={type(embeddings)}")
     return embeddings
 
+# embeddings for queries, they are looked up in the cache before calling the endpoint
+def create_query_embeddings(region: str, embedding_model_name: str) -> CachedEmbeddings:
+    embedding_model_name_enum = EmbeddingsModelName(embedding_model_name)
+    embeddings_model_endpoint = sagemaker_endpoint_mapping[embedding_model_name_enum]
+    logger.info(f"embeddings_model_endpoint={embeddings_model_endpoint}")
+    return CachedEmbeddings(_create_sagemaker_embeddings(embeddings_model_endpoint, region),
+                            model_name=embedding_model_name_enum.value,
+                            cache=query_embedding_cache)
+
 # loading vector store
 def load_vector_db_opensearch(region:str,
                               opensearch_endpoint:str,
@@ -124,11 +247,7 @@ def load_vector_db_opensearch(region:str,
                 f"embeddings_model={embedding_model_name}")
     
 
-    embedding_model_name_enum = EmbeddingsModelName(embedding_model_name)
-    embeddings_model_endpoint = sagemaker_endpoint_mapping[embedding_model_name_enum]
-    logger.info(f"embeddings_model_endpoint={embeddings_model_endpoint}")
-
-    embedding_function = _create_sagemaker_embeddings(embeddings_model_endpoint, region)
+    embedding_function = create_query_embeddings(region, embedding_model_name)
    
     vector_db = OpenSearchVectorSearch(index_name = opensearch_index,
                                        embedding_function = embedding_function,
@@ -137,12 +256,23 @@ def load_vector_db_opensearch(region:str,
                                        use_ssl = True,
                                        verify_certs = True,
                                        connection_class = RequestsHttpConnection,
-                                       http_auth=aws4auth)
+                                       http_auth=_get_aws4auth())
     logger.info(f"returning handle to OpenSearchVectorSearch, vector_db={vector_db}")
     return vector_db
 
+# loading the in-process faiss vector store exported by the ingestion job
+def load_vector_db_faiss(region:str,
+                         faiss_index_uri:str,
+                         embedding_model_name:str) -> FaissVectorStore:
+    logger.info(f"load_vector_db_faiss, region={region}, faiss_index_uri={faiss_index_uri}, "
+                f"embeddings_model={embedding_model_name}")
+    embedding_function = create_query_embeddings(region, embedding_model_name)
+    vector_db = FaissVectorStore.load(faiss_index_uri, embedding_function)
+    logger.info(f"returning handle to FaissVectorStore, vector_db={vector_db}")
+    return vector_db
+
 # Sagemaker endpoint instanee for text generation
-def sagemaker_endpoint_for_text_generation(req: Request, region:str) -> SagemakerEndpoint:
+def sagemaker_endpoint_for_text_generation(req: Request, region:str) -> PooledSagemakerEndpoint:
     parameters = {
         "max_length": req.max_length,
         "num_return_sequences": req.num_return_sequences,
@@ -154,7 +284,7 @@ def sagemaker_endpoint_for_text_generation(req: Request, region:str) -> Sagemake
     content_handler = ContentHandlerForTextGeneration()
     text_generation_endpoint_name = sagemaker_endpoint_mapping[req.text_generation_model_name]
     logger.info(f"text_generation_endpoint_name is: {text_generation_endpoint_name}")
-    sm_llm = SagemakerEndpoint(
+    sm_llm = PooledSagemakerEndpoint(
         endpoint_name=text_generation_endpoint_name,
         region_name = region,
         model_kwargs =  parameters,
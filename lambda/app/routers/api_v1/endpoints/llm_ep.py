@@ -1,12 +1,32 @@
-from .fastapi_request import Request, VectorDBType
+from .fastapi_request import Request, VectorDBType, RetrievalMode
 from .initialise import (load_vector_db_opensearch, 
-                         sagemaker_endpoint_for_text_generation)
-from fastapi import APIRouter
-from typing import Any, Dict
+                         load_vector_db_faiss,
+                         sagemaker_endpoint_for_text_generation,
+                         create_query_embeddings)
+from fastapi import APIRouter, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Tuple
 import os
+import json
+import time
+import threading
+import contextvars
 from langchain.chains.question_answering import load_qa_chain
-from .query_llm import query_sm_endpoint
-import boto3
+from langchain.docstore.document import Document
+from .query_llm import aquery_sm_endpoint, stream_sm_endpoint
+from .query_cache import query_embedding_cache
+from .answer_cache import answer_cache, ANSWER_CACHE_ENABLED
+from .config import get_parameter
+from .faiss_store import FAISS_INDEX_URI
+from .hybrid_search import (hybrid_similarity_search, msearch_similarity_search, similarity_search_by_vector,
+                            asimilarity_search_by_vector, ahybrid_similarity_search)
+from .async_clients import run_blocking, get_async_opensearch
+from .metrics import registry, stage, sampled
+from .context_packing import CONTEXT_PACKING, CONTEXT_CANDIDATES_FACTOR, CONTEXT_MIN_SCORE, pack_context
+from .llm_pool import PooledLLM, llm_pool
 import logging
 from langchain import PromptTemplate
 
@@ -15,96 +35,428 @@ logging.getLogger().setLevel(logging.INFO)
 logger = logging.getLogger()
 
 
-_vector_db = None
-_current_vectordb_type = None
-_sm_llm = None
+# vector db of every vectordb type and embeddings model, created on first use and shared by the requests
+_vector_dbs: Dict[Tuple, Any] = {}
+_vector_dbs_lock = threading.Lock()
+_query_embeddings = {}
+
+# largest accepted /rag/batch request and number of generations in flight for it
+RAG_BATCH_MAX_ITEMS = int(os.environ.get("RAG_BATCH_MAX_ITEMS", "100"))
+RAG_BATCH_MAX_CONCURRENCY = int(os.environ.get("RAG_BATCH_MAX_CONCURRENCY", "8"))
+
+RAG_PROMPT_TEMPLATE = """Answer based on context:\n {context} \n Question: {question} \n Answer:"""
+# compiled once, the chains of all the pooled llms share it
+RAG_PROMPT = PromptTemplate(template=RAG_PROMPT_TEMPLATE, input_variables=["context", "question"])
 
 router = APIRouter()
 
-ssm = boto3.client('ssm')
-region = ssm.get_parameter(Name='REGION', WithDecryption=True)['Parameter']['Value']
-opensearch_domain_endpoint = ssm.get_parameter(Name='OPENSEARCH_DOMAIN_ENDPOINT', WithDecryption=True)['Parameter']['Value']
-opensearch_index = ssm.get_parameter(Name='OPENSEARCH_INDEX', WithDecryption=True)['Parameter']['Value']
+
+def _load_vector_db(req: Request):
+    if req.vectordb_type == VectorDBType.opensearch:
+        return load_vector_db_opensearch(get_parameter('REGION'),
+                                         get_parameter('OPENSEARCH_DOMAIN_ENDPOINT'),
+                                         get_parameter('OPENSEARCH_INDEX'),
+                                         req.embeddings_generation_model_name)
+    if req.vectordb_type == VectorDBType.faiss:
+        return load_vector_db_faiss(get_parameter('REGION'),
+                                    FAISS_INDEX_URI,
+                                    req.embeddings_generation_model_name)
+    raise ValueError(f"req.vectordb_type={req.vectordb_type} which is not supported")
+
 
 def _init(req:Request):
-    global _vector_db
-    global _current_vectordb_type
-    logger.info(f"req.vector_db_type: {req.vectordb_type}, _vector_db: {_vector_db}")
-    if req.vectordb_type != _current_vectordb_type:
-        logger.info(f"req.vectordb_type={req.vectordb_type} does not match _current_vectordb_type={_current_vectordb_type}, "
-                    f"resetting _vector_db")
-        _vector_db = None
-    if req.vectordb_type == VectorDBType.opensearch and _vector_db is None:
-
-        _vector_db = load_vector_db_opensearch(region,
-                                               opensearch_domain_endpoint,
-                                               opensearch_index,
-                                               req.embeddings_generation_model_name)
-    elif _vector_db is not None:
-        logger.info(f"db already initialized, skipping")
-    else:
-        logger.error(f"req.vectordb_type={req.vectordb_type} which is not supported, _vector_db={_vector_db}")
-
-    # similar to the above, but for the sagemaker endpoint
-    global _sm_llm
-    if _sm_llm is None:
-        logger.info(f"SM LLM endpoint is not setup, setting it up")
-        _sm_llm = sagemaker_endpoint_for_text_generation(req,region)
-        logger.info("Sagemaker llm endpoint is now set up")
-    else:
-        logger.info(f"SM LLM endpoint is already setup, skipping")
+    """
+    The vector db of the request. Requests in flight keep the one they got,
+    a request with another vectordb type or embeddings model does not replace it.
+    """
+    key = (req.vectordb_type, req.embeddings_generation_model_name)
+    with _vector_dbs_lock:
+        vector_db = _vector_dbs.get(key)
+        if vector_db is None:
+            logger.info(f"loading the vector db of vectordb_type={req.vectordb_type}, "
+                        f"embeddings model={req.embeddings_generation_model_name}")
+            vector_db = _load_vector_db(req)
+            _vector_dbs[key] = vector_db
+    if sampled():
+        logger.info(f"req.vector_db_type: {req.vectordb_type}, vector_db: {vector_db}")
+    return vector_db
+
+
+def _get_query_embeddings(req: Request):
+    # /text2text does not go through the vector db but still needs query
+    # embeddings for the answer cache, one instance per embeddings model
+    if req.embeddings_generation_model_name not in _query_embeddings:
+        _query_embeddings[req.embeddings_generation_model_name] = create_query_embeddings(
+            get_parameter('REGION'), req.embeddings_generation_model_name)
+    return _query_embeddings[req.embeddings_generation_model_name]
+
+
+def _generation_key(req: Request) -> Tuple:
+    # text generation model and parameters, requests with the same key can share an llm
+    return (req.text_generation_model_name.value, req.max_length, req.num_return_sequences,
+            req.top_k, req.top_p, req.temperature, req.do_sample)
+
+
+def _build_llm(req: Request) -> PooledLLM:
+    llm = sagemaker_endpoint_for_text_generation(req, get_parameter('REGION'))
+    # using load_qa_chain which is a high-level api than LLMChain
+    return PooledLLM(llm=llm, rag_chain=load_qa_chain(llm=llm, prompt=RAG_PROMPT, chain_type="stuff"))
+
+
+def _get_llm(req: Request) -> PooledLLM:
+    # the llm and chain built for the text generation model and parameters of the request
+    return llm_pool.get(_generation_key(req), lambda: _build_llm(req))
+
+
+def _answer_cache_key(req: Request, endpoint: str) -> Tuple:
+    # only answers generated with exactly the same parameters can be reused
+    key = (endpoint, req.embeddings_generation_model_name.value) + _generation_key(req)
+    if endpoint == "rag":
+        key += (req.vectordb_type.value, req.max_matching_docs, req.retrieval_mode.value)
+        if req.retrieval_mode == RetrievalMode.hybrid:
+            key += (req.fusion_method.value, req.lexical_weight, req.vector_weight)
+    return key
+
+
+def _search_k(req: Request) -> int:
+    # context packing picks the documents out of more candidates
+    return req.max_matching_docs * CONTEXT_CANDIDATES_FACTOR if CONTEXT_PACKING else req.max_matching_docs
+
+
+def _pack_context(req: Request, docs: List[Document]) -> List[Document]:
+    if not CONTEXT_PACKING:
+        return docs
+    # fused hybrid scores are not on the scale of the threshold
+    hybrid = req.retrieval_mode == RetrievalMode.hybrid and req.vectordb_type == VectorDBType.opensearch
+    with stage("pack"):
+        packed, stats = pack_context(docs, req.max_matching_docs, min_score=None if hybrid else CONTEXT_MIN_SCORE)
+    registry.inc("context_tokens_total", stats["tokens_after"])
+    registry.inc("context_tokens_saved_total", stats["tokens_saved"])
+    logger.info(f"context packing, candidates={stats['candidates']}, below_min_score={stats['below_min_score']}, "
+                f"merged={stats['merged']}, selected={stats['selected']}, prompt tokens {stats['tokens_before']} -> "
+                f"{stats['tokens_after']}, saved={stats['tokens_saved']}")
+    return packed
+
+
+def _similarity_search(req: Request, vector_db):
+    if req.retrieval_mode == RetrievalMode.hybrid:
+        if req.vectordb_type == VectorDBType.opensearch:
+            return hybrid_similarity_search(vector_db, req.query, k=_search_k(req),
+                                            fusion_method=req.fusion_method.value,
+                                            lexical_weight=req.lexical_weight,
+                                            vector_weight=req.vector_weight)
+        logger.warning(f"hybrid retrieval needs opensearch, vectordb_type={req.vectordb_type}, using vector search")
+    if req.vectordb_type == VectorDBType.opensearch:
+        # the query vector has to be encoded like the vectors of the index
+        query_embedding = vector_db.embedding_function.embed_query(req.query)
+        return similarity_search_by_vector(vector_db, query_embedding, k=_search_k(req))
+    return vector_db.similarity_search(req.query, k=_search_k(req))
+
+
+async def _asimilarity_search(req: Request, vector_db, query_embedding: List[float]) -> List[Document]:
+    # opensearch is queried with the async client, the in-process faiss search runs on the executor
+    if req.vectordb_type == VectorDBType.opensearch:
+        client = get_async_opensearch(get_parameter('OPENSEARCH_DOMAIN_ENDPOINT'))
+        if req.retrieval_mode == RetrievalMode.hybrid:
+            return await ahybrid_similarity_search(client, vector_db.index_name, req.query, query_embedding,
+                                                   k=_search_k(req),
+                                                   fusion_method=req.fusion_method.value,
+                                                   lexical_weight=req.lexical_weight,
+                                                   vector_weight=req.vector_weight)
+        return await asimilarity_search_by_vector(client, vector_db.index_name, query_embedding, k=_search_k(req))
+    if req.retrieval_mode == RetrievalMode.hybrid:
+        logger.warning(f"hybrid retrieval needs opensearch, vectordb_type={req.vectordb_type}, using vector search")
+    return await run_blocking(vector_db.similarity_search_by_vector, query_embedding, k=_search_k(req))
+
+
+def _sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _stream_answer(req: Request, text_inputs: str, on_done) -> Iterator[str]:
+    # tokens go out as they arrive, the full answer is handed to on_done for caching
+    parts = []
+    st = time.perf_counter()
+    try:
+        for text in stream_sm_endpoint(req, text_inputs):
+            if not parts:
+                registry.observe("stage_seconds", time.perf_counter() - st, stage="llm_first_token")
+            parts.append(text)
+            yield _sse("token", {"text": text})
+    except Exception as e:
+        logger.error(f"error while streaming the answer, error={e}")
+        yield _sse("error", {"message": str(e)})
+        return
+    answer = "".join(parts)
+    if sampled():
+        logger.info(f"answer streamed from llm, question: \"{req.query}\" answer: \"{answer}\"")
+    yield from on_done(answer)
+
+
+def _sources(docs: List[Document], verbose: bool) -> Dict[str, Any]:
+    if verbose:
+        return {'docs': [doc.dict() for doc in docs]}
+    return {'sources': [doc.metadata.get('source') for doc in docs]}
+
+
+def _respond(resp: Dict[str, Any]) -> JSONResponse:
+    # serialized here rather than by fastapi so the time it takes shows up as a stage
+    with stage("serialize"):
+        return JSONResponse(jsonable_encoder(resp))
+
+
+def _log_docs(req: Request, docs: List[Document]) -> None:
+    if sampled():
+        logger.info(f"there are the {req.max_matching_docs} closest documents to the query= \"{req.query}\"")
+        for doc in docs:
+            logger.info(f"doc: {doc}")
+
+
+def _event_stream(events: Iterator[str]) -> StreamingResponse:
+    # no-transform keeps proxies from buffering or compressing the events
+    return StreamingResponse(events, media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache, no-transform", "X-Accel-Buffering": "no"})
+
+
+def _text2text_events(req: Request, query_embedding) -> Iterator[str]:
+    def _done(answer: str):
+        if query_embedding is not None:
+            answer_cache.store(_answer_cache_key(req, "text2text"), query_embedding, {'answer': [answer]})
+        yield _sse("done", {'question': req.query, 'answer': [answer], 'cached': False})
+
+    yield from _stream_answer(req, req.query, _done)
+
+
+def _rag_events(req: Request, vector_db, query_embedding) -> Iterator[str]:
+    try:
+        with stage("search"):
+            docs = _similarity_search(req, vector_db)
+    except Exception as e:
+        logger.error(f"error in similarity search, error={e}")
+        yield _sse("error", {"message": str(e)})
+        return
+    docs = _pack_context(req, docs)
+    _log_docs(req, docs)
+    # sources first, they are known long before the first token
+    yield _sse("sources", _sources(docs, req.verbose))
+    context = "\n\n".join(doc.page_content for doc in docs)
+
+    def _done(answer: str):
+        if query_embedding is not None:
+            answer_cache.store(_answer_cache_key(req, "rag"), query_embedding, {'answer': answer, 'docs': docs})
+        yield _sse("done", {'question': req.query, 'answer': answer, 'cached': False})
+
+    yield from _stream_answer(req, RAG_PROMPT.format(context=context, question=req.query), _done)
+
+
+def _cached_events(req: Request, cached: Dict[str, Any]) -> Iterator[str]:
+    if 'docs' in cached:
+        yield _sse("sources", _sources(cached['docs'], req.verbose))
+    yield _sse("done", {'question': req.query, 'answer': cached['answer'], 'cached': True})
 
 
 @router.post("/text2text")
 async def llm_text2text(req: Request) -> Dict[str, Any]:
     # debugdding request
-    logger.info(f"req: {req}")
+    if sampled():
+        logger.info(f"req: {req}")
 
     # _init(req)
 
-    answer = query_sm_endpoint(req)
-    resp = {'question': req.query, 'answer': answer}
-    return resp
+    use_cache = ANSWER_CACHE_ENABLED and req.use_cache
+    if use_cache:
+        with stage("embed"):
+            query_embeddings = await run_blocking(_get_query_embeddings, req)
+            query_embedding = await query_embeddings.aembed_query(req.query)
+        with stage("cache"):
+            cached = answer_cache.lookup(_answer_cache_key(req, "text2text"), query_embedding)
+        if cached is not None:
+            if req.stream:
+                return _event_stream(_cached_events(req, cached))
+            return _respond({'question': req.query, 'answer': cached['answer'], 'cached': True})
+
+    if req.stream:
+        return _event_stream(_text2text_events(req, query_embedding if use_cache else None))
+
+    with stage("llm"):
+        answer = await aquery_sm_endpoint(req)
+    if use_cache:
+        answer_cache.store(_answer_cache_key(req, "text2text"), query_embedding, {'answer': answer})
+    resp = {'question': req.query, 'answer': answer, 'cached': False}
+    return _respond(resp)
 
 
 @router.post("/rag")
 async def llm_rag(req: Request) -> Dict[str, Any]:
     # debugdding request
-    logger.info(f"req: {req}")
+    if sampled():
+        logger.info(f"req: {req}")
+
+    # the vector db of the request, used for the whole request even if another one is loaded meanwhile
+    with stage("init"):
+        vector_db = await run_blocking(_init, req)
+
+    # the query is embedded once, for the answer cache and for retrieval
+    with stage("embed"):
+        query_embedding = await vector_db.embedding_function.aembed_query(req.query)
 
-   # initialize the vector db and the sagemaker endpoint
-   # it will be saved to gloabl  variable
-    _init(req)
+    # near duplicate questions asked with the same parameters are answered
+    # from the cache, skipping both retrieval and generation
+    use_cache = ANSWER_CACHE_ENABLED and req.use_cache
+    if use_cache:
+        with stage("cache"):
+            cached = answer_cache.lookup(_answer_cache_key(req, "rag"), query_embedding)
+        if cached is not None:
+            if req.stream:
+                return _event_stream(_cached_events(req, cached))
+            resp = {'question': req.query, 'answer': cached['answer'], 'cached': True}
+            if req.verbose:
+                resp['docs'] = cached['docs']
+            return _respond(resp)
 
-    # Use the vector db to find similar documents to the query
-    # the vector db call would automatically convert the query text
-    # into embeddings
+    if req.stream:
+        return _event_stream(_rag_events(req, vector_db, query_embedding if use_cache else None))
+
+    # Use the vector db to find similar documents to the query embedding
     try:
-        docs = _vector_db.similarity_search(req.query, k=req.max_matching_docs)
+        with stage("search"):
+            docs = await _asimilarity_search(req, vector_db, query_embedding)
     except Exception as e:
         logger.error(f"error in similarity search, error={e}")
         raise e
-    
-    logger.info(f"there are the {req.max_matching_docs} closest documents to the query= \"{req.query}\"")
-    for doc in docs:
-        logger.info(f"--------")
-        logger.info(f"doc: {doc}")
-        logger.info(f"--------")
-    
-    #define prompt
-    prompt_template = """Answer based on context:\n {context} \n Question: {question} \n Answer:"""
-    prompt = PromptTemplate(
-        template = prompt_template, input_variables = ["context", "question"]
-
-    )
-    logger.info(f"prompt sent to llm = \"{prompt}\"")
-    # using load_qa_chain which is a high-level api than LLMChain 
-    chain = load_qa_chain(llm=_sm_llm, prompt=prompt, chain_type="stuff")
-    answer = chain({"input_documents": docs, "question": req.query}, return_only_outputs=True)['output_text']
-    logger.info(f"answer received from llm, question: \"{req.query}\" answer: \"{answer}\"")
-    resp  = {'question': req.query, 'answer': answer}
+    docs = _pack_context(req, docs)
+    # documents are only logged in full for the sampled requests
+    _log_docs(req, docs)
+
+    # prompt and chain are built once per set of generation parameters
+    with stage("prompt"):
+        chain = _get_llm(req).rag_chain
+    if sampled():
+        logger.info(f"prompt sent to llm = \"{RAG_PROMPT}\"")
+    # the langchain llm is synchronous, it runs on the bounded executor
+    with stage("llm"):
+        answer = (await run_blocking(chain, {"input_documents": docs, "question": req.query},
+                                     return_only_outputs=True))['output_text']
+    if sampled():
+        logger.info(f"answer received from llm, question: \"{req.query}\" answer: \"{answer}\"")
+    if use_cache:
+        answer_cache.store(_answer_cache_key(req, "rag"), query_embedding, {'answer': answer, 'docs': docs})
+    resp  = {'question': req.query, 'answer': answer, 'cached': False}
     if req.verbose:
         resp['docs'] = docs
-    return resp
+    return _respond(resp)
+
+
+@router.get("/cache/stats")
+async def cache_stats() -> Dict[str, Any]:
+    return {'query_embedding_cache': query_embedding_cache.stats(),
+            'answer_cache': answer_cache.stats(),
+            'llm_pool': llm_pool.stats()}
+
+
+@router.get("/metrics")
+async def metrics(format: str = "json"):
+    """Stage and request latency histograms and counters, format=prometheus for the text exposition format."""
+    if format == "prometheus":
+        return PlainTextResponse(registry.prometheus(), media_type="text/plain; version=0.0.4")
+    return registry.as_dict()
+
+
+def _batch_similarity_search(vector_db, reqs: List[Request], query_embeddings: List[List[float]]) -> List[Any]:
+    # documents of every request, or the exception its search failed with
+    if reqs and reqs[0].vectordb_type == VectorDBType.opensearch:
+        searches = [{"query": req.query, "vector": vector, "k": _search_k(req),
+                     "hybrid": req.retrieval_mode == RetrievalMode.hybrid,
+                     "fusion_method": req.fusion_method.value,
+                     "lexical_weight": req.lexical_weight,
+                     "vector_weight": req.vector_weight} for req, vector in zip(reqs, query_embeddings)]
+        try:
+            return msearch_similarity_search(vector_db, searches)
+        except Exception as e:
+            logger.error(f"error in batch similarity search, error={e}")
+            return [e] * len(reqs)
+    results = []
+    for req, vector in zip(reqs, query_embeddings):
+        try:
+            results.append(vector_db.similarity_search_by_vector(vector, k=_search_k(req)))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def _rag_batch(reqs: List[Request]) -> List[Dict[str, Any]]:
+    results: List[Dict[str, Any]] = [None] * len(reqs)
+    retrieved = []
+    # requests are processed per vector db and embeddings model
+    groups: Dict[Tuple, List[int]] = {}
+    for i, req in enumerate(reqs):
+        groups.setdefault((req.vectordb_type, req.embeddings_generation_model_name), []).append(i)
+    for indices in groups.values():
+        try:
+            vector_db = _init(reqs[indices[0]])
+            with stage("embed"):
+                query_embeddings = vector_db.embedding_function.embed_queries([reqs[i].query for i in indices])
+        except Exception as e:
+            logger.error(f"error while loading the vector db or embedding the batch queries, error={e}")
+            for i in indices:
+                results[i] = {'question': reqs[i].query, 'error': str(e)}
+            continue
+        to_search = []
+        for i, query_embedding in zip(indices, query_embeddings):
+            req = reqs[i]
+            if ANSWER_CACHE_ENABLED and req.use_cache:
+                cached = answer_cache.lookup(_answer_cache_key(req, "rag"), query_embedding)
+                if cached is not None:
+                    results[i] = {'question': req.query, 'answer': cached['answer'], 'cached': True}
+                    if req.verbose:
+                        results[i]['docs'] = cached['docs']
+                    continue
+            to_search.append((i, query_embedding))
+        with stage("search"):
+            found = _batch_similarity_search(vector_db, [reqs[i] for i, _ in to_search], [vector for _, vector in to_search])
+        for (i, query_embedding), docs in zip(to_search, found):
+            if isinstance(docs, Exception):
+                results[i] = {'question': reqs[i].query, 'error': str(docs)}
+            else:
+                retrieved.append((i, query_embedding, _pack_context(reqs[i], docs)))
+    logger.info(f"rag batch of {len(reqs)} requests, {len(retrieved)} to generate")
+
+    # the pooled llm and chain of every set of generation parameters, shared by the generation threads
+    def _generate(item):
+        i, query_embedding, docs = item
+        req = reqs[i]
+        try:
+            chain = _get_llm(req).rag_chain
+            with stage("llm", route="/api/v1/llm/rag/batch"):
+                answer = chain({"input_documents": docs, "question": req.query}, return_only_outputs=True)['output_text']
+        except Exception as e:
+            logger.error(f"error in batch generation, question: \"{req.query}\", error={e}")
+            return i, {'question': req.query, 'error': str(e)}
+        if ANSWER_CACHE_ENABLED and req.use_cache:
+            answer_cache.store(_answer_cache_key(req, "rag"), query_embedding, {'answer': answer, 'docs': docs})
+        resp = {'question': req.query, 'answer': answer, 'cached': False}
+        if req.verbose:
+            resp['docs'] = docs
+        return i, resp
+
+    if retrieved:
+        with ThreadPoolExecutor(max_workers=min(RAG_BATCH_MAX_CONCURRENCY, len(retrieved))) as executor:
+            for i, resp in executor.map(_generate, retrieved):
+                results[i] = resp
+    return results
 
 
+@router.post("/rag/batch")
+async def llm_rag_batch(reqs: List[Request]) -> Dict[str, Any]:
+    """
+    Answers many /rag requests at once: queries are embedded in batched calls,
+    retrieved with one _msearch and generated concurrently. Results are in input
+    order, a failed item has an error instead of an answer.
+    """
+    if len(reqs) > RAG_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"at most {RAG_BATCH_MAX_ITEMS} requests per batch")
+    logger.info(f"rag batch request with {len(reqs)} items")
+    registry.inc("rag_batch_items_total", len(reqs))
+    # blocking work, keep it off the event loop
+    results = await run_in_threadpool(contextvars.copy_context().run, _rag_batch, reqs)
+    return _respond({'results': results})
@@ -0,0 +1,87 @@
+"""
+Pool of ready to use text generation LLMs and the chains compiled on top of
+them, keyed on the text generation model and the generation parameters.
+
+The langchain SagemakerEndpoint sends the model_kwargs it was created with,
+there is no per call override, so every set of generation parameters needs its
+own LLM. Requests with parameters seen before reuse the LLM and the chain
+built for them, a new set of parameters builds them once. The pool is a
+bounded LRU, the LLMs share the runtime client and its connection pool so an
+entry is cheap to keep.
+"""
+import os
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, NamedTuple
+from .metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# number of sets of generation parameters kept, can be overridden through the lambda environment
+LLM_POOL_MAX_ENTRIES = int(os.environ.get("LLM_POOL_MAX_ENTRIES", "32"))
+
+
+class PooledLLM(NamedTuple):
+    llm: Any
+    # load_qa_chain of the llm with the rag prompt
+    rag_chain: Any
+
+
+class LLMPool:
+    """
+    Args:
+        max_entries: maximum number of LLMs kept, the least recently used one is dropped first.
+    """
+
+    def __init__(self, max_entries: int = 32):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[Hashable, PooledLLM]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, build: Callable[[], PooledLLM]) -> PooledLLM:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        if entry is not None:
+            registry.inc("llm_pool_hits_total")
+            return entry
+        # built outside of the lock, requests with other parameters are not held up
+        built = build()
+        evicted = 0
+        with self._lock:
+            self.misses += 1
+            # another request may have built it in the meantime, the first one is kept
+            entry = self._entries.setdefault(key, built)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                evicted += 1
+            self.evictions += evicted
+            size = len(self._entries)
+        registry.inc("llm_pool_misses_total")
+        if evicted:
+            registry.inc("llm_pool_evictions_total", evicted)
+        logger.info(f"llm pool: built an llm for {key}, {size} pooled")
+        return entry
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self._entries),
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+llm_pool = LLMPool(max_entries=LLM_POOL_MAX_ENTRIES)
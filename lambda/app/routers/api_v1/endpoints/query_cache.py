@@ -0,0 +1,257 @@
+"""
+Cache of query text -> embedding vector that sits in front of the embeddings
+endpoint, so repeated /rag questions skip the SageMaker round trip.
+
+The in-memory layer is a bounded LRU with a TTL, keyed on the embeddings model
+name and the normalised query text. An optional shared backend (a directory,
+e.g. on /tmp or EFS, or a Redis compatible server) lets warm Lambda containers
+share hits with each other.
+"""
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from langchain.embeddings.base import Embeddings
+from .async_clients import run_blocking
+
+logger = logging.getLogger(__name__)
+
+# cache settings, can be overridden through the lambda environment
+QUERY_CACHE_MAX_ENTRIES = int(os.environ.get("QUERY_CACHE_MAX_ENTRIES", "1024"))
+QUERY_CACHE_TTL_SECONDS = float(os.environ.get("QUERY_CACHE_TTL_SECONDS", "3600"))
+QUERY_CACHE_COLLAPSE_WHITESPACE = os.environ.get("QUERY_CACHE_COLLAPSE_WHITESPACE", "true").lower() == "true"
+QUERY_CACHE_LOWERCASE = os.environ.get("QUERY_CACHE_LOWERCASE", "false").lower() == "true"
+# "" for in-memory only, "file:///tmp/query-embedding-cache" or "redis://host:6379/0"
+QUERY_CACHE_BACKEND = os.environ.get("QUERY_CACHE_BACKEND", "")
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def _as_list(embedding) -> List[float]:
+    # the endpoint returns numpy rows, the shared backends store json
+    return embedding.tolist() if isinstance(embedding, np.ndarray) else embedding
+
+
+class FileCacheBackend:
+    """One json file per key in a directory, writes are atomic renames."""
+
+    def __init__(self, directory: str, max_entries: int = 10000):
+        self.directory = directory
+        self.max_entries = max_entries
+        self._writes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str, ttl: float) -> Optional[List[float]]:
+        try:
+            with open(self._path(key)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry["ts"] > ttl:
+            return None
+        return entry["embedding"]
+
+    def set(self, key: str, embedding: List[float], ttl: float) -> None:
+        tmp_path = self._path(key) + f".{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"ts": time.time(), "embedding": _as_list(embedding)}, f)
+        os.replace(tmp_path, self._path(key))
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self._prune()
+
+    def _prune(self) -> None:
+        # drop the oldest files once the directory grows past max_entries
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".json")]
+        if len(paths) <= self.max_entries:
+            return
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:len(paths) - self.max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class RedisCacheBackend:
+    """Any server speaking the Redis protocol (ElastiCache, a local stand-in...)."""
+
+    def __init__(self, url: str):
+        try:
+            import redis
+        except ImportError:
+            raise ValueError("Could not import redis python package. "
+                             "Please install it with `pip install redis`.")
+        self.client = redis.Redis.from_url(url, socket_timeout=0.05)
+
+    def get(self, key: str, ttl: float) -> Optional[List[float]]:
+        value = self.client.get(key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key: str, embedding: List[float], ttl: float) -> None:
+        self.client.set(key, json.dumps(_as_list(embedding)), ex=int(ttl))
+
+
+def create_cache_backend(url: str):
+    if not url:
+        return None
+    if url.startswith("file://"):
+        return FileCacheBackend(url[len("file://"):])
+    if url.startswith("redis://") or url.startswith("rediss://"):
+        return RedisCacheBackend(url)
+    raise ValueError(f"unsupported query cache backend={url}")
+
+
+class QueryEmbeddingCache:
+    """
+    Args:
+        max_entries: maximum number of embeddings kept in memory.
+        ttl_seconds: how long an embedding stays valid.
+        collapse_whitespace: treat runs of whitespace as a single space and strip the ends.
+        lowercase: ignore case when matching queries.
+        backend: optional shared backend consulted on a local miss.
+    """
+
+    def __init__(self,
+                 max_entries: int = 1024,
+                 ttl_seconds: float = 3600,
+                 collapse_whitespace: bool = True,
+                 lowercase: bool = False,
+                 backend=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.collapse_whitespace = collapse_whitespace
+        self.lowercase = lowercase
+        self.backend = backend
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[float, List[float]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def normalize(self, text: str) -> str:
+        if self.collapse_whitespace:
+            text = _WHITESPACE.sub(" ", text).strip()
+        if self.lowercase:
+            text = text.lower()
+        return text
+
+    @staticmethod
+    def _backend_key(key: Tuple[str, str]) -> str:
+        return hashlib.sha256("\x00".join(key).encode("utf-8")).hexdigest()
+
+    def get(self, model_name: str, text: str) -> Optional[List[float]]:
+        key = (model_name, self.normalize(text))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[0] <= self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+        if self.backend is not None:
+            try:
+                embedding = self.backend.get(self._backend_key(key), self.ttl_seconds)
+            except Exception as e:
+                logger.warning(f"query cache backend get failed, error={e}")
+                embedding = None
+            if embedding is not None:
+                with self._lock:
+                    self.shared_hits += 1
+                self._put_local(key, embedding)
+                return embedding
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _put_local(self, key: Tuple[str, str], embedding: List[float]) -> None:
+        with self._lock:
+            self._entries[key] = (time.time(), embedding)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def set(self, model_name: str, text: str, embedding: List[float]) -> None:
+        key = (model_name, self.normalize(text))
+        self._put_local(key, embedding)
+        if self.backend is not None:
+            try:
+                self.backend.set(self._backend_key(key), embedding, self.ttl_seconds)
+            except Exception as e:
+                logger.warning(f"query cache backend set failed, error={e}")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            return {"entries": len(self._entries),
+                    "hits": self.hits,
+                    "shared_hits": self.shared_hits,
+                    "misses": self.misses,
+                    "hit_rate": (self.hits + self.shared_hits) / lookups if lookups else 0.0}
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embeddings object so embed_query is answered from the cache,
+    embed_documents is passed through untouched.
+    """
+
+    def __init__(self, embeddings: Embeddings, model_name: str, cache: QueryEmbeddingCache):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.cache = cache
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        embedding = self.cache.get(self.model_name, text)
+        if embedding is None:
+            embedding = self.embeddings.embed_query(text)
+            self.cache.set(self.model_name, text, embedding)
+        return embedding
+
+    async def aembed_query(self, text: str) -> List[float]:
+        embedding = self.cache.get(self.model_name, text)
+        if embedding is None:
+            if hasattr(self.embeddings, "aembed_query"):
+                embedding = await self.embeddings.aembed_query(text)
+            else:
+                embedding = await run_blocking(self.embeddings.embed_query, text)
+            self.cache.set(self.model_name, text, embedding)
+        return embedding
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """Like embed_query for many queries, the ones not cached are embedded in batched calls."""
+        embeddings = [self.cache.get(self.model_name, text) for text in texts]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            # a query asked twice in the batch is embedded once
+            unique = list(dict.fromkeys(texts[i] for i in missing))
+            computed = dict(zip(unique, self.embeddings.embed_documents(unique)))
+            for text, embedding in computed.items():
+                self.cache.set(self.model_name, text, embedding)
+            for i in missing:
+                embeddings[i] = computed[texts[i]]
+        return embeddings
+
+
+query_embedding_cache = QueryEmbeddingCache(max_entries=QUERY_CACHE_MAX_ENTRIES,
+                                            ttl_seconds=QUERY_CACHE_TTL_SECONDS,
+                                            collapse_whitespace=QUERY_CACHE_COLLAPSE_WHITESPACE,
+                                            lowercase=QUERY_CACHE_LOWERCASE,
+                                            backend=create_cache_backend(QUERY_CACHE_BACKEND))
@@ -1,14 +1,24 @@
-import boto3
 import json
 import logging
-from typing import List, Dict
+from typing import List, Dict, Iterator
+from botocore.exceptions import ClientError
 from .fastapi_request import(Request,
                              sagemaker_endpoint_mapping)
+from .config import get_parameter
+from .async_clients import get_async_sagemaker_runtime
+from .sagemaker_runtime import get_sagemaker_runtime_client
+from .metrics import sampled
+from .response_codecs import loads
 
 logger = logging.getLogger(__name__)
+
+# endpoints that rejected a response stream invocation, they are not tried again
+_streaming_unsupported = set()
+
+
 def query_llm(encode_json, endpoint_name) -> Dict:
     content_type="application/json"
-    client = boto3.client('runtime.sagemaker')
+    client = get_sagemaker_runtime_client(get_parameter('REGION'))
     response = client.invoke_endpoint(EndpointName=endpoint_name,
         ContentType=content_type,
         Body=encode_json)
@@ -16,29 +26,126 @@ def query_llm(encode_json, endpoint_name) -> Dict:
 
 
 def parse_response_model_flan_t5(query_response) -> List:
-    model_predictions = json.loads(query_response["Body"].read())
-    logger.info(f"model_predictions are: {model_predictions}")
+    model_predictions = loads(query_response["Body"])
+    if sampled():
+        logger.info(f"model_predictions are: {model_predictions}")
     generated_text = model_predictions["generated_texts"]
     return generated_text
 
 
-
-def query_sm_endpoint(req: Request) -> List:
-    payload = {
-        "text_inputs": req.query,
+def text_generation_payload(req: Request, text_inputs: str) -> Dict:
+    return {
+        "text_inputs": text_inputs,
         "max_length": req.max_length,
         "num_return_sequences": req.num_return_sequences,
         "top_k": req.top_k,
         "top_p": req.top_p,
         "do_sample": req.do_sample,
         "temperature": req.temperature}
+
+
+def query_sm_endpoint(req: Request) -> List:
+    payload = text_generation_payload(req, req.query)
     text_generation_model_endpoint = sagemaker_endpoint_mapping[req.text_generation_model_name]
     encode_json = json.dumps(payload).encode("utf-8")
-    logger.info(f"encode_json for text generation model: {encode_json}")
+    if sampled():
+        logger.info(f"encode_json for text generation model: {encode_json}")
     query_response = query_llm(encode_json,
         endpoint_name = text_generation_model_endpoint)
-    
+
 
     generated_texts = parse_response_model_flan_t5(query_response)
-    logger.info(f"the generated output is: {generated_texts}")
-    return generated_texts
\ No newline at end of file
+    if sampled():
+        logger.info(f"the generated output is: {generated_texts}")
+    return generated_texts
+
+
+async def aquery_sm_endpoint(req: Request) -> List:
+    """query_sm_endpoint through the async runtime client, the event loop is not blocked."""
+    payload = text_generation_payload(req, req.query)
+    text_generation_model_endpoint = sagemaker_endpoint_mapping[req.text_generation_model_name]
+    encode_json = json.dumps(payload).encode("utf-8")
+    if sampled():
+        logger.info(f"encode_json for text generation model: {encode_json}")
+    runtime = get_async_sagemaker_runtime(get_parameter('REGION'))
+    body = await runtime.invoke_endpoint(EndpointName=text_generation_model_endpoint,
+                                         Body=encode_json,
+                                         ContentType="application/json")
+    generated_texts = parse_response_model_flan_t5({"Body": body})
+    if sampled():
+        logger.info(f"the generated output is: {generated_texts}")
+    return generated_texts
+
+
+def _parse_stream_line(line: bytes) -> str:
+    # containers stream either server-sent events ("data: {...}") with a token
+    # per event (text-generation-inference) or json / plain text parts
+    text = line.decode("utf-8")
+    if text.startswith("data:"):
+        text = text[len("data:"):].strip()
+    if not text.strip():
+        return ""
+    try:
+        part = json.loads(text)
+    except ValueError:
+        return text + "\n"
+    if not isinstance(part, dict):
+        return str(part)
+    if "token" in part:
+        return "" if part["token"].get("special") else part["token"].get("text", "")
+    for key in ("generated_text", "outputs", "generated_texts"):
+        if key in part:
+            value = part[key]
+            return value[0] if isinstance(value, list) else value
+    return ""
+
+
+def _iter_response_stream(event_stream) -> Iterator[str]:
+    # payload parts are not aligned with lines, a line can span several parts
+    buffer = b""
+    for event in event_stream:
+        buffer += event.get("PayloadPart", {}).get("Bytes", b"")
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            text = _parse_stream_line(line)
+            if text:
+                yield text
+    if buffer:
+        text = _parse_stream_line(buffer)
+        if text:
+            yield text
+
+
+def _chunked(text: str, words_per_chunk: int = 4) -> Iterator[str]:
+    words = text.split(" ")
+    for i in range(0, len(words), words_per_chunk):
+        yield " ".join(words[i:i + words_per_chunk]) + (" " if i + words_per_chunk < len(words) else "")
+
+
+def stream_sm_endpoint(req: Request, text_inputs: str) -> Iterator[str]:
+    """
+    Yields the generated text of the first sequence as it is produced.
+
+    Uses InvokeEndpointWithResponseStream when the installed boto3 and the
+    model container support it, otherwise the whole generation is requested
+    with InvokeEndpoint and yielded in chunks.
+    """
+    endpoint_name = sagemaker_endpoint_mapping[req.text_generation_model_name]
+    encode_json = json.dumps(text_generation_payload(req, text_inputs)).encode("utf-8")
+    client = get_sagemaker_runtime_client(get_parameter('REGION'))
+    if hasattr(client, "invoke_endpoint_with_response_stream") and endpoint_name not in _streaming_unsupported:
+        try:
+            response = client.invoke_endpoint_with_response_stream(EndpointName=endpoint_name,
+                                                                   ContentType="application/json",
+                                                                   Body=encode_json)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") != "ValidationError":
+                raise
+            logger.warning(f"endpoint={endpoint_name} does not support response streaming, error={e}, "
+                           f"falling back to chunked responses")
+            _streaming_unsupported.add(endpoint_name)
+        else:
+            yield from _iter_response_stream(response["Body"])
+            return
+    generated_texts = parse_response_model_flan_t5(query_llm(encode_json, endpoint_name=endpoint_name))
+    yield from _chunked(generated_texts[0])
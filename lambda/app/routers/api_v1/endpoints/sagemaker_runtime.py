@@ -0,0 +1,62 @@
+"""
+Shared boto3 SageMaker runtime client for the synchronous calls (query_llm,
+the langchain SagemakerEndpoint wrappers, streaming responses).
+
+Creating a client per call costs a session, the service model load and a new
+TLS connection. boto3 clients are thread-safe once created, so one client per
+region is kept and its urllib3 pool reuses keep-alive connections across
+requests and threads.
+"""
+import os
+import logging
+import threading
+from typing import Any, Dict, Optional
+import boto3
+from botocore.config import Config
+
+logger = logging.getLogger(__name__)
+
+# e.g. a VPC endpoint or a local stand-in, the regional endpoint when empty
+SAGEMAKER_RUNTIME_ENDPOINT_URL = os.environ.get("SAGEMAKER_RUNTIME_ENDPOINT_URL", "")
+# connections kept open per client, above the number of threads calling it concurrently
+SAGEMAKER_RUNTIME_MAX_POOL_CONNECTIONS = int(os.environ.get("SAGEMAKER_RUNTIME_MAX_POOL_CONNECTIONS", "50"))
+SAGEMAKER_RUNTIME_TCP_KEEPALIVE = os.environ.get("SAGEMAKER_RUNTIME_TCP_KEEPALIVE", "true").lower() == "true"
+SAGEMAKER_RUNTIME_CONNECT_TIMEOUT_SECONDS = float(os.environ.get("SAGEMAKER_RUNTIME_CONNECT_TIMEOUT_SECONDS", "5"))
+# generation can take a while, this is the time to the first byte of the response
+SAGEMAKER_RUNTIME_READ_TIMEOUT_SECONDS = float(os.environ.get("SAGEMAKER_RUNTIME_READ_TIMEOUT_SECONDS", "300"))
+# total attempts including the first one, "standard" or "adaptive" (client side rate limiting on throttles)
+SAGEMAKER_RUNTIME_MAX_ATTEMPTS = int(os.environ.get("SAGEMAKER_RUNTIME_MAX_ATTEMPTS", "4"))
+SAGEMAKER_RUNTIME_RETRY_MODE = os.environ.get("SAGEMAKER_RUNTIME_RETRY_MODE", "standard")
+
+_clients: Dict[Optional[str], Any] = {}
+_lock = threading.Lock()
+
+
+def runtime_client_config(max_pool_connections: int = SAGEMAKER_RUNTIME_MAX_POOL_CONNECTIONS) -> Config:
+    return Config(max_pool_connections=max_pool_connections,
+                  tcp_keepalive=SAGEMAKER_RUNTIME_TCP_KEEPALIVE,
+                  connect_timeout=SAGEMAKER_RUNTIME_CONNECT_TIMEOUT_SECONDS,
+                  read_timeout=SAGEMAKER_RUNTIME_READ_TIMEOUT_SECONDS,
+                  retries={"total_max_attempts": SAGEMAKER_RUNTIME_MAX_ATTEMPTS, "mode": SAGEMAKER_RUNTIME_RETRY_MODE})
+
+
+def get_sagemaker_runtime_client(region: Optional[str] = None):
+    """
+    The sagemaker-runtime client of the region (the default region when None),
+    created on first use and shared by every caller afterwards.
+    """
+    client = _clients.get(region)
+    if client is None:
+        # creating clients from the shared default session is not thread-safe
+        with _lock:
+            client = _clients.get(region)
+            if client is None:
+                client = boto3.Session().client("sagemaker-runtime",
+                                                region_name=region,
+                                                endpoint_url=SAGEMAKER_RUNTIME_ENDPOINT_URL or None,
+                                                config=runtime_client_config())
+                logger.info(f"created sagemaker runtime client, region={region or 'default'}, "
+                            f"max_pool_connections={SAGEMAKER_RUNTIME_MAX_POOL_CONNECTIONS}, "
+                            f"retries={SAGEMAKER_RUNTIME_MAX_ATTEMPTS}/{SAGEMAKER_RUNTIME_RETRY_MODE}")
+                _clients[region] = client
+    return client
@@ -0,0 +1,38 @@
+"""
+ASGI middleware giving every request its stage timings (see metrics.stage)
+and returning them in a Server-Timing header, e.g.
+
+    Server-Timing: embed;dur=41.2, search;dur=12.9, prompt;dur=0.4, llm;dur=812.0, serialize;dur=0.3, total;dur=868.1
+
+The header goes out with the response start, so for a streamed response it
+covers the stages before the first event. The time to the response start is
+also recorded in the request_seconds histogram.
+"""
+from starlette.datastructures import MutableHeaders
+from .metrics import registry, start_timings, end_timings
+
+
+class ServerTimingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timings, token = start_timings(scope["path"])
+
+        async def _send(message):
+            if message["type"] == "http.response.start":
+                total = timings.elapsed
+                headers = MutableHeaders(scope=message)
+                headers.append("Server-Timing", timings.server_timing(total))
+                # unknown paths are not used as labels, they would grow the registry without bound
+                route = timings.route if message["status"] != 404 else "unmatched"
+                registry.observe("request_seconds", total, route=route, status=message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            end_timings(token)
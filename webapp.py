@@ -4,10 +4,11 @@ for the UI and the Python requests package to talk to an API endpoint that
 implements text generation and Retrieval Augmented Generation (RAG) using LLMs
 and Amazon OpenSearch as the vector database.
 """
+import json
 import boto3
 import streamlit as st
 import requests as req
-from typing import List, Tuple, Dict
+from typing import Iterator, List, Tuple, Dict
 
 
 # Global constants
@@ -54,6 +55,36 @@ st.set_page_config(
 # keep track of conversations by using streamlit_session
 _ = [st.session_state.setdefault(k, v) for k,v in STREAMLIT_SESSION_VARS]
 
+def iter_events(resp) -> Iterator[Tuple[str, Dict]]:
+    """
+    Yields (event, data) for every server-sent event of a streaming response
+    """
+    event = None
+    for line in resp.iter_lines(decode_unicode=True):
+        if line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            yield event, json.loads(line[len("data:"):].strip())
+
+
+def stream_answer(resp, placeholder) -> str:
+    """
+    Renders the sources and the answer tokens as they arrive, returns the final output
+    """
+    sources, answer, output = None, "", ""
+    for event, data in iter_events(resp):
+        if event == "sources":
+            sources = data.get('sources') or [d['metadata']['source'] for d in data.get('docs', [])]
+        elif event == "token":
+            answer += data['text']
+        elif event == "done":
+            answer = data['answer'][0] if isinstance(data['answer'], list) else data['answer']
+        elif event == "error":
+            answer = f"Error: {data['message']}"
+        output = f"{answer} \n \n Sources: {sources}" if sources is not None else answer
+        placeholder.success(output or "...", icon="👩‍💻")
+    return output
+
 def get_user_input() -> str:
     """
     Returns the text entered by the user
@@ -72,6 +103,7 @@ with st.sidebar.expander("⚙️", expanded=True):
     text2text_model = st.selectbox(label='Text2Text Model', options=TEXT2TEXT_MODEL_LIST)
     embeddings_model = st.selectbox(label='Embeddings Model', options=EMBEDDINGS_MODEL_LIST)
     mode = st.selectbox(label='Mode', options=MODE_VALUES)
+    stream = st.checkbox(label='Stream response', value=True)
 
 # streamlit app layout sidebar + main panel
 # the main panel has a title, a sub header and user input textbox
@@ -88,7 +120,18 @@ if user_input:
     # headers for request and response encoding, same for both endpoints
     headers: Dict[str, str] = {"Content-Type": "application/json", "Accept": "application/json"}
     output: str = None
-    if mode == MODE_TEXT2TEXT:
+    if stream and mode in MODE_VALUES:
+        # show the answer while it is generated, the sources of a RAG answer come first
+        headers["Accept"] = "text/event-stream"
+        placeholder = st.empty()
+        data = {"query": user_input, "stream": True}
+        resp = req.post(api_rag_ep if mode == MODE_RAG else api_text2text_ep, json=data, headers=headers, stream=True)
+        if resp.status_code != HTTP_OK:
+            output = f"Error: {resp.status_code}"
+        else:
+            output = stream_answer(resp, placeholder)
+        placeholder.empty()
+    elif mode == MODE_TEXT2TEXT:
         data = {"query": user_input}
         resp = req.post(api_text2text_ep, json=data, headers=headers)
         if resp.status_code != HTTP_OK: